@@ -0,0 +1,480 @@
+"""
+Офлайн-бенчмарк перелива MS SQL → ClickHouse без боевого MS SQL.
+
+Источник - синтетическая таблица со схемой ALL_DATA_COMPETITORS_MATERIALIZED (45 колонок)
+в процессе или в SQLite, приемник - null-клиент или локальный ClickHouse.
+Для каждого размера батча запускается copy_id_range в отдельном процессе и печатается
+строк/сек, пиковый RSS и суммарное время этапов чтения, конвертации и вставки.
+
+Пример:
+    python benchmark_transfer.py --rows 500000 --batch-sizes 10000,50000,100000
+    CH_HOST=localhost python benchmark_transfer.py --source sqlite --sink clickhouse
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+
+from mssql_to_ch import (
+    COMPETITOR_COLUMNS, BatchConverter, BatchSizer, BlockCoalescer, QuarantineStore, TABLE_SPECS, build_table_ddl,
+    convert_value, copy_id_range, get_clickhouse_client, logger, peak_rss_mb
+)
+
+SPEC = TABLE_SPECS['bi.ALL_DATA_COMPETITORS_MATERIALIZED']
+
+# Типы колонок источника выводятся из описания таблицы SPEC: ключ и календарные колонки -
+# по type_overrides, суммы и количества - decimal, вес и тонны - текст с запятой
+# (такие значения разбирает convert_value), остальные - nvarchar.
+# Типы ClickHouse получаются из них через SPEC.column_type, как в build_table_ddl.
+OVERRIDE_SOURCE_TYPES = {'UInt64': 'bigint', 'UInt16': 'int', 'UInt8': 'int', 'Date': 'date'}
+TEXT_NUMBER_COLUMNS = frozenset({'weight', 'sales_tons'})
+
+
+def source_type(name):
+    """DATA_TYPE колонки синтетического источника"""
+    if name in SPEC.type_overrides:
+        return OVERRIDE_SOURCE_TYPES[SPEC.type_overrides[name]]
+    if name in SPEC.numeric_columns:
+        return 'nvarchar' if name in TEXT_NUMBER_COLUMNS else 'decimal'
+    return 'nvarchar'
+
+
+# Схема источника {колонка: DATA_TYPE} в порядке ORDINAL_POSITION
+SOURCE_COLUMNS = {name: source_type(name) for name in COMPETITOR_COLUMNS}
+
+# Словари измерений; первые значения встречаются чаще (zipf_choice)
+CHAINS = ['Магнит', 'Пятёрочка', 'Перекрёсток', 'Лента', 'Ашан', 'Дикси', 'ВкусВилл', 'Спар',
+          'Монетка', 'Светофор', 'Верный', 'Бристоль']
+REGIONS = ['Москва', 'Московская область', 'Санкт-Петербург', 'Краснодарский край',
+           'Свердловская область', 'Республика Татарстан', 'Новосибирская область',
+           'Самарская область', 'Ростовская область', 'Нижегородская область']
+FORMATS = ['у дома', 'супермаркет', 'гипермаркет', 'дискаунтер', 'магазин-склад']
+CATEGORIES = ['Продукты', 'Напитки', 'Бытовая химия', 'Алкоголь', 'Кондитерские изделия',
+              'Молочная продукция', 'Мясная гастрономия', 'Замороженные продукты']
+PACKAGES = ['бутылка ПЭТ', 'стекло', 'банка', 'пакет', 'коробка', 'тетрапак', 'весовой']
+FLAVORS = ['классический', 'клубника', 'ваниль', 'шоколад', 'лимон', 'вишня', 'мята', 'без вкуса']
+MATERIALS = ['ПЭТ', 'стекло', 'алюминий', 'картон', 'полипропилен']
+# Пустые значения, которые встречаются в текстовых колонках источника
+NULL_MARKERS = ['', '-', 'nan', 'None']
+
+
+def zipf_choice(rng, values):
+    """Выбор с убывающей частотой: первые значения словаря встречаются чаще"""
+    index = min(int(rng.paretovariate(1.2)) - 1, len(values) - 1)
+    return values[index]
+
+
+def maybe_null(rng, value, null_rate, markers=False):
+    """NULL или текстовый маркер пустого значения с вероятностью null_rate"""
+    if rng.random() >= null_rate:
+        return value
+    return rng.choice(NULL_MARKERS) if markers else None
+
+
+def money(rng, low, high, null_rate):
+    return maybe_null(rng, Decimal(f"{rng.uniform(low, high):.2f}"), null_rate)
+
+
+def comma_number(rng, low, high, null_rate):
+    """Число в nvarchar-колонке: с запятой как десятичным разделителем или маркером пустоты"""
+    return maybe_null(rng, f"{rng.uniform(low, high):.3f}".replace('.', ','), null_rate, markers=True)
+
+
+class SyntheticRows:
+    """
+    Детерминированный генератор строк таблицы продаж конкурентов.
+    Строки собираются из пула шаблонов (pool_size разных товаров и магазинов),
+    id, даты и суммы подставляются для каждой строки. Время генерации входит в этап чтения,
+    как создание строк pyodbc в боевом переносе.
+    """
+
+    def __init__(self, total_rows, seed=42, null_rate=0.05, pool_size=20000,
+                 start_date=datetime.date(2023, 1, 1), days=730):
+        self.total_rows = total_rows
+        self.seed = seed
+        self.null_rate = null_rate
+        self.start_date = start_date
+        self.days = days
+        rng = random.Random(seed)
+        self.templates = [self._template(rng, i) for i in range(pool_size)]
+
+    def _template(self, rng, i):
+        """Колонки строки от retail_chain до warehouse_supplier без дат и сумм"""
+        n = self.null_rate
+        chain = zipf_choice(rng, CHAINS)
+        region = zipf_choice(rng, REGIONS)
+        category = zipf_choice(rng, CATEGORIES)
+        brand = f"Бренд {int(rng.paretovariate(0.8)) % 3000}"
+        family = rng.randint(1, 500)
+        factory = rng.randint(1, 300)
+        return {
+            'retail_chain': chain,
+            'branch': maybe_null(rng, f"{chain} {region}", n / 5),
+            'region': maybe_null(rng, region, n / 5),
+            'city': maybe_null(rng, f"{region} г{rng.randint(1, 40)}", n),
+            'address': maybe_null(rng, f"ул. {rng.choice(['Ленина', 'Мира', 'Советская', 'Гагарина'])}, "
+                                       f"д. {rng.randint(1, 250)}, корп. {i}", n, markers=True),
+            'store_format': maybe_null(rng, zipf_choice(rng, FORMATS), n),
+            'store_name': maybe_null(rng, f"{chain} №{rng.randint(1, 2000)}", n),
+            'product_name': f"{category} {brand} {rng.choice(PACKAGES)} {rng.choice([0.33, 0.5, 1, 1.5, 2])} "
+                            f"арт. {i}",
+            'brand': maybe_null(rng, brand, n),
+            'flavor': maybe_null(rng, zipf_choice(rng, FLAVORS), 3 * n, markers=True),
+            'weight': comma_number(rng, 0.05, 5, n),
+            'product_type': category,
+            'package_type': maybe_null(rng, rng.choice(PACKAGES), n, markers=True),
+            'product_level_1': category,
+            'product_level_2': f"{category} / {rng.randint(1, 12)}",
+            'product_level_3': maybe_null(rng, f"{category} / {rng.randint(1, 60)}", n),
+            'product_level_4': maybe_null(rng, f"{category} / {rng.randint(1, 300)}", 4 * n),
+            'product_family_code': f"PF{family:04d}",
+            'product_family_name': maybe_null(rng, f"{category} {brand} семейство {family}", 2 * n),
+            'product_article': maybe_null(rng, f"{rng.randint(10000, 99999)}-{i % 100:02d}", 2 * n, markers=True),
+            'product_code': f"{rng.randint(100000, 999999)}",
+            'barcode': maybe_null(rng, f"46{rng.randint(10 ** 10, 10 ** 11 - 1)}", 0.1),
+            'factory_code': maybe_null(rng, f"F{factory:03d}", 2 * n),
+            'factory_name': maybe_null(rng, f"Завод {factory} «{brand}»", 2 * n, markers=True),
+            'material': maybe_null(rng, zipf_choice(rng, MATERIALS), 2 * n),
+            'vendor': maybe_null(rng, f"Вендор {rng.randint(1, 400)}", 2 * n),
+            'supplier': maybe_null(rng, f"Поставщик {rng.randint(1, 800)}", 2 * n),
+            'warehouse_supplier': maybe_null(rng, f"РЦ {chain} {rng.randint(1, 30)}", 2 * n, markers=True),
+        }
+
+    def row(self, row_id):
+        rng = random.Random(self.seed * 1000003 + row_id)
+        n = self.null_rate
+        # Даты растут вместе с id, как при ежедневной загрузке
+        sale_date = self.start_date + datetime.timedelta(days=row_id * self.days // max(self.total_rows, 1))
+        quantity = rng.uniform(1, 200)
+        price = rng.uniform(30, 3000)
+        amount = quantity * price
+        promo = rng.random() < 0.2
+        values = dict(
+            self.templates[row_id % len(self.templates)],
+            id=row_id,
+            sale_year=sale_date.year,
+            sale_month=sale_date.month,
+            sale_date=maybe_null(rng, sale_date, n / 10),
+            sales_quantity=maybe_null(rng, Decimal(f"{quantity:.3f}"), n),
+            sales_amount_rub=maybe_null(rng, Decimal(f"{amount:.2f}"), n),
+            avg_cost_price=money(rng, 10, 2000, n),
+            avg_sell_price=maybe_null(rng, Decimal(f"{price:.2f}"), n),
+            sales_amount_with_vat=maybe_null(rng, Decimal(f"{amount * 1.2:.2f}"), n),
+            promo_sales_amount_with_vat=money(rng, 0, 50000, 0.8) if promo else None,
+            writeoff_quantity=money(rng, 0, 5, 0.7),
+            writeoff_amount_rub=money(rng, 0, 500, 0.7),
+            margin_amount_rub=money(rng, -500, 20000, n),
+            loss_quantity=money(rng, 0, 3, 0.8),
+            loss_amount_rub=money(rng, 0, 300, 0.8),
+            sales_tons=comma_number(rng, 0, 0.5, n),
+            sales_weight_kg=money(rng, 0, 1000, n),
+        )
+        return tuple(values[name] for name in COMPETITOR_COLUMNS)
+
+    def rows(self, after_id, limit=None, end_id=None):
+        """Строки с id в (after_id, end_id] по возрастанию id, не больше limit"""
+        last = self.total_rows if end_id is None else min(end_id, self.total_rows)
+        if limit is not None:
+            last = min(last, after_id + limit)
+        return [self.row(row_id) for row_id in range(after_id + 1, last + 1)]
+
+
+# Фильтр keyset-запросов copy_id_range: WHERE [id] > N [AND [id] <= M]
+RANGE_PATTERN = re.compile(r"WHERE \[(\w+)\] > (-?\d+)(?: AND \[\w+\] <= (-?\d+))?")
+TOP_PATTERN = re.compile(r"SELECT TOP (\d+)")
+
+
+class MemoryCursor:
+    """
+    Курсор-заглушка pyodbc над SyntheticRows: понимает keyset-запросы copy_id_range
+    (SELECT [TOP N] * ... WHERE [id] > N [AND [id] <= M] ORDER BY [id]),
+    строки генерируются по мере fetchmany/fetchall.
+    """
+
+    def __init__(self, generator, chunk_size=1000):
+        self.generator = generator
+        self.chunk_size = chunk_size
+        self._next_id = None
+        self._end_id = None
+
+    def execute(self, query):
+        match = RANGE_PATTERN.search(query)
+        if not match:
+            raise ValueError(f"Неподдерживаемый запрос бенчмарка: {query.strip()[:100]}")
+        after_id = int(match.group(2))
+        end_id = int(match.group(3)) if match.group(3) else self.generator.total_rows
+        top = TOP_PATTERN.search(query)
+        if top:
+            end_id = min(end_id, after_id + int(top.group(1)))
+        self._next_id, self._end_id = after_id, end_id
+        return self
+
+    def fetchmany(self, size):
+        rows = self.generator.rows(self._next_id, size, self._end_id)
+        if rows:
+            self._next_id = rows[-1][0]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(None)
+
+    def close(self):
+        pass
+
+
+def _adapt_sqlite_types():
+    sqlite3.register_adapter(Decimal, str)
+    sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+    sqlite3.register_converter('decimal', lambda value: Decimal(value.decode()))
+    sqlite3.register_converter('date', lambda value: datetime.date.fromisoformat(value.decode()))
+
+
+def build_sqlite_source(generator, path, chunk_size=10000):
+    """Заполняет таблицу SQLite синтетическими строками (один раз на файл)"""
+    _adapt_sqlite_types()
+    # Конвейер copy_id_range читает источник из отдельного потока
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    exists = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = 'competitors'"
+    ).fetchone()[0]
+    if exists and conn.execute("SELECT COUNT(*) FROM competitors").fetchone()[0] == generator.total_rows:
+        return conn
+    conn.execute("DROP TABLE IF EXISTS competitors")
+    columns_sql = ', '.join(
+        f'"{name}" {mssql_type}' + (' PRIMARY KEY' if name == 'id' else '')
+        for name, mssql_type in SOURCE_COLUMNS.items()
+    )
+    conn.execute(f"CREATE TABLE competitors ({columns_sql})")
+    placeholders = ', '.join('?' * len(SOURCE_COLUMNS))
+    for after_id in range(0, generator.total_rows, chunk_size):
+        conn.executemany(f"INSERT INTO competitors VALUES ({placeholders})",
+                         generator.rows(after_id, chunk_size))
+    conn.commit()
+    return conn
+
+
+class SQLiteCursor:
+    """Курсор SQLite, который выполняет T-SQL запросы copy_id_range ([x] → "x", TOP N → LIMIT N)"""
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+
+    def execute(self, query):
+        top = TOP_PATTERN.search(query)
+        query = TOP_PATTERN.sub('SELECT', query)
+        query = re.sub(r'\[(\w+)\]\.\[(\w+)\]', 'competitors', query)
+        query = re.sub(r'\[(\w+)\]', r'"\1"', query)
+        if top:
+            query += f" LIMIT {top.group(1)}"
+        self.cursor.execute(query)
+        return self
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+# Колонки колоночной вставки insert_column_data: INSERT INTO t (`a`, `b`) VALUES
+INSERT_COLUMNS_PATTERN = re.compile(r"`(\w+)`")
+
+
+class NullClickHouse:
+    """
+    Приемник-заглушка clickhouse_driver.Client: принимает вставки и только считает строки
+    и куски, которые создал бы ClickHouse (по куску на каждый месяц sale_date во вставке)
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.parts = 0
+
+    def execute(self, query, params=None, columnar=False, settings=None):
+        if params is not None and query.lstrip().upper().startswith('INSERT'):
+            self.rows += len(params[0]) if columnar and params else len(params or [])
+            columns = INSERT_COLUMNS_PATTERN.findall(query)
+            if columnar and params and 'sale_date' in columns:
+                months = np.asarray(params[columns.index('sale_date')], dtype='datetime64[M]')
+                self.parts += len(np.unique(months))
+        return []
+
+    def disconnect(self):
+        pass
+
+
+class RowwiseConverter(BatchConverter):
+    """Построчная конвертация через convert_value (как до BatchConverter) - точка сравнения"""
+
+    def __init__(self, source_columns, ch_types, numeric_columns):
+        super().__init__(source_columns, ch_types, numeric_columns)
+        self.use_numpy = False
+
+    def convert(self, rows):
+        converted = [
+            [convert_value(row[pos], name, self.numeric_columns)
+             for pos, name in zip(self.positions, self.columns)]
+            for row in rows
+        ]
+        return [list(col) for col in zip(*converted)] if converted else [[] for _ in self.columns]
+
+
+def open_source(options, generator):
+    if options['source'] == 'memory':
+        return MemoryCursor(generator)
+    conn = build_sqlite_source(generator, options['sqlite_path'])
+    return SQLiteCursor(conn)
+
+
+def open_sink(options):
+    """Null-приемник или локальный ClickHouse с пустой таблицей бенчмарка"""
+    if options['sink'] == 'null':
+        return NullClickHouse(), 'bench_null'
+    target_table = options['target_table']
+    ch_client = get_clickhouse_client()
+    ch_client.execute(f"DROP TABLE IF EXISTS {target_table}")
+    ch_client.execute(build_table_ddl(target_table, SOURCE_COLUMNS, SPEC))
+    return ch_client, target_table
+
+
+def run_benchmark(options):
+    """Один прогон copy_id_range с заданным размером батча, вызывается в отдельном процессе"""
+    generator = SyntheticRows(options['rows'], options['seed'], options['null_rate'])
+    mssql_cursor = open_source(options, generator)
+    ch_client, target_table = open_sink(options)
+    ch_types = {name: SPEC.column_type(name, mssql_type) for name, mssql_type in SOURCE_COLUMNS.items()}
+    converter_class = RowwiseConverter if options['converter'] == 'rowwise' else BatchConverter
+    converter = converter_class(SOURCE_COLUMNS.keys(), ch_types, SPEC.numeric_columns)
+
+    stages = {'fetch_seconds': 0.0, 'convert_seconds': 0.0, 'insert_seconds': 0.0, 'bytes': 0}
+
+    def on_batch(record):
+        for name in stages:
+            stages[name] += record[name]
+
+    batch_sizer = None
+    if options['adaptive']:
+        batch_sizer = BatchSizer(ch_client, target_table, options['batch_size'], adaptive=True,
+                                 target_seconds=options['target_seconds'])
+
+    setup_rss = peak_rss_mb()
+    quarantine = QuarantineStore(ch_client, target_table)
+    if options['sink'] == 'clickhouse':
+        quarantine.ensure()
+    start = time.perf_counter()
+    try:
+        transferred, errors, _ = copy_id_range(
+            mssql_cursor, ch_client, converter, SPEC.source_table, target_table,
+            0, options['batch_size'], quarantine,
+            pipeline_depth=options['pipeline_depth'], converter_threads=options['converter_threads'],
+            read_mode=options['read_mode'], on_batch=on_batch, batch_sizer=batch_sizer,
+            coalescer=BlockCoalescer(converter.columns, SPEC.partition_key, SPEC.sorting_key,
+                                     options['coalesce_rows']) if options['coalesce_rows'] else None,
+        )
+    finally:
+        mssql_cursor.close()
+        ch_client.disconnect()
+    seconds = time.perf_counter() - start
+    return dict(
+        batch_size=options['batch_size'],
+        final_batch_size=batch_sizer.size if batch_sizer else options['batch_size'],
+        rows=transferred,
+        errors=errors,
+        seconds=round(seconds, 3),
+        rows_per_sec=round(transferred / seconds) if seconds else 0,
+        setup_rss_mb=round(setup_rss, 1),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        **{name: round(value, 3) for name, value in stages.items() if name != 'bytes'},
+        mb=round(stages['bytes'] / 1024 / 1024, 1),
+        parts=getattr(ch_client, 'parts', None),
+    )
+
+
+def print_report(results):
+    header = (f"{'батч':>8} {'итог':>8} {'строк':>10} {'сек':>8} {'строк/с':>10} {'чтение':>8} "
+              f"{'конверт':>8} {'вставка':>8} {'МБ':>8} {'RSS МБ':>8} {'ошибок':>7} {'кусков':>7}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['batch_size']:>8} {r['final_batch_size']:>8} {r['rows']:>10} {r['seconds']:>8.2f} {r['rows_per_sec']:>10} "
+              f"{r['fetch_seconds']:>8.2f} {r['convert_seconds']:>8.2f} {r['insert_seconds']:>8.2f} "
+              f"{r['mb']:>8.1f} {r['peak_rss_mb']:>8.1f} {r['errors']:>7} {r['parts'] if r['parts'] is not None else '-':>7}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк перелива MS SQL → ClickHouse")
+    parser.add_argument('--rows', type=int, default=200000, help="строк в синтетической таблице")
+    parser.add_argument('--batch-sizes', default='10000,50000,100000',
+                        help="размеры батча через запятую, по прогону на каждый")
+    parser.add_argument('--source', choices=['memory', 'sqlite'], default='memory',
+                        help="memory - генерация строк в процессе, sqlite - чтение из файла SQLite")
+    parser.add_argument('--sqlite-path', default=os.path.join(tempfile.gettempdir(), 'bench_competitors.sqlite'),
+                        help="файл SQLite-источника (создается при первом запуске)")
+    parser.add_argument('--sink', choices=['null', 'clickhouse'], default='null',
+                        help="null - вставки отбрасываются, clickhouse - локальный ClickHouse (CH_HOST, CH_PORT)")
+    parser.add_argument('--target-table', default='bench_competitors',
+                        help="таблица ClickHouse для --sink clickhouse (пересоздается на каждый прогон)")
+    parser.add_argument('--converter', choices=['batch', 'rowwise'], default='batch',
+                        help="batch - BatchConverter, rowwise - построчный convert_value")
+    parser.add_argument('--read-mode', choices=['keyset', 'stream'], default='stream')
+    parser.add_argument('--pipeline-depth', type=int, default=0)
+    parser.add_argument('--converter-threads', type=int, default=1)
+    parser.add_argument('--adaptive', action='store_true',
+                        help="адаптивный размер батча (BatchSizer), --batch-sizes - начальные размеры")
+    parser.add_argument('--target-seconds', type=float, default=5.0,
+                        help="целевое время батча для --adaptive")
+    parser.add_argument('--coalesce-rows', type=int, default=0,
+                        help="буфер BlockCoalescer: вставка блоками по месяцам (0 - выключен)")
+    parser.add_argument('--null-rate', type=float, default=0.05, help="базовая доля пустых значений")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=1, help="прогонов на каждый размер батча")
+    parser.add_argument('--json', help="файл для результатов в JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    base = {
+        'rows': args.rows, 'source': args.source, 'sqlite_path': args.sqlite_path,
+        'sink': args.sink, 'target_table': args.target_table, 'converter': args.converter,
+        'read_mode': args.read_mode, 'pipeline_depth': args.pipeline_depth,
+        'converter_threads': args.converter_threads, 'null_rate': args.null_rate, 'seed': args.seed,
+        'adaptive': args.adaptive, 'target_seconds': args.target_seconds,
+        'coalesce_rows': args.coalesce_rows,
+    }
+    if args.source == 'sqlite':
+        logger.info(f"Готовим SQLite-источник {args.sqlite_path} на {args.rows:,} строк")
+        build_sqlite_source(SyntheticRows(args.rows, args.seed, args.null_rate), args.sqlite_path).close()
+
+    results = []
+    # Каждый прогон - в новом процессе, чтобы пиковый RSS не накапливался между прогонами
+    context = multiprocessing.get_context('spawn')
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        for attempt in range(args.repeat):
+            logger.info(f"Прогон: батч {batch_size}, попытка {attempt + 1}/{args.repeat}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_benchmark, dict(base, batch_size=batch_size)).result()
+            results.append(dict(result, attempt=attempt + 1))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': base, 'results': results}, f, ensure_ascii=False, indent=2)
+        logger.info(f"Результаты сохранены в {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,40 @@
+import argparse
+import datetime
 import pyodbc
 from clickhouse_driver import Client
 import time
 
-def transfer_data():
-    print("Starting data transfer from MS SQL to ClickHouse...")
-    
+# Типы MS SQL → ClickHouse; decimal/numeric, float, datetime2 и datetimeoffset
+# зависят от точности и разбираются в column_type
+MSSQL_TYPE_MAP = {
+    'bigint': 'Int64', 'int': 'Int32', 'smallint': 'Int16', 'tinyint': 'UInt8', 'bit': 'UInt8',
+    'money': 'Decimal(19, 4)', 'smallmoney': 'Decimal(10, 4)', 'real': 'Float32',
+    'date': 'Date32', 'smalldatetime': 'DateTime', 'datetime': 'DateTime64(3)',
+    'uniqueidentifier': 'UUID',
+}
+
+# Типы, которые pyodbc не читает: приводятся к строке на стороне MS SQL
+CLR_TYPES = ('geography', 'geometry', 'hierarchyid')
+CAST_TO_STRING_TYPES = ('time', 'sql_variant', 'xml')
+
+# rowversion не является временем и в ClickHouse не переносится
+SKIPPED_TYPES = ('timestamp', 'rowversion')
+
+# Диапазон Date32 и DateTime64 в ClickHouse; date и datetime2 в MS SQL - 0001-9999
+CH_MIN_DATE = datetime.date(1900, 1, 1)
+CH_MAX_DATE = datetime.date(2299, 12, 31)
+CH_MIN_DATETIME = datetime.datetime(1900, 1, 1)
+CH_MAX_DATETIME = datetime.datetime(2299, 12, 31, 23, 59, 59, 999999)
+
+
+def get_mssql_connection():
     # Подключение к MS SQL
-    mssql_conn = None
     max_retries = 3
     retry_delay = 5
-    
+
     for attempt in range(max_retries):
         try:
-            mssql_conn = pyodbc.connect(
+            return pyodbc.connect(
                 'DRIVER={ODBC Driver 17 for SQL Server};'
                 'SERVER=host.docker.internal,1433;'
                 'DATABASE=Stage;'
@@ -21,74 +43,229 @@ def transfer_data():
                 'Encrypt=no;'
                 'TrustServerCertificate=yes;'
             )
-            break
         except Exception as e:
             print(f"Attempt {attempt + 1} failed: {str(e)}")
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
-            else:
-                raise Exception("Failed to connect to MS SQL Server")
-    
+    raise Exception("Failed to connect to MS SQL Server")
+
+
+def get_clickhouse_client():
     # Подключение к ClickHouse
-    ch_client = Client(
+    return Client(
         host='clickhouse',
         port=9000,
         user='admin',
         password='123',
         settings={'use_numpy': False}
     )
-    
-    # Пример переноса данных для таблицы 'your_table'
-    table_name = 'your_table'
-    target_table = 'mssql_' + table_name
-    
-    print(f"Transferring data from {table_name} to {target_table}...")
-    
-    # Получаем данные из MS SQL
-    cursor = mssql_conn.cursor()
-    cursor.execute(f"SELECT * FROM {table_name}")
-    rows = cursor.fetchall()
-    
-    # Получаем описание столбцов
-    columns = [column[0] for column in cursor.description]
-    column_types = []
-    
-    for column in cursor.description:
-        sql_type = column[1]
-        if sql_type == str:
-            ch_type = 'String'
-        elif sql_type == int:
-            ch_type = 'Int32'
-        elif sql_type == float:
-            ch_type = 'Float64'
-        elif 'datetime' in str(sql_type).lower():
-            ch_type = 'DateTime'
-        else:
-            ch_type = 'String'
-        column_types.append(ch_type)
-    
-    # Создаем таблицу в ClickHouse
-    create_table_sql = f"""
-    CREATE TABLE IF NOT EXISTS {target_table} (
-        {', '.join([f'{col} {typ}' for col, typ in zip(columns, column_types)])}
-    ) ENGINE = MergeTree()
-    ORDER BY tuple()
+
+
+def split_table_name(table_name):
+    """'schema.table' → (schema, table); без схемы - dbo"""
+    return tuple(table_name.split('.', 1)) if '.' in table_name else ('dbo', table_name)
+
+
+def get_source_columns(cursor, schema, table):
+    """Колонки таблицы MS SQL: [(имя, тип, точность, масштаб, точность времени, допускает NULL)]"""
+    cursor.execute("""
+        SELECT COLUMN_NAME, DATA_TYPE, NUMERIC_PRECISION, NUMERIC_SCALE, DATETIME_PRECISION, IS_NULLABLE
+        FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+        ORDER BY ORDINAL_POSITION
+    """, schema, table)
+    columns = [(name, data_type.lower(), precision, scale, datetime_precision, nullable == 'YES')
+               for name, data_type, precision, scale, datetime_precision, nullable in cursor.fetchall()]
+    if not columns:
+        raise Exception(f"Table {schema}.{table} not found in MS SQL")
+    return columns
+
+
+def get_primary_key(cursor, schema, table):
+    """Колонки первичного ключа таблицы MS SQL в порядке ключа (пустой список, если ключа нет)"""
+    cursor.execute("""
+        SELECT kcu.COLUMN_NAME
+        FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+        JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+          ON kcu.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA AND kcu.CONSTRAINT_NAME = tc.CONSTRAINT_NAME
+        WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY' AND tc.TABLE_SCHEMA = ? AND tc.TABLE_NAME = ?
+        ORDER BY kcu.ORDINAL_POSITION
+    """, schema, table)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def column_type(data_type, precision, scale, datetime_precision, nullable, low_cardinality=False):
+    """
+    Тип ClickHouse для колонки MS SQL. decimal/numeric(p, s) → Decimal(p, s),
+    datetime2(n) → DateTime64(n), datetimeoffset(n) → DateTime64(n, 'UTC'),
+    float(n <= 24) → Float32. Колонки с NULL в источнике → Nullable(...),
+    low_cardinality - строка с небольшим числом различных значений → LowCardinality(...).
     """
-    
-    ch_client.execute(create_table_sql)
-    print(f"Table {target_table} created in ClickHouse")
-    
-    # Вставляем данные пакетами
-    batch_size = 10000
-    total_rows = len(rows)
-    print(f"Total rows to transfer: {total_rows}")
-    
-    for i in range(0, total_rows, batch_size):
-        batch = rows[i:i + batch_size]
-        ch_client.execute(f'INSERT INTO {target_table} VALUES', batch)
-        print(f"Inserted {min(i + batch_size, total_rows)}/{total_rows} rows")
-    
+    if data_type in ('decimal', 'numeric'):
+        ch_type = f'Decimal({precision}, {scale})'
+    elif data_type == 'float':
+        ch_type = 'Float32' if precision and precision <= 24 else 'Float64'
+    elif data_type == 'datetime2':
+        ch_type = f'DateTime64({datetime_precision})'
+    elif data_type == 'datetimeoffset':
+        ch_type = f"DateTime64({datetime_precision}, 'UTC')"
+    else:
+        ch_type = MSSQL_TYPE_MAP.get(data_type, 'String')
+
+    if nullable:
+        ch_type = f'Nullable({ch_type})'
+    if low_cardinality and ch_type in ('String', 'Nullable(String)'):
+        ch_type = f'LowCardinality({ch_type})'
+    return ch_type
+
+
+def select_expression(name, data_type):
+    """Выражение SELECT для колонки: типы, которые pyodbc не читает, приводятся на стороне MS SQL"""
+    if data_type == 'datetimeoffset':
+        return f"CONVERT(datetime2, SWITCHOFFSET([{name}], 0)) AS [{name}]"
+    if data_type in CLR_TYPES:
+        return f"[{name}].ToString() AS [{name}]"
+    if data_type in CAST_TO_STRING_TYPES:
+        return f"CAST([{name}] AS nvarchar(max)) AS [{name}]"
+    return f"[{name}]"
+
+
+def clamp_dates(rows, positions, clamped):
+    """
+    Строки батча кортежами; даты и время в positions вне диапазона ClickHouse (служебные
+    0001-01-01, 9999-12-31 и т.п.) заменяются ближайшей границей диапазона.
+    clamped - счетчик замен по позициям, дополняется на месте.
+    """
+    result = []
+    for row in rows:
+        row = list(row)
+        for position in positions:
+            value = row[position]
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                bounded = min(max(value, CH_MIN_DATETIME), CH_MAX_DATETIME)
+            else:
+                bounded = min(max(value, CH_MIN_DATE), CH_MAX_DATE)
+            if bounded != value:
+                row[position] = bounded
+                clamped[position] = clamped.get(position, 0) + 1
+        result.append(tuple(row))
+    return result
+
+
+def build_table_ddl(target_table, column_types, order_by, partition_by=None):
+    """DDL MergeTree-таблицы; NULL в колонках ключа сортировки требует allow_nullable_key"""
+    columns_sql = ',\n        '.join(f'`{name}` {ch_type}' for name, ch_type in column_types)
+    order_sql = f"({', '.join(f'`{name}`' for name in order_by)})" if order_by else 'tuple()'
+    partition_sql = f"\n    PARTITION BY {partition_by}" if partition_by else ''
+    types = dict(column_types)
+    nullable_key = any('Nullable' in types[name] for name in order_by)
+    settings_sql = "\n    SETTINGS allow_nullable_key = 1" if nullable_key else ''
+    return f"""
+    CREATE TABLE {target_table} (
+        {columns_sql}
+    ) ENGINE = MergeTree(){partition_sql}
+    ORDER BY {order_sql}{settings_sql}
+    """
+
+
+def mirror_table(mssql_conn, ch_client, table_name, target_table=None, order_by=None, partition_by=None,
+                 low_cardinality=(), batch_size=10000):
+    """
+    Полная копия таблицы MS SQL в ClickHouse. Строки читаются потоком (fetchmany по batch_size)
+    и сразу вставляются, поэтому память не зависит от размера таблицы.
+    order_by - колонки ключа сортировки (по умолчанию первичный ключ источника, без него - tuple()),
+    partition_by - выражение PARTITION BY, low_cardinality - строковые колонки для LowCardinality.
+    Таблица загружается во временную <target>__mirror и затем подменяет target (EXCHANGE TABLES),
+    так что читатели видят либо старую, либо полную новую копию. Date32 и DateTime64 хранят
+    только 1900-2299, поэтому значения вне диапазона заменяются его границей (clamp_dates)
+    с итоговым сообщением по колонкам. Возвращает число строк.
+    """
+    schema, table = split_table_name(table_name)
+    target_table = target_table or 'mssql_' + table
+    staging_table = f'{target_table}__mirror'
+    cursor = mssql_conn.cursor()
+
+    source_columns = [column for column in get_source_columns(cursor, schema, table)
+                      if column[1] not in SKIPPED_TYPES]
+    names = [column[0] for column in source_columns]
+    column_types = [
+        (name, column_type(data_type, precision, scale, datetime_precision, nullable,
+                           low_cardinality=name in low_cardinality))
+        for name, data_type, precision, scale, datetime_precision, nullable in source_columns
+    ]
+    if order_by is None:
+        order_by = get_primary_key(cursor, schema, table)
+    unknown = [name for name in order_by if name not in names]
+    if unknown:
+        raise ValueError(f"Sort key columns not found in {schema}.{table}: {', '.join(unknown)}")
+
+    print(f"Transferring data from {schema}.{table} to {target_table}...")
+    ch_client.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    ch_client.execute(build_table_ddl(staging_table, column_types, order_by, partition_by))
+
+    select_sql = ', '.join(select_expression(name, data_type) for name, data_type, *_ in source_columns)
+    columns_sql = ', '.join(f'`{name}`' for name in names)
+    date_positions = [position for position, (_, ch_type) in enumerate(column_types)
+                      if 'Date32' in ch_type or 'DateTime64' in ch_type]
+    cursor.execute(f"SELECT {select_sql} FROM [{schema}].[{table}]")
+
+    # Вставляем данные пакетами по мере чтения
+    total_rows = 0
+    clamped = {}
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        data = [tuple(row) for row in rows]
+        if date_positions:
+            data = clamp_dates(data, date_positions, clamped)
+        ch_client.execute(f'INSERT INTO {staging_table} ({columns_sql}) VALUES', data)
+        total_rows += len(rows)
+        print(f"Inserted {total_rows} rows")
+    cursor.close()
+    for position, count in clamped.items():
+        print(f"Column {names[position]}: {count} values outside {CH_MIN_DATE}..{CH_MAX_DATE} "
+              f"replaced with the nearest bound")
+
+    if ch_client.execute(f"EXISTS TABLE {target_table}")[0][0]:
+        ch_client.execute(f"EXCHANGE TABLES {staging_table} AND {target_table}")
+        ch_client.execute(f"DROP TABLE {staging_table}")
+    else:
+        ch_client.execute(f"RENAME TABLE {staging_table} TO {target_table}")
+    print(f"Table {target_table} mirrored: {total_rows} rows")
+    return total_rows
+
+
+def split_columns(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else []
+
+
+def transfer_data(table_name='your_table', target_table=None, order_by=None, partition_by=None,
+                  low_cardinality=(), batch_size=10000):
+    print("Starting data transfer from MS SQL to ClickHouse...")
+    mssql_conn = get_mssql_connection()
+    ch_client = get_clickhouse_client()
+    try:
+        mirror_table(mssql_conn, ch_client, table_name, target_table, order_by=order_by,
+                     partition_by=partition_by, low_cardinality=low_cardinality, batch_size=batch_size)
+    finally:
+        mssql_conn.close()
+        ch_client.disconnect()
     print("Data transfer completed successfully!")
 
+
 if __name__ == "__main__":
-    transfer_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Копия таблицы MS SQL в ClickHouse')
+    parser.add_argument('table', nargs='?', default='your_table', help='таблица MS SQL (schema.table)')
+    parser.add_argument('--target', help='таблица ClickHouse (по умолчанию mssql_<table>)')
+    parser.add_argument('--order-by', help='колонки ключа сортировки через запятую (по умолчанию первичный ключ)')
+    parser.add_argument('--partition-by', help='выражение PARTITION BY')
+    parser.add_argument('--low-cardinality', default='', help='строковые колонки LowCardinality через запятую')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+    transfer_data(args.table, args.target,
+                  order_by=split_columns(args.order_by) if args.order_by is not None else None,
+                  partition_by=args.partition_by, low_cardinality=frozenset(split_columns(args.low_cardinality)),
+                  batch_size=args.batch_size)
@@ -1,4 +1,18 @@
 import os
+import re
+import sys
+import copy
+import json
+import uuid
+import collections
+import signal
+import contextlib
+import multiprocessing
+import queue
+import random
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 import pyodbc
 from clickhouse_driver import Client
 import logging
@@ -7,6 +21,24 @@ from tqdm import tqdm
 import time
 from decimal import Decimal
 import datetime
+import resource
+import numpy as np
+import requests
+from status_server import serve_status
+
+# Arrow-движок и файловая выгрузка: опциональные зависимости
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pc = None
+    pq = None
+try:
+    from arrow_odbc import read_arrow_batches_from_odbc
+except (ImportError, OSError):
+    read_arrow_batches_from_odbc = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,17 +51,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def get_mssql_connection_string():
+    """Строка подключения ODBC к MS SQL Server"""
+    return (
+        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
+        f"SERVER={environ['MSSQL_SERVER']},{environ['MSSQL_PORT']};"
+        f"DATABASE=Stage;"
+        f"UID={environ['MSSQL_USER']};"
+        f"PWD={environ['MSSQL_PASSWORD']};"
+        "Encrypt=no;TrustServerCertificate=yes;"
+    )
+
 def get_mssql_connection():
     """Создает подключение к MS SQL Server"""
     try:
-        conn_str = (
-            f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-            f"SERVER={environ['MSSQL_SERVER']},{environ['MSSQL_PORT']};"
-            f"DATABASE=Stage;"
-            f"UID={environ['MSSQL_USER']};"
-            f"PWD={environ['MSSQL_PASSWORD']};"
-            "Encrypt=no;TrustServerCertificate=yes;"
-        )
+        conn_str = get_mssql_connection_string()
         logger.info(f"Подключаемся к MS SQL: {conn_str.replace(environ['MSSQL_PASSWORD'], '***')}")
         return pyodbc.connect(conn_str)
     except Exception as e:
@@ -61,24 +97,136 @@ def get_clickhouse_client():
         logger.error(f"Ошибка подключения к ClickHouse: {str(e)}")
         raise ConnectionError(f"Не удалось подключиться к ClickHouse: {str(e)}")
 
-def convert_value(value, column_name=None):
+@contextlib.contextmanager
+def open_connections(connections=None):
     """
-    Конвертирует значения для ClickHouse.
-    Числовые → float, даты → date, строки → string, None → '' или 0.0
-    """
-    numeric_columns = {
-        'weight', 'sales_quantity', 'sales_amount_rub',
-        'avg_cost_price', 'avg_sell_price',
-        'sales_amount_with_vat', 'promo_sales_amount_with_vat',
-        'writeoff_quantity', 'writeoff_amount_rub',
-        'margin_amount_rub', 'loss_quantity', 'loss_amount_rub',
-        'sales_tons', 'sales_weight_kg'
-    }
+    Контекст с парой (mssql_conn, ch_client).
+    Переданные подключения используются как есть и не закрываются, иначе открываются новые.
+    """
+    if connections is not None:
+        yield connections
+        return
+    with get_mssql_connection() as mssql_conn, get_clickhouse_client() as ch_client:
+        yield mssql_conn, ch_client
+
+ISOLATION_LEVELS = ('read_committed', 'snapshot')
+
+
+def snapshot_isolation_state(mssql_cursor):
+    """(разрешен ли SNAPSHOT, включен ли READ_COMMITTED_SNAPSHOT) для текущей базы MS SQL"""
+    mssql_cursor.execute(
+        "SELECT snapshot_isolation_state, is_read_committed_snapshot_on FROM sys.databases WHERE name = DB_NAME()"
+    )
+    snapshot_state, rcsi = mssql_cursor.fetchone()
+    return snapshot_state == 1, bool(rcsi)
+
+
+def set_isolation(mssql_conn, isolation='read_committed'):
+    """
+    Уровень изоляции чтения подключения MS SQL. isolation='snapshot' - все запросы до commit/rollback
+    читают один снимок базы (версии строк из tempdb) без разделяемых блокировок, поэтому
+    не мешают записи в таблицы и дают согласованный срез по всем батчам.
+    Требует ALLOW_SNAPSHOT_ISOLATION ON; если он выключен, но включен READ_COMMITTED_SNAPSHOT,
+    остается READ COMMITTED (тоже без блокировок, но срез согласован только внутри запроса).
+    Возвращает фактический уровень: snapshot, read_committed_snapshot или read_committed.
+    """
+    if isolation not in ISOLATION_LEVELS:
+        raise ValueError(f"Неизвестный уровень изоляции: {isolation}")
+    # Уровень меняется только вне транзакции: закрываем неявную транзакцию прошлых запросов
+    mssql_conn.rollback()
+    cursor = mssql_conn.cursor()
+    if isolation == 'read_committed':
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        return isolation
+    snapshot_allowed, rcsi = snapshot_isolation_state(cursor)
+    mssql_conn.rollback()
+    if snapshot_allowed:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL SNAPSHOT")
+        return 'snapshot'
+    if rcsi:
+        logger.warning("SNAPSHOT не разрешен в базе MS SQL, читаем в READ_COMMITTED_SNAPSHOT: "
+                       "без блокировок, но срез согласован только внутри запроса")
+        return 'read_committed_snapshot'
+    raise RuntimeError(
+        "SNAPSHOT не разрешен в базе MS SQL: выполните ALTER DATABASE <база> SET ALLOW_SNAPSHOT_ISOLATION ON "
+        "или запустите с TRANSFER_ISOLATION=read_committed"
+    )
+
+
+@contextlib.contextmanager
+def read_isolation(mssql_conn, isolation='read_committed'):
+    """
+    Контекст чтения с уровнем изоляции set_isolation. На выходе транзакция снимка закрывается
+    (rollback: чтение ничего не меняет, версии строк в tempdb освобождаются),
+    подключение возвращается к READ COMMITTED - оно может использоваться повторно (пул, демон).
+    """
+    if isolation == 'read_committed':
+        yield isolation
+        return
+    level = set_isolation(mssql_conn, isolation)
+    try:
+        yield level
+    finally:
+        try:
+            set_isolation(mssql_conn, 'read_committed')
+        except pyodbc.Error as e:
+            logger.warning(f"Не удалось закрыть транзакцию снимка MS SQL: {str(e)}")
+
+
+def isolated_connection_factory(isolation='read_committed'):
+    """
+    Фабрика подключений MS SQL для переподключения потокового чтения.
+    Под SNAPSHOT новое подключение открыло бы другой снимок, и батчи после обрыва
+    читались бы из другого среза, поэтому переподключение завершается ошибкой:
+    перезапуск продолжит с контрольной точки в новом снимке.
+    READ_COMMITTED_SNAPSHOT включен на уровне базы и действует для любого подключения.
+    """
+    if isolation != 'snapshot':
+        return get_mssql_connection
+
+    def connect():
+        raise RuntimeError(
+            "Обрыв чтения из MS SQL под SNAPSHOT: новое подключение читало бы другой снимок. "
+            "Перенос остановлен, повторный запуск продолжит с контрольной точки"
+        )
+    return connect
 
+
+# Колонки, которые в ClickHouse хранятся как Float64
+NUMERIC_COLUMNS = frozenset({
+    'weight', 'sales_quantity', 'sales_amount_rub',
+    'avg_cost_price', 'avg_sell_price',
+    'sales_amount_with_vat', 'promo_sales_amount_with_vat',
+    'writeoff_quantity', 'writeoff_amount_rub',
+    'margin_amount_rub', 'loss_quantity', 'loss_amount_rub',
+    'sales_tons', 'sales_weight_kg'
+})
+
+# Строковые значения, которые считаются пустыми
+NULL_STRINGS = frozenset({'', '-', 'nan', 'NaN', 'null', 'None'})
+
+# Текст, который float() разбирает как конечное число (после замены запятой на точку)
+NUMBER_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+EPOCH_DATE = datetime.date(1970, 1, 1)
+
+# Типы ClickHouse, которые clickhouse_driver умеет вставлять из NumPy-массивов
+NUMPY_DTYPES = {
+    'UInt8': np.uint8, 'UInt16': np.uint16, 'UInt32': np.uint32, 'UInt64': np.uint64,
+    'Int8': np.int8, 'Int16': np.int16, 'Int32': np.int32, 'Int64': np.int64,
+    'Float32': np.float32, 'Float64': np.float64,
+}
+
+
+def convert_value(value, column_name=None, numeric_columns=NUMERIC_COLUMNS):
+    """
+    Конвертирует значения для ClickHouse.
+    Числовые (колонки numeric_columns) → float, даты → date, строки → string, None → '' или 0.0
+    """
     # 1. None → дефолты
     if value is None:
         if column_name == 'sale_date':
-            return datetime.date(1970, 1, 1)
+            return EPOCH_DATE
         elif column_name in numeric_columns:
             return 0.0
         else:
@@ -97,13 +245,13 @@ def convert_value(value, column_name=None):
     # 4. Строки
     if isinstance(value, str):
         text = value.strip()
-        if text in ['', '-', 'nan', 'NaN', 'null', 'None']:
+        if text in NULL_STRINGS:
             return 0.0 if column_name in numeric_columns else ''
         if column_name == 'sale_date':
             try:
                 return datetime.datetime.strptime(text, '%Y-%m-%d').date()
             except Exception:
-                return datetime.date(1970, 1, 1)
+                return EPOCH_DATE
         if column_name in numeric_columns:
             try:
                 return float(text.replace(',', '.'))
@@ -126,239 +274,4111 @@ def convert_value(value, column_name=None):
         return ''
 
 
-def transfer_table(full_table_name, target_table=None, batch_size=50000):
-    """Оптимизированный перенос данных из MS SQL в ClickHouse"""
-    start_time = time.time()
-    
+def _coerce_number(value):
+    """Поэлементный запасной путь для числовых колонок (те же правила, что в convert_value)"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        if text in NULL_STRINGS:
+            return 0
+        try:
+            return float(text.replace(',', '.'))
+        except ValueError:
+            return 0
     try:
-        schema, table_name = full_table_name.split('.') if '.' in full_table_name else ('dbo', full_table_name)
-        target_table = target_table or table_name
-        
-        logger.info(f"Начало переноса из {schema}.{table_name} в {target_table}")
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
 
-        # Подключаемся к базам данных
-        with get_mssql_connection() as mssql_conn, get_clickhouse_client() as ch_client:
-            mssql_cursor = mssql_conn.cursor()
-            
-            # 1. Сначала создаем таблицу в ClickHouse (если не существует)
-            logger.info(f"Создание/проверка таблицы {target_table} в ClickHouse")
-            ch_client.execute(f"""
-                CREATE TABLE IF NOT EXISTS {target_table} (
-                    id UInt64,
-                    retail_chain String,
-                    sale_year UInt16,
-                    sale_month UInt8,
-                    sale_date Date,
-                    branch String,
-                    region String,
-                    city String,
-                    address String,
-                    store_format String,
-                    store_name String,
-                    product_name String,
-                    brand String,
-                    flavor String,
-                    weight Float64,
-                    product_type String,
-                    package_type String,
-                    product_level_1 String,
-                    product_level_2 String,
-                    product_level_3 String,
-                    product_level_4 String,
-                    product_family_code String,
-                    product_family_name String,
-                    product_article String,
-                    product_code String,
-                    barcode String,
-                    factory_code String,
-                    factory_name String,
-                    material String,
-                    vendor String,
-                    supplier String,
-                    warehouse_supplier String,
-                    sales_quantity Float64,
-                    sales_amount_rub Float64,
-                    avg_cost_price Float64,
-                    avg_sell_price Float64,
-                    sales_amount_with_vat Float64,
-                    promo_sales_amount_with_vat Float64,
-                    writeoff_quantity Float64,
-                    writeoff_amount_rub Float64,
-                    margin_amount_rub Float64,
-                    loss_quantity Float64,
-                    loss_amount_rub Float64,
-                    sales_tons Float64,
-                    sales_weight_kg Float64
-                ) ENGINE = MergeTree()
-                ORDER BY (sale_date, id)
-                SETTINGS index_granularity = 8192
-            """)
-            
-            # 2. Теперь получаем информацию о колонках для правильного преобразования типов
-            logger.info("Получение информации о колонках ClickHouse")
-            columns_info = ch_client.execute(f"DESCRIBE TABLE {target_table}")
-            columns_map = {col[0]: col[1] for col in columns_info}
-            logger.debug(f"Колонки ClickHouse: {list(columns_map.keys())}")
-            
-            # 3. Получаем максимальный ID из ClickHouse
+
+def _coerce_text(value):
+    """Строка без пробелов по краям, пустые маркеры → ''"""
+    if value is None:
+        return ''
+    if value.__class__ is not str:
+        return convert_value(value)
+    text = value.strip()
+    return '' if text in NULL_STRINGS else text
+
+
+def unwrap_low_cardinality(ch_type):
+    """LowCardinality(T) → T"""
+    if ch_type.startswith('LowCardinality(') and ch_type.endswith(')'):
+        return ch_type[len('LowCardinality('):-1]
+    return ch_type
+
+
+def code_dtype(size):
+    """Наименьший беззнаковый тип кодов для словаря из size значений"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+class DictionaryColumn:
+    """
+    Строковая колонка батча в словарном кодировании: коды строк и словарь различных значений.
+    Каждое значение хранится одним объектом, строки pyodbc освобождаются вместе с батчем.
+    Обычный массив строк собирается только на время вставки (materialize).
+    """
+
+    __slots__ = ('codes', 'dictionary')
+
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    @classmethod
+    def encode(cls, values, coerce=_coerce_text):
+        """Кодирует значения колонки; coerce применяется один раз к каждому различному значению"""
+        index = {}
+        codes = np.fromiter((index.setdefault(v, len(index)) for v in values),
+                            dtype=np.uint32, count=len(values))
+        dictionary = np.empty(len(index), dtype=object)
+        dictionary[:] = [coerce(v) for v in index]
+        return cls(codes.astype(code_dtype(len(index)), copy=False), dictionary)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.dictionary[self.codes[item]]
+        return DictionaryColumn(self.codes[item], self.dictionary)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.materialize()
+        return array if dtype is None else array.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(len(value) + 8 for value in self.dictionary)
+
+    def materialize(self):
+        """Массив строк (ссылки на значения словаря, сами строки не копируются)"""
+        return self.dictionary[self.codes]
+
+
+class BatchConverter:
+    """
+    Колоночный конвертер батча MS SQL → ClickHouse.
+    Строится один раз на таблицу по списку колонок источника и типам ClickHouse
+    и преобразует целый батч по колонкам, а не по ячейкам.
+    Колонки LowCardinality(String), а также String с повторяющимися значениями
+    (различных не больше половины строк) кодируются словарем (DictionaryColumn).
+    """
+
+    def __init__(self, source_columns, ch_types, numeric_columns=NUMERIC_COLUMNS):
+        self.source_columns = list(source_columns)
+        self.numeric_columns = numeric_columns
+        # Берем только те колонки источника, которые есть в целевой таблице
+        self.positions = [i for i, name in enumerate(self.source_columns) if name in ch_types]
+        self.columns = [self.source_columns[i] for i in self.positions]
+        self.ch_types = [ch_types[name] for name in self.columns]
+        self.converters = [
+            self._make_column_converter(name, ch_type)
+            for name, ch_type in zip(self.columns, self.ch_types)
+        ]
+        # NumPy-вставка возможна, только если все колонки поддерживаются драйвером
+        self.use_numpy = all(
+            base_type in NUMPY_DTYPES or base_type in ('String', 'Date')
+            for base_type in map(unwrap_low_cardinality, self.ch_types)
+        )
+
+    @property
+    def skipped_columns(self):
+        return [name for name in self.source_columns if name not in self.columns]
+
+    def _make_column_converter(self, name, ch_type):
+        base_type = unwrap_low_cardinality(ch_type)
+        if base_type == 'Date' or name == 'sale_date':
+            return self._convert_date_column
+        if base_type in NUMPY_DTYPES:
+            dtype = NUMPY_DTYPES[base_type]
+            return lambda values: self._convert_numeric_column(values, dtype)
+        if base_type == 'String':
+            return DictionaryColumn.encode if base_type != ch_type else self._encode_string_column
+        return lambda values: [convert_value(v, name, self.numeric_columns) for v in values]
+
+    @staticmethod
+    def _convert_numeric_column(values, dtype):
+        try:
+            array = np.array(values, dtype=np.float64 if dtype in (np.float32, np.float64) else dtype)
+        except (TypeError, ValueError):
+            array = np.array([_coerce_number(v) for v in values], dtype=np.float64)
+        if array.dtype.kind == 'f':
+            # None и 'nan' превращаются в NaN, в ClickHouse пишем 0
+            array[np.isnan(array)] = 0.0
+        return array.astype(dtype, copy=False)
+
+    @staticmethod
+    def _convert_date_column(values):
+        try:
+            array = np.array(values, dtype='datetime64[D]')
+        except (TypeError, ValueError):
+            array = np.array([convert_value(v, 'sale_date') for v in values], dtype='datetime64[D]')
+        array[np.isnat(array)] = np.datetime64(EPOCH_DATE, 'D')
+        return array
+
+    @staticmethod
+    def _encode_string_column(values):
+        column = DictionaryColumn.encode(values)
+        if len(column.dictionary) * 2 > len(column.codes):
+            # Почти уникальные значения: словарь не экономит память
+            return column.materialize()
+        return column
+
+    def convert(self, rows):
+        """Преобразует список строк pyodbc в список колонок в порядке self.columns"""
+        if not rows:
+            return [[] for _ in self.columns]
+        source = list(zip(*rows))
+        return [
+            converter(source[pos])
+            for pos, converter in zip(self.positions, self.converters)
+        ]
+
+
+def dedup_settings(token, deduplicate=True):
+    """
+    Настройки идемпотентной вставки: блок с тем же токеном ClickHouse не вставит повторно.
+    Вставка синхронная - async_insert не дедуплицирует блоки в нереплицируемых таблицах.
+    deduplicate=False выключает дедупликацию совсем: без токена ClickHouse с
+    non_replicated_deduplication_window отбрасывает блок с тем же содержимым, что уже вставлялся.
+    """
+    if not deduplicate:
+        return {'insert_deduplicate': 0}
+    if token is None:
+        return {}
+    return {'insert_deduplication_token': token, 'insert_deduplicate': 1, 'async_insert': 0}
+
+
+def dedup_token(prefix, first_id, last_id, num_rows):
+    """Детерминированный токен дедупликации блока по диапазону id"""
+    return f"{prefix}:{first_id}-{last_id}:{num_rows}"
+
+
+def insert_column_data(ch_client, target_table, columns, columns_data, use_numpy, settings=None):
+    """Колоночная вставка списка колонок в ClickHouse"""
+    column_list = ', '.join(f'`{name}`' for name in columns)
+    columns_data = [
+        col.materialize() if isinstance(col, DictionaryColumn) else col
+        for col in columns_data
+    ]
+    if not use_numpy:
+        columns_data = [
+            col.tolist() if isinstance(col, np.ndarray) else col
+            for col in columns_data
+        ]
+    query_settings = {'use_numpy': use_numpy}
+    query_settings.update(settings or {})
+    ch_client.execute(
+        f"INSERT INTO {target_table} ({column_list}) VALUES",
+        columns_data,
+        columnar=True,
+        settings=query_settings
+    )
+    return len(columns_data[0]) if columns_data else 0
+
+
+def insert_columns(ch_client, target_table, converter, columns_data, dedup_token=None, deduplicate=True):
+    """Колоночная вставка батча в ClickHouse без материализации строк"""
+    return insert_column_data(ch_client, target_table, converter.columns, columns_data,
+                              converter.use_numpy, dedup_settings(dedup_token, deduplicate))
+
+
+def slice_columns(columns_data, start, stop):
+    """Срез колоночного батча по строкам"""
+    return [col[start:stop] for col in columns_data]
+
+
+# Колонки основной таблицы продаж bi.ALL_DATA_COMPETITORS_MATERIALIZED в порядке ORDINAL_POSITION
+COMPETITOR_COLUMNS = (
+    'id', 'retail_chain', 'sale_year', 'sale_month', 'sale_date',
+    'branch', 'region', 'city', 'address', 'store_format', 'store_name',
+    'product_name', 'brand', 'flavor', 'weight', 'product_type', 'package_type',
+    'product_level_1', 'product_level_2', 'product_level_3', 'product_level_4',
+    'product_family_code', 'product_family_name', 'product_article', 'product_code', 'barcode',
+    'factory_code', 'factory_name', 'material', 'vendor', 'supplier', 'warehouse_supplier',
+    'sales_quantity', 'sales_amount_rub', 'avg_cost_price', 'avg_sell_price',
+    'sales_amount_with_vat', 'promo_sales_amount_with_vat',
+    'writeoff_quantity', 'writeoff_amount_rub', 'margin_amount_rub',
+    'loss_quantity', 'loss_amount_rub', 'sales_tons', 'sales_weight_kg',
+)
+
+# Физическая схема основной таблицы продаж в ClickHouse
+PARTITION_KEY = 'toYYYYMM(sale_date)'
+SORTING_KEY = 'sale_date, id'
+
+# Измерения с небольшим числом различных значений → LowCardinality(String)
+LOW_CARDINALITY_COLUMNS = frozenset({
+    'retail_chain', 'branch', 'region', 'city', 'store_format', 'brand',
+    'product_type', 'package_type',
+    'product_level_1', 'product_level_2', 'product_level_3', 'product_level_4'
+})
+
+# Типы, которые задаются явно, независимо от типа в MS SQL
+TYPE_OVERRIDES = {
+    'id': 'UInt64',
+    'sale_year': 'UInt16',
+    'sale_month': 'UInt8',
+    'sale_date': 'Date',
+}
+
+MSSQL_TYPE_MAP = {
+    'bigint': 'Int64', 'int': 'Int32', 'smallint': 'Int16', 'tinyint': 'UInt8', 'bit': 'UInt8',
+    'decimal': 'Float64', 'numeric': 'Float64', 'money': 'Float64', 'smallmoney': 'Float64',
+    'float': 'Float64', 'real': 'Float32',
+    'date': 'Date', 'datetime': 'DateTime', 'datetime2': 'DateTime', 'smalldatetime': 'DateTime',
+}
+
+# Типы MS SQL, которые используются как версия строки (rowversion в ClickHouse не переносится)
+ROWVERSION_TYPES = ('timestamp', 'rowversion')
+DATETIME_TYPES = ('datetime', 'datetime2', 'smalldatetime', 'datetimeoffset')
+
+# Служебные колонки версионированной (ReplacingMergeTree) целевой таблицы
+VERSION_COLUMN = '_version'
+DELETED_COLUMN = '_is_deleted'
+
+# Сколько последних вставленных блоков ClickHouse помнит для дедупликации
+DEDUP_WINDOW = 1000
+
+
+class TableSpec:
+    """
+    Описание переносимой таблицы: источник, целевая таблица, ключ, карта типов, движок
+    и размер батча.
+    key - возрастающий целочисленный ключ для keyset-чтения, контрольных точек и шардов.
+    numeric_columns хранятся как Float64, low_cardinality - как LowCardinality(String),
+    type_overrides задают тип явно. partition_key=None - таблица без партиций,
+    sorting_key по умолчанию - key (key всегда входит в ключ сортировки).
+    engine, batch_size, mode и version_column = None берутся из общих настроек запуска.
+    keyset - для таблиц без возрастающего id: уникальный ключ строки (кортеж колонок),
+    первая колонка которого - монотонно растущее время (date/datetime); по нему идет
+    keyset-пагинация и инкрементальная загрузка (transfer_keyset). key тогда не используется,
+    ключ сортировки по умолчанию - keyset; явный sorting_key должен однозначно определять строку.
+    Таблица ClickHouse - ReplacingMergeTree с версией по колонке времени: из строк с одинаковым
+    ключом сортировки остается самая поздняя. keyset_lookback (timedelta) - насколько раньше
+    последнего перенесенного времени перечитывается источник при каждом запуске.
+    """
+
+    def __init__(self, source, target=None, key='id', numeric_columns=(), low_cardinality=(),
+                 type_overrides=None, partition_key=None, sorting_key=None, engine=None,
+                 batch_size=None, mode=None, version_column=None, keyset=None,
+                 keyset_lookback=datetime.timedelta(0)):
+        self.schema, self.table_name = source.split('.') if '.' in source else ('dbo', source)
+        self.source = f"{self.schema}.{self.table_name}"
+        self.target = target or self.table_name
+        self.key = key
+        self.numeric_columns = frozenset(numeric_columns)
+        self.low_cardinality = frozenset(low_cardinality)
+        self.type_overrides = dict(type_overrides or {})
+        self.partition_key = partition_key
+        self.keyset = tuple(keyset) if keyset else None
+        default_sorting_key = ', '.join(self.keyset) if self.keyset else key
+        self.sorting_columns = [name.strip() for name in (sorting_key or default_sorting_key).split(',')]
+        if self.keyset is None and key not in self.sorting_columns:
+            self.sorting_columns.append(key)
+        self.keyset_lookback = keyset_lookback
+        self.engine = engine
+        self.batch_size = batch_size
+        self.mode = mode
+        self.version_column = version_column
+
+    @property
+    def source_table(self):
+        return f"[{self.schema}].[{self.table_name}]"
+
+    @property
+    def sorting_key(self):
+        return ', '.join(self.sorting_columns)
+
+    def column_type(self, name, mssql_type):
+        """Тип колонки ClickHouse по имени и типу MS SQL (колонки не Nullable, NULL → значение по умолчанию)"""
+        if name in self.type_overrides:
+            return self.type_overrides[name]
+        if name in self.numeric_columns:
+            return 'Float64'
+        ch_type = MSSQL_TYPE_MAP.get(mssql_type, 'String')
+        if ch_type == 'String' and name in self.low_cardinality:
+            return 'LowCardinality(String)'
+        return ch_type
+
+    def with_target(self, target_table):
+        """Копия описания с другой целевой таблицей"""
+        spec = copy.copy(self)
+        spec.target = target_table
+        return spec
+
+
+# Реестр переносимых таблиц; таблицы вне реестра переносятся с описанием по умолчанию
+TABLE_SPECS = {spec.source: spec for spec in [
+    TableSpec(
+        'bi.ALL_DATA_COMPETITORS_MATERIALIZED',
+        numeric_columns=NUMERIC_COLUMNS,
+        low_cardinality=LOW_CARDINALITY_COLUMNS,
+        type_overrides=TYPE_OVERRIDES,
+        partition_key=PARTITION_KEY,
+        sorting_key=SORTING_KEY,
+        batch_size=50000,
+    ),
+    # update_tt_info.py дописывает точки без id и обновляет продажи на месте, выставляя
+    # created_at = GETDATE(): новые и обновленные строки читаются по created_at,
+    # в ClickHouse остается последняя версия строки по естественному ключу
+    TableSpec(
+        'bi.STORE_CHARACTERISTICS',
+        numeric_columns={
+            'sales_quantity', 'sales_amount_rub', 'avg_sell_price', 'avg_cost_price',
+            'lat', 'lon', 'area_m2'
+        },
+        low_cardinality={
+            'retail_chain', 'store_format', 'store_type', 'city',
+            'federal_district', 'federal_subject'
+        },
+        sorting_key='retail_chain, address, sale_date',
+        keyset=('created_at', 'retail_chain', 'address', 'sale_date'),
+        keyset_lookback=datetime.timedelta(minutes=5),
+    ),
+]}
+
+
+def get_table_spec(full_table_name, target_table=None):
+    """Описание таблицы из реестра или описание по умолчанию (ключ id, без партиций)"""
+    spec = TableSpec(full_table_name)
+    spec = TABLE_SPECS.get(spec.source, spec)
+    return spec.with_target(target_table) if target_table else spec
+
+
+def resolve_table_specs(table_names):
+    """Описания таблиц по списку через запятую ('*' - все таблицы реестра)"""
+    names = [name.strip() for name in table_names.split(',') if name.strip()]
+    if names == ['*']:
+        return list(TABLE_SPECS.values())
+    return [get_table_spec(name) for name in names]
+
+
+def column_codec(ch_type):
+    """Кодек сжатия: Delta для целых и дат (монотонные id, отсортированные даты), ZSTD для остального"""
+    if ch_type.startswith('LowCardinality'):
+        return ''
+    if ch_type.startswith(('Int', 'UInt', 'Date')):
+        return 'CODEC(Delta, ZSTD(1))'
+    return 'CODEC(ZSTD(1))'
+
+
+def build_table_ddl(target_table, source_columns, spec, versioned=False):
+    """DDL целевой таблицы по схеме MS SQL ({колонка: DATA_TYPE}) и описанию таблицы"""
+    column_defs = []
+    for name, mssql_type in source_columns.items():
+        if mssql_type in ROWVERSION_TYPES:
+            continue
+        ch_type = spec.column_type(name, mssql_type)
+        codec = column_codec(ch_type)
+        column_defs.append(f"`{name}` {ch_type} {codec}".rstrip())
+
+    engine = 'MergeTree()'
+    if versioned:
+        column_defs += [
+            f"`{VERSION_COLUMN}` UInt64 DEFAULT 0",
+            f"`{DELETED_COLUMN}` UInt8 DEFAULT 0",
+            f"INDEX {spec.key}_bloom `{spec.key}` TYPE bloom_filter GRANULARITY 4",
+        ]
+        engine = f'ReplacingMergeTree({VERSION_COLUMN}, {DELETED_COLUMN})'
+    elif spec.keyset:
+        # Перечитанные и обновленные в источнике строки схлопываются, остается самая поздняя по времени
+        leading = spec.keyset[0]
+        version_type = spec.column_type(leading, source_columns.get(leading))
+        engine = f'ReplacingMergeTree(`{leading}`)' if version_type.startswith('Date') else 'ReplacingMergeTree()'
+
+    columns_sql = ',\n    '.join(column_defs)
+    partition_sql = f"\nPARTITION BY {spec.partition_key}" if spec.partition_key else ""
+    return f"""
+CREATE TABLE IF NOT EXISTS {target_table} (
+    {columns_sql}
+) ENGINE = {engine}{partition_sql}
+ORDER BY ({spec.sorting_key})
+SETTINGS index_granularity = 8192, non_replicated_deduplication_window = {DEDUP_WINDOW}
+"""
+
+
+def get_table_info(ch_client, table):
+    """Движок, ключ сортировки и ключ партиционирования таблицы ClickHouse или None"""
+    rows = ch_client.execute(
+        """
+        SELECT engine, sorting_key, partition_key
+        FROM system.tables
+        WHERE database = currentDatabase() AND name = %(table)s
+        """,
+        {'table': table}
+    )
+    return rows[0] if rows else None
+
+
+def layout_differences(ch_client, target_table, source_columns, spec, versioned):
+    """Отличия существующей таблицы от схемы, которую сгенерировал бы build_table_ddl"""
+    engine, _, partition_key = get_table_info(ch_client, target_table)
+    differences = []
+    if (versioned or spec.keyset) and engine != 'ReplacingMergeTree':
+        differences.append(f"движок {engine} вместо ReplacingMergeTree")
+    expected_partition = (spec.partition_key or '').replace(' ', '')
+    if partition_key.replace(' ', '') != expected_partition:
+        differences.append(f"PARTITION BY '{partition_key}' вместо '{spec.partition_key or ''}'")
+
+    current = {row[0]: (row[1], row[5]) for row in ch_client.execute(f"DESCRIBE TABLE {target_table}")}
+    for name, mssql_type in source_columns.items():
+        if name not in current:
+            continue
+        ch_type = spec.column_type(name, mssql_type)
+        current_type, current_codec = current[name]
+        if current_type != ch_type:
+            differences.append(f"{name}: {current_type} вместо {ch_type}")
+        elif bool(current_codec) != bool(column_codec(ch_type)):
+            differences.append(f"{name}: кодек '{current_codec}'")
+    return differences
+
+
+def migrate_table(ch_client, target_table, source_columns, spec, versioned=False):
+    """
+    Перестраивает существующую таблицу по сгенерированному DDL.
+    Данные копируются в новую таблицу по партициям (INSERT ... SELECT, ClickHouse сам
+    приводит типы и пересжимает колонки), затем таблицы атомарно меняются местами
+    (EXCHANGE TABLES), а прежняя остается как {target_table}__pre_migration.
+    Выполняется, пока перенос в таблицу не идет.
+    """
+    staging_table = f"{target_table}__migrating"
+    backup_table = f"{target_table}__pre_migration"
+    logger.info(f"Миграция {target_table} на новую схему хранения")
+
+    ch_client.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    ch_client.execute(build_table_ddl(staging_table, source_columns, spec, versioned))
+
+    old_columns = {row[0] for row in ch_client.execute(f"DESCRIBE TABLE {target_table}")}
+    columns = [row[0] for row in ch_client.execute(f"DESCRIBE TABLE {staging_table}") if row[0] in old_columns]
+    column_list = ', '.join(f'`{name}`' for name in columns)
+
+    copy_query = f"INSERT INTO {staging_table} ({column_list}) SELECT {column_list} FROM {target_table}"
+    if spec.partition_key:
+        partitions = [row[0] for row in ch_client.execute(
+            f"SELECT DISTINCT {spec.partition_key} AS partition FROM {target_table} ORDER BY partition"
+        )]
+        for partition in tqdm(partitions, unit='партиция', desc=f"Миграция {target_table}"):
+            ch_client.execute(
+                f"{copy_query} WHERE {spec.partition_key} = %(partition)s",
+                {'partition': partition},
+                settings={'async_insert': 0}
+            )
+    else:
+        ch_client.execute(copy_query, settings={'async_insert': 0})
+
+    ch_client.execute(f"EXCHANGE TABLES {target_table} AND {staging_table}")
+    ch_client.execute(f"DROP TABLE IF EXISTS {backup_table}")
+    ch_client.execute(f"RENAME TABLE {staging_table} TO {backup_table}")
+    logger.info(f"Миграция завершена, прежняя таблица сохранена как {backup_table}")
+
+
+def ensure_target_table(ch_client, target_table, source_columns, spec, versioned=False, migrate=False):
+    """
+    Создает таблицу в ClickHouse по схеме MS SQL (если не существует) и возвращает {колонка: тип}.
+    Для существующей таблицы сверяет физическую схему: при migrate=True перестраивает ее,
+    иначе только сообщает об отличиях. versioned=True (режим изменений) требует
+    ReplacingMergeTree и мигрирует таблицу всегда, как и таблица с keyset.
+    """
+    logger.info(f"Создание/проверка таблицы {target_table} в ClickHouse")
+    table_info = get_table_info(ch_client, target_table)
+    if table_info is None:
+        ch_client.execute(build_table_ddl(target_table, source_columns, spec, versioned))
+    else:
+        # Версионированная таблица остается версионированной и после миграции схемы
+        versioned = versioned or (table_info[0] == 'ReplacingMergeTree' and not spec.keyset)
+        differences = layout_differences(ch_client, target_table, source_columns, spec, versioned)
+        if differences:
+            force = (versioned or bool(spec.keyset)) and table_info[0] != 'ReplacingMergeTree'
+            if migrate or force:
+                migrate_table(ch_client, target_table, source_columns, spec, versioned)
+            else:
+                logger.warning(
+                    f"Схема {target_table} отличается от рекомендуемой ({'; '.join(differences)}). "
+                    f"Для миграции запустите с TRANSFER_MIGRATE_SCHEMA=1"
+                )
+        # Для таблиц, созданных до появления токенов дедупликации
+        ch_client.execute(
+            f"ALTER TABLE {target_table} MODIFY SETTING non_replicated_deduplication_window = {DEDUP_WINDOW}"
+        )
+
+    logger.info("Получение информации о колонках ClickHouse")
+    columns_info = ch_client.execute(f"DESCRIBE TABLE {target_table}")
+    columns_map = {col[0]: col[1] for col in columns_info}
+    logger.debug(f"Колонки ClickHouse: {list(columns_map.keys())}")
+    return columns_map
+
+
+def get_source_columns(mssql_cursor, schema, table_name):
+    """Возвращает {колонка: тип} таблицы MS SQL в порядке ORDINAL_POSITION"""
+    mssql_cursor.execute(f"""
+        SELECT COLUMN_NAME, DATA_TYPE 
+        FROM INFORMATION_SCHEMA.COLUMNS 
+        WHERE TABLE_SCHEMA = '{schema}' AND TABLE_NAME = '{table_name}'
+        ORDER BY ORDINAL_POSITION
+    """)
+    mssql_columns = {row[0]: row[1] for row in mssql_cursor.fetchall()}
+    logger.debug(f"Колонки MS SQL: {list(mssql_columns.keys())}")
+    return mssql_columns
+
+
+class CheckpointStore:
+    """
+    Контрольные точки переноса в ClickHouse: последний зафиксированный id по целевой
+    таблице и диапазону шарда (shard_start, shard_end]. Строка с shard_start = shard_end = 0 -
+    общая точка продолжения таблицы (водяной знак).
+    batch_size - размер следующего батча после last_id: перезапуск читает тот же блок,
+    что и прерванный запуск, и токен дедупликации совпадает (0 - не сохранен).
+    end_id - верхняя граница последовательного запуска: перезапуск доводит прерванный запуск
+    до нее, и последний неполный батч не растет за счет новых строк (0 - запуск завершен).
+    last_key - последний ключ keyset-переноса (JSON-список значений составного ключа).
+    """
+
+    def __init__(self, ch_client, table='etl_checkpoints'):
+        self.ch_client = ch_client
+        self.table = table
+
+    def ensure(self):
+        self.ch_client.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                target_table String,
+                shard_start UInt64,
+                shard_end UInt64,
+                last_id UInt64,
+                batch_no UInt64,
+                rows UInt64,
+                done UInt8,
+                updated_at DateTime64(6),
+                batch_size UInt32 DEFAULT 0,
+                last_key String DEFAULT '',
+                end_id UInt64 DEFAULT 0
+            ) ENGINE = ReplacingMergeTree(updated_at)
+            ORDER BY (target_table, shard_start, shard_end)
+        """)
+        # Таблицы, созданные до появления batch_size, last_key и end_id
+        self.ch_client.execute(
+            f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS batch_size UInt32 DEFAULT 0"
+        )
+        self.ch_client.execute(
+            f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS last_key String DEFAULT ''"
+        )
+        self.ch_client.execute(
+            f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS end_id UInt64 DEFAULT 0"
+        )
+
+    def get(self, target_table, shard_start=0, shard_end=0):
+        """Возвращает (last_id, done, batch_size, end_id) или None, если контрольной точки нет"""
+        rows = self.ch_client.execute(
+            f"""
+            SELECT argMax(last_id, updated_at), argMax(done, updated_at), argMax(batch_size, updated_at),
+                   argMax(end_id, updated_at)
+            FROM {self.table}
+            WHERE target_table = %(target_table)s
+              AND shard_start = %(shard_start)s AND shard_end = %(shard_end)s
+            GROUP BY target_table
+            """,
+            {'target_table': target_table, 'shard_start': shard_start, 'shard_end': shard_end}
+        )
+        return (rows[0][0], bool(rows[0][1]), rows[0][2], rows[0][3]) if rows else None
+
+    def get_key(self, target_table):
+        """Последний ключ keyset-переноса [значения] или None"""
+        rows = self.ch_client.execute(
+            f"""
+            SELECT argMax(last_key, updated_at)
+            FROM {self.table}
+            WHERE target_table = %(target_table)s AND shard_start = 0 AND shard_end = 0
+            GROUP BY target_table
+            """,
+            {'target_table': target_table}
+        )
+        return json.loads(rows[0][0]) if rows and rows[0][0] else None
+
+    def save(self, target_table, last_id, batch_no=0, rows=0, shard_start=0, shard_end=0, done=False,
+             batch_size=0, last_key=None, end_id=0):
+        self.ch_client.execute(
+            f"INSERT INTO {self.table} (target_table, shard_start, shard_end, last_id, batch_no, "
+            f"rows, done, updated_at, batch_size, last_key, end_id) VALUES",
+            [(target_table, shard_start, shard_end, last_id, batch_no, rows, int(done),
+              datetime.datetime.now(), batch_size,
+              json.dumps([json_value(value) for value in last_key], ensure_ascii=False) if last_key else '',
+              end_id)],
+            settings={'async_insert': 0}
+        )
+
+    def shards_above(self, target_table, watermark):
+        """Шарды прошлых запусков выше водяного знака: [(start, end, last_id, done, batch_size)]"""
+        return self.ch_client.execute(
+            f"""
+            SELECT shard_start, shard_end, argMax(last_id, updated_at), argMax(done, updated_at),
+                   argMax(batch_size, updated_at)
+            FROM {self.table}
+            WHERE target_table = %(target_table)s AND shard_end > 0 AND shard_start >= %(watermark)s
+            GROUP BY shard_start, shard_end
+            ORDER BY shard_start
+            """,
+            {'target_table': target_table, 'watermark': watermark}
+        )
+
+
+class RunRecorder:
+    """
+    История запусков переноса в ClickHouse: etl_batches - время этапов (чтение, конвертация,
+    вставка), строки, байты и ошибки каждого батча, etl_runs - итог запуска.
+    Записи батчей копятся в памяти и вставляются пачками по flush_every. Ошибки записи
+    истории только логируются и не прерывают перенос.
+    """
+
+    BATCH_FIELDS = ('batch_no', 'first_id', 'last_id', 'rows', 'bytes', 'errors',
+                    'fetch_seconds', 'convert_seconds', 'insert_seconds')
+
+    def __init__(self, ch_client, target_table, run_id=None, flush_every=20,
+                 runs_table='etl_runs', batches_table='etl_batches'):
+        self.ch_client = ch_client
+        self.target_table = target_table
+        self.run_id = run_id or uuid.uuid4()
+        self.flush_every = flush_every
+        self.runs_table = runs_table
+        self.batches_table = batches_table
+        self._pending = []
+
+    def ensure(self):
+        self.ch_client.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.runs_table} (
+                run_id UUID,
+                target_table String,
+                source_table String,
+                engine LowCardinality(String),
+                read_mode LowCardinality(String),
+                batch_size UInt32,
+                workers UInt16,
+                status LowCardinality(String),
+                started_at DateTime64(3),
+                finished_at DateTime64(3),
+                rows UInt64,
+                errors UInt64,
+                bytes UInt64,
+                batches UInt32,
+                fetch_seconds Float64,
+                convert_seconds Float64,
+                insert_seconds Float64,
+                peak_rss_mb Float64,
+                error String
+            ) ENGINE = MergeTree()
+            PARTITION BY toYYYYMM(started_at)
+            ORDER BY (target_table, started_at)
+        """)
+        self.ch_client.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.batches_table} (
+                run_id UUID,
+                target_table String,
+                batch_no UInt32,
+                first_id UInt64,
+                last_id UInt64,
+                rows UInt32,
+                bytes UInt64,
+                errors UInt32,
+                fetch_seconds Float64,
+                convert_seconds Float64,
+                insert_seconds Float64,
+                recorded_at DateTime64(3)
+            ) ENGINE = MergeTree()
+            PARTITION BY toYYYYMM(recorded_at)
+            ORDER BY (target_table, recorded_at)
+            TTL toDateTime(recorded_at) + INTERVAL 90 DAY
+        """)
+
+    def record_batch(self, record):
+        """record - словарь с полями BATCH_FIELDS"""
+        self._pending.append(
+            (self.run_id, self.target_table)
+            + tuple(record[name] for name in self.BATCH_FIELDS)
+            + (datetime.datetime.now(),)
+        )
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self.ch_client.execute(f"INSERT INTO {self.batches_table} VALUES", pending,
+                                   settings={'async_insert': 0})
+        except Exception as e:
+            logger.warning(f"Не удалось записать историю батчей ({len(pending)}): {str(e)}")
+
+    def finish(self, source_table, started_at, rows, errors, status, engine='', read_mode='',
+               batch_size=0, workers=1, error=''):
+        """Записывает итог запуска; время этапов суммируется по etl_batches (в т.ч. из процессов-шардов)"""
+        self.flush()
+        try:
+            batches, total_bytes, fetch_seconds, convert_seconds, insert_seconds = self.ch_client.execute(
+                f"""
+                SELECT count(), sum(bytes), sum(fetch_seconds), sum(convert_seconds), sum(insert_seconds)
+                FROM {self.batches_table}
+                WHERE run_id = %(run_id)s
+                """,
+                {'run_id': self.run_id}
+            )[0]
+            self.ch_client.execute(
+                f"INSERT INTO {self.runs_table} VALUES",
+                [(self.run_id, self.target_table, source_table, engine, read_mode, batch_size, workers,
+                  status, started_at, datetime.datetime.now(), rows, errors, total_bytes, batches,
+                  fetch_seconds, convert_seconds, insert_seconds, peak_rss_mb(), error)],
+                settings={'async_insert': 0}
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось записать итог запуска {self.run_id}: {str(e)}")
+            return
+        if batches:
+            logger.info(
+                f"Время этапов за запуск: чтение {fetch_seconds:.1f} сек, конвертация "
+                f"{convert_seconds:.1f} сек, вставка {insert_seconds:.1f} сек ({batches} батчей)"
+            )
+
+
+def json_value(value):
+    """Значение строки для JSON карантина: скаляры NumPy → Python, даты и Decimal → строка"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime.date, datetime.datetime, Decimal, bytes)):
+        return str(value)
+    return value
+
+
+class QuarantineStore:
+    """
+    Карантин строк, которые не удалось сконвертировать или вставить: таблица ClickHouse
+    etl_quarantine с исходными значениями строки (JSON), ошибкой, этапом и батчем.
+    Строки копятся в памяти и вставляются пачками по flush_every. Если ClickHouse не принял
+    пачку, она дописывается в quarantine_<таблица>.jsonl, чтобы строки не потерялись.
+    Статус строки (pending → redriven / missing) меняется новой версией (ReplacingMergeTree),
+    таблицу читают с FINAL.
+    """
+
+    def __init__(self, ch_client, target_table, source_table='', run_id=None, flush_every=10000,
+                 table='etl_quarantine'):
+        self.ch_client = ch_client
+        self.target_table = target_table
+        self.source_table = source_table
+        self.run_id = run_id or uuid.uuid4()
+        self.flush_every = flush_every
+        self.table = table
+        self.count = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        self.ch_client.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                target_table LowCardinality(String),
+                row_key String,
+                source_table LowCardinality(String),
+                run_id UUID,
+                batch_no UInt32,
+                batch_first_id UInt64,
+                batch_last_id UInt64,
+                stage LowCardinality(String),
+                error String CODEC(ZSTD(3)),
+                row_json String CODEC(ZSTD(3)),
+                status LowCardinality(String),
+                quarantined_at DateTime64(3),
+                updated_at DateTime64(3)
+            ) ENGINE = ReplacingMergeTree(updated_at)
+            ORDER BY (target_table, row_key)
+        """)
+
+    def add(self, stage, row_key, error, values, batch_no=0, first_id=0, last_id=0):
+        """Кладет строку в карантин. stage - 'convert' или 'insert', values - {колонка: значение}"""
+        now = datetime.datetime.now()
+        row_json = json.dumps({name: json_value(value) for name, value in values.items()},
+                              ensure_ascii=False, default=str)
+        with self._lock:
+            self._pending.append((
+                self.target_table, str(json_value(row_key)), self.source_table, self.run_id, batch_no,
+                first_id or 0, last_id or 0, stage, str(error)[:10000], row_json, 'pending', now, now
+            ))
+            self.count += 1
+            flush = len(self._pending) >= self.flush_every
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            self.ch_client.execute(f"INSERT INTO {self.table} VALUES", pending, settings={'async_insert': 0})
+        except Exception as e:
+            path = f"quarantine_{self.target_table}.jsonl"
+            logger.error(f"Не удалось записать {len(pending)} строк в {self.table} ({str(e)}), пишем в {path}")
+            with open(path, 'a', encoding='utf-8') as f:
+                for row in pending:
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+    def buffered_keys(self):
+        """Ключи строк, еще не записанных в ClickHouse"""
+        with self._lock:
+            return {row[1] for row in self._pending}
+
+    def pending_rows(self, limit=None):
+        """Строки таблицы в карантине со статусом pending: [(row_key, row_json, error, quarantined_at)]"""
+        limit_sql = f"LIMIT {int(limit)}" if limit else ""
+        return self.ch_client.execute(
+            f"""
+            SELECT row_key, row_json, error, quarantined_at
+            FROM {self.table} FINAL
+            WHERE target_table = %(target_table)s AND status = 'pending'
+            ORDER BY row_key
+            {limit_sql}
+            """,
+            {'target_table': self.target_table}
+        )
+
+    def set_status(self, rows, status):
+        """Новая версия строк карантина (как из pending_rows) со статусом status"""
+        if not rows:
+            return
+        now = datetime.datetime.now()
+        self.ch_client.execute(
+            f"INSERT INTO {self.table} (target_table, row_key, source_table, run_id, stage, error, "
+            f"row_json, status, quarantined_at, updated_at) VALUES",
+            [(self.target_table, row_key, self.source_table, self.run_id, 'redrive', error, row_json,
+              status, quarantined_at, now) for row_key, row_json, error, quarantined_at in rows],
+            settings={'async_insert': 0}
+        )
+
+
+def columns_nbytes(columns_data):
+    """Приблизительный объем колоночного батча: nbytes массивов, для строк - длина текста"""
+    total = 0
+    for col in columns_data:
+        if isinstance(col, DictionaryColumn) or isinstance(col, np.ndarray) and col.dtype != object:
+            total += col.nbytes
+        else:
+            total += sum(len(value) if isinstance(value, str) else 8 for value in col)
+    return total
+
+
+def timed_batches(batches):
+    """Итератор (батч, секунд на получение батча из источника)"""
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+        yield batch, time.perf_counter() - start
+        # Не держим прошлый батч, пока читается следующий
+        del batch
+
+
+def current_rss_mb():
+    """Текущий RSS процесса в МБ (/proc/self/statm), вне Linux - пиковый"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+class BatchSizer:
+    """
+    Размер батча и обратное давление ClickHouse при переносе одной таблицы.
+    Источник батчей берет размер следующего батча вызовом sizer(), после вставки
+    copy_id_range передает время этапов батча в observe() и ждет в backpressure().
+
+    adaptive=True подбирает размер между min_size и max_size: батч дольше
+    target_seconds уменьшается, быстрый полный батч увеличивается, при RSS процесса
+    выше memory_limit_mb размер делится пополам. Без adaptive размер постоянный.
+    backpressure() не реже раза в check_interval секунд проверяет system.parts
+    и system.merges и приостанавливает вставки (не дольше max_pause секунд), пока
+    в партиции таблицы не больше max_parts активных кусков и не больше max_merges слияний.
+    first_size - размер первого батча (из контрольной точки прерванного запуска).
+    """
+
+    def __init__(self, ch_client, target_table, batch_size, first_size=None, adaptive=False,
+                 min_size=None, max_size=None, target_seconds=5.0, memory_limit_mb=None,
+                 max_parts=100, max_merges=10, check_interval=5.0, max_pause=300):
+        self.ch_client = ch_client
+        self.database, self.table = (
+            target_table.split('.', 1) if '.' in target_table else (None, target_table)
+        )
+        self.batch_size = batch_size
+        self.size = first_size or batch_size
+        self.adaptive = adaptive
+        self.min_size = min_size or max(1000, batch_size // 10)
+        self.max_size = max_size or batch_size * 4
+        self.target_seconds = target_seconds
+        self.memory_limit_mb = memory_limit_mb
+        self.max_parts = max_parts
+        self.max_merges = max_merges
+        self.check_interval = check_interval
+        self.max_pause = max_pause
+        # Размеры уже запрошенных, но еще не вставленных батчей (конвейер читает наперед)
+        self.issued = collections.deque()
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+
+    def __call__(self):
+        with self._lock:
+            self.issued.append(self.size)
+            return self.size
+
+    @property
+    def next_size(self):
+        """Размер батча, следующего за последним вставленным (для контрольной точки)"""
+        with self._lock:
+            return self.issued[0] if self.issued else self.size
+
+    def observe(self, record):
+        """Учитывает вставленный батч (поля RunRecorder.BATCH_FIELDS) и пересчитывает размер"""
+        with self._lock:
+            batch_size = self.issued.popleft() if self.issued else self.size
+            if not self.adaptive:
+                self.size = self.batch_size
+                return
+            seconds = record['fetch_seconds'] + record['convert_seconds'] + record['insert_seconds']
+            size = self.size
+            if self.memory_limit_mb and current_rss_mb() > self.memory_limit_mb:
+                size = size // 2
+            elif seconds > self.target_seconds * 1.5:
+                size = int(size * 0.7)
+            elif seconds < self.target_seconds / 2 and record['rows'] >= batch_size:
+                # Растем только по полным батчам: последний неполный батч ничего не говорит о скорости
+                size = int(size * 1.25)
+            size = max(self.min_size, min(self.max_size, size))
+            if size != self.size:
+                logger.debug(f"Размер батча {self.table}: {self.size} → {size} "
+                             f"(батч {record['rows']} строк за {seconds:.1f} сек)")
+                self.size = size
+
+    def merge_pressure(self):
+        """(максимум активных кусков в партиции, число идущих слияний) целевой таблицы"""
+        database = '%(database)s' if self.database else 'currentDatabase()'
+        params = {'database': self.database, 'table': self.table}
+        parts = self.ch_client.execute(
+            f"""
+            SELECT max(parts) FROM (
+                SELECT count() AS parts FROM system.parts
+                WHERE active AND database = {database} AND table = %(table)s
+                GROUP BY partition_id
+            )
+            """, params
+        )[0][0] or 0
+        merges = self.ch_client.execute(
+            f"SELECT count() FROM system.merges WHERE database = {database} AND table = %(table)s",
+            params
+        )[0][0]
+        return parts, merges
+
+    def backpressure(self):
+        """Ждет, пока ClickHouse сольет куски таблицы (проверка не чаще check_interval)"""
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        waited = 0.0
+        pause = 1.0
+        while True:
+            self._checked_at = time.monotonic()
             try:
-                max_id_ch = ch_client.execute(f"SELECT max(id) FROM {target_table}")[0][0] or 0
-                logger.info(f"Текущий максимальный ID в ClickHouse: {max_id_ch}")
+                parts, merges = self.merge_pressure()
             except Exception as e:
-                logger.warning(f"Не удалось получить max ID (возможно таблица пустая): {str(e)}")
-                max_id_ch = 0
-
-            # 4. Получаем общее количество новых строк из MS SQL
-            count_query = f"SELECT COUNT(*) FROM [{schema}].[{table_name}] WHERE id > {max_id_ch}"
-            logger.debug(f"Выполняем запрос: {count_query}")
-            mssql_cursor.execute(count_query)
-            total_rows = mssql_cursor.fetchone()[0]
-            
-            if total_rows == 0:
-                logger.info("Нет новых данных для переноса")
+                logger.debug(f"Не удалось проверить куски {self.table}: {str(e)}")
                 return
-                
-            logger.info(f"Найдено {total_rows:,} новых строк для переноса")
-
-            # 5. Получаем информацию о колонках из MS SQL
-            mssql_cursor.execute(f"""
-                SELECT COLUMN_NAME, DATA_TYPE 
-                FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_SCHEMA = '{schema}' AND TABLE_NAME = '{table_name}'
-                ORDER BY ORDINAL_POSITION
-            """)
-            mssql_columns = {row[0]: row[1] for row in mssql_cursor.fetchall()}
-            logger.debug(f"Колонки MS SQL: {list(mssql_columns.keys())}")
-
-            # 6. Переносим данные пакетами
-            transferred_rows = 0
-            last_id = max_id_ch
-            error_count = 0
-            error_log_path = f'error_rows_{target_table}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-            
-            with open(error_log_path, 'w', encoding='utf-8') as error_log, \
-                 tqdm(total=total_rows, unit='rows', desc=f"Перенос {table_name}") as pbar:
-                
-                error_log.write(f"Лог ошибок переноса таблицы {target_table}\n")
-                error_log.write(f"Время начала: {datetime.datetime.now()}\n")
-                error_log.write("="*50 + "\n")
-                
-                batch_count = 0
+            if parts <= self.max_parts and merges <= self.max_merges:
+                if waited:
+                    logger.info(f"Вставка в {self.table} продолжена после паузы {waited:.0f} сек")
+                return
+            if waited >= self.max_pause:
+                logger.warning(f"Куски {self.table} не слились за {waited:.0f} сек, продолжаем вставку")
+                return
+            if not waited:
+                logger.warning(
+                    f"ClickHouse не успевает сливать куски {self.table}: {parts} активных кусков "
+                    f"в партиции, {merges} слияний. Приостанавливаем вставку"
+                )
+            time.sleep(pause)
+            waited += pause
+            pause = min(pause * 2, 30.0)
+
+
+class StackSampler:
+    """
+    Сэмплирующий профилировщик потоков текущего процесса: каждые interval секунд снимает
+    стеки всех потоков (sys._current_frames) и пишет накопленные стеки в формате
+    collapsed stacks (flamegraph.pl, speedscope). Процессы-шарды не профилируются.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        with open(path, 'w', encoding='utf-8') as output:
+            for stack, count in self.samples.most_common():
+                output.write(f"{stack} {count}\n")
+        logger.info(f"Профиль ({sum(self.samples.values())} сэмплов) записан в {path}")
+
+
+def table_row_count(mssql_cursor, source_table):
+    """
+    Число строк таблицы MS SQL из метаданных, без чтения данных.
+    sys.dm_db_partition_stats требует VIEW DATABASE STATE, иначе используется sys.partitions.
+    Возвращает None, если метаданные недоступны.
+    """
+    queries = (
+        f"""
+        SELECT SUM(row_count) FROM sys.dm_db_partition_stats
+        WHERE object_id = OBJECT_ID('{source_table}') AND index_id IN (0, 1)
+        """,
+        f"""
+        SELECT SUM(rows) FROM sys.partitions
+        WHERE object_id = OBJECT_ID('{source_table}') AND index_id IN (0, 1)
+        """,
+    )
+    for query in queries:
+        try:
+            mssql_cursor.execute(query)
+            return mssql_cursor.fetchone()[0]
+        except pyodbc.Error as e:
+            logger.debug(f"Метаданные числа строк недоступны: {str(e)}")
+    return None
+
+
+def estimate_new_rows(mssql_cursor, source_table, key, last_id):
+    """
+    Оценка числа строк с ключом > last_id: число строк из метаданных, умноженное на долю
+    диапазона ключа выше last_id (MIN/MAX ключа - поиск по индексу, таблица не сканируется).
+    Возвращает (оценка или None, максимальный ключ или None, если новых строк нет).
+    """
+    mssql_cursor.execute(f"SELECT MIN([{key}]), MAX([{key}]) FROM {source_table}")
+    min_id, max_id = mssql_cursor.fetchone()
+    if max_id is None or max_id <= last_id:
+        return 0, None
+    total_rows = table_row_count(mssql_cursor, source_table)
+    if total_rows is None:
+        return None, max_id
+    key_span = max_id - min_id + 1
+    new_span = max_id - max(last_id, min_id - 1)
+    return max(1, round(total_rows * new_span / key_span)), max_id
+
+
+def fetch_id_batches(mssql_cursor, source_table, last_id, batch_size, end_id=None,
+                     key='id', key_position=0):
+    """
+    Генератор батчей строк MS SQL с ключом в (last_id, end_id] (keyset-пагинация по ключу).
+    key_position - позиция ключа в строке SELECT *.
+    batch_size - число или функция без аргументов (BatchSizer), вызывается на каждый батч.
+    """
+    range_filter = f" AND [{key}] <= {end_id}" if end_id is not None else ""
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    while True:
+        # Эффективный запрос с использованием ключа
+        query = f"""
+        SELECT TOP {next_size()} *
+        FROM {source_table}
+        WHERE [{key}] > {last_id}{range_filter}
+        ORDER BY [{key}]
+        """
+        
+        mssql_cursor.execute(query)
+        rows = mssql_cursor.fetchall()
+        
+        if not rows:
+            logger.debug("Больше данных нет для переноса")
+            return
+        
+        last_id = rows[-1][key_position]
+        yield rows
+        del rows
+
+
+def stream_id_batches(mssql_cursor, source_table, last_id, batch_size, end_id=None,
+                      reconnect=None, max_reconnects=3, key='id', key_position=0):
+    """
+    Генератор батчей строк MS SQL с ключом в (last_id, end_id] из одного упорядоченного запроса.
+    Строки читаются потоково через fetchmany, план запроса строится один раз.
+    При обрыве соединения запрос переоткрывается через reconnect() с последнего прочитанного ключа.
+    batch_size - число или функция без аргументов (BatchSizer), вызывается на каждый батч.
+    """
+    range_filter = f" AND [{key}] <= {end_id}" if end_id is not None else ""
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    reconnects = 0
+    owned_conn = None
+    try:
+        while True:
+            try:
+                mssql_cursor.execute(f"""
+                SELECT *
+                FROM {source_table}
+                WHERE [{key}] > {last_id}{range_filter}
+                ORDER BY [{key}]
+                """)
                 while True:
-                    batch_count += 1
-                    logger.debug(f"Обработка батча #{batch_count}, last_id={last_id}")
-                    
-                    # Эффективный запрос с использованием ключа (id)
-                    query = f"""
-                    SELECT TOP {batch_size} *
-                    FROM [{schema}].[{table_name}]
-                    WHERE id > {last_id}
-                    ORDER BY id
-                    """
-                    
-                    mssql_cursor.execute(query)
-                    rows = mssql_cursor.fetchall()
-                    
+                    rows = mssql_cursor.fetchmany(next_size())
                     if not rows:
                         logger.debug("Больше данных нет для переноса")
-                        break
-                    
-                    # Получаем имена колонок из MS SQL
-                    columns = [column[0] for column in mssql_cursor.description]
-                    logger.debug(f"Колонки в результате: {columns}")
-                    
-                    # Преобразуем данные для ClickHouse
-                    data = []
-                    batch_errors = 0
-                    
-                    for row_idx, row in enumerate(rows):
-                        try:
-                            processed_row = []
-                            for i, value in enumerate(row):
-                                column_name = columns[i] if i < len(columns) else f'column_{i}'
-                                processed_value = convert_value(value, column_name)
-                                processed_row.append(processed_value)
-                            
-                            data.append(processed_row)
-                            last_id = row[0]  # предполагаем, что id - первый столбец
-                            
-                        except Exception as e:
-                            error_count += 1
-                            batch_errors += 1
-                            error_msg = f"Ошибка обработки строки {row[0] if row else 'unknown'}: {str(e)}"
-                            error_log.write(error_msg + "\n")
-                            logger.debug(error_msg)
-                            continue
-                    
-                    if batch_errors > 0:
-                        logger.warning(f"В батче #{batch_count} обнаружено {batch_errors} ошибок обработки")
-                    
-                    # Вставка данных в ClickHouse
-                    if data:
-                        try:
-                            ch_client.execute(
-                                f"INSERT INTO {target_table} VALUES",
-                                data,
-                                types_check=True
-                            )
-                            transferred_rows += len(data)
-                            pbar.update(len(data))
-                            logger.debug(f"Успешно вставлен батч #{batch_count} из {len(data)} строк")
-                            
-                        except Exception as e:
-                            logger.error(f"Ошибка вставки батча #{batch_count}: {str(e)}")
-                            
-                            # Пробуем вставить по одной строке
-                            single_success = 0
-                            for single_row in data:
-                                try:
-                                    ch_client.execute(
-                                        f"INSERT INTO {target_table} VALUES",
-                                        [single_row],
-                                        types_check=True
-                                    )
-                                    transferred_rows += 1
-                                    single_success += 1
-                                    pbar.update(1)
-                                except Exception as single_e:
-                                    error_count += 1
-                                    error_msg = f"Ошибка вставки строки {single_row[0]}: {str(single_e)}"
-                                    error_log.write(error_msg + "\n")
-                                    logger.debug(error_msg)
-                                    continue
-                            
-                            if single_success > 0:
-                                logger.info(f"Удалось вставить {single_success} строк по одной из проблемного батча")
-                    
-                    # Небольшая пауза между батчами чтобы не перегружать системы
-                    if batch_count % 10 == 0:
-                        time.sleep(0.1)
-            
-            # 7. Финализация
+                        return
+                    last_id = rows[-1][key_position]
+                    yield rows
+                    del rows
+            except pyodbc.Error as e:
+                if reconnect is None or reconnects >= max_reconnects:
+                    raise
+                reconnects += 1
+                logger.warning(
+                    f"Обрыв чтения из MS SQL ({str(e)}), переподключение "
+                    f"{reconnects}/{max_reconnects} с {key} > {last_id}"
+                )
+                if owned_conn is not None:
+                    try:
+                        owned_conn.close()
+                    except pyodbc.Error:
+                        pass
+                owned_conn = reconnect()
+                mssql_cursor = owned_conn.cursor()
+    finally:
+        if owned_conn is not None:
+            owned_conn.close()
+
+
+def fetch_batches(read_mode, mssql_cursor, source_table, last_id, batch_size, end_id=None,
+                  reconnect=None, key='id', key_position=0):
+    """Источник батчей по ключу: 'stream' - один потоковый запрос, 'keyset' - TOP N на каждый батч"""
+    if read_mode == 'stream':
+        return stream_id_batches(mssql_cursor, source_table, last_id, batch_size, end_id, reconnect,
+                                 key=key, key_position=key_position)
+    if read_mode == 'keyset':
+        return fetch_id_batches(mssql_cursor, source_table, last_id, batch_size, end_id,
+                                key=key, key_position=key_position)
+    raise ValueError(f"Неизвестный режим чтения: {read_mode}")
+
+
+def keyset_filter(key_columns, last_key):
+    """
+    Условие T-SQL «ключ > last_key» для составного ключа с параметрами pyodbc:
+    (a, b) > (x, y) ⇔ a > x OR (a = x AND b > y)
+    """
+    clauses = []
+    params = []
+    for i, name in enumerate(key_columns):
+        clauses.append(' AND '.join([f"[{prev}] = ?" for prev in key_columns[:i]] + [f"[{name}] > ?"]))
+        params.extend(last_key[:i + 1])
+    return ' OR '.join(f"({clause})" for clause in clauses), params
+
+
+def fetch_keyset_batches(mssql_cursor, source_table, key_columns, key_positions, since, batch_size):
+    """
+    Генератор батчей строк MS SQL по уникальному составному ключу key_columns (keyset-пагинация).
+    Первый батч - строки с первой колонкой ключа (временем) не меньше since (None - с начала
+    таблицы), следующие - с ключом больше последнего прочитанного.
+    key_positions - позиции ключа в строке SELECT *.
+    batch_size - число или функция без аргументов (BatchSizer).
+    """
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    order = ', '.join(f"[{name}]" for name in key_columns)
+    where, params = '', []
+    if since is not None:
+        where, params = f" WHERE [{key_columns[0]}] >= ?", [since]
+    while True:
+        mssql_cursor.execute(f"SELECT TOP {next_size()} * FROM {source_table}{where} ORDER BY {order}", *params)
+        rows = mssql_cursor.fetchall()
+        if not rows:
+            logger.debug("Больше данных нет для переноса")
+            return
+        condition, params = keyset_filter(key_columns, tuple(rows[-1][pos] for pos in key_positions))
+        where = f" WHERE {condition}"
+        yield rows
+        del rows
+
+
+def bisect_insert(insert, data, num_rows, take, on_failed_row, on_progress=None, first_error=None):
+    """
+    Вставляет блок через insert(data), при ошибке делит его пополам и повторяет
+    для каждой половины. Исправные части уходят в ClickHouse крупными блоками,
+    а k плохих строк изолируются за O(k·log n) вставок.
+    take(data, start, stop) - срез блока, on_failed_row(row, error) - обработка плохой строки.
+    first_error - ошибка уже выполненной вставки всего блока (повторно не вставляется).
+    Возвращает (вставлено строк, ошибок).
+    """
+    if first_error is None:
+        try:
+            insert(data)
+            if on_progress:
+                on_progress(num_rows)
+            return num_rows, 0
+        except Exception as e:
+            first_error = e
+
+    if num_rows == 1:
+        on_failed_row(data, first_error)
+        return 0, 1
+    logger.debug(f"Ошибка вставки блока из {num_rows} строк, делим пополам: {str(first_error)}")
+
+    mid = num_rows // 2
+    left_inserted, left_errors = bisect_insert(
+        insert, take(data, 0, mid), mid, take, on_failed_row, on_progress
+    )
+    right_inserted, right_errors = bisect_insert(
+        insert, take(data, mid, num_rows), num_rows - mid, take, on_failed_row, on_progress
+    )
+    return left_inserted + right_inserted, left_errors + right_errors
+
+
+def load_batch(ch_client, target_table, converter, data, quarantine, on_progress=None, batch_label='',
+               dedup_prefix=None, key='id', batch_no=0, deduplicate=True):
+    """
+    Вставляет сконвертированный батч в ClickHouse.
+    При ошибке вставки батч делится пополам, пока не будут найдены плохие строки,
+    плохие строки уходят в карантин (QuarantineStore) с ошибкой и номером батча.
+    dedup_prefix включает токены дедупликации для каждого вставляемого блока (по ключу key),
+    deduplicate=False - повторная вставка уже вставлявшихся строк (insert_deduplicate=0).
+    key - колонка или кортеж колонок составного ключа (keyset-перенос), значение составного
+    ключа в токенах и карантине - JSON-список.
+    Возвращает (вставлено строк, ошибок).
+    """
+    batch_rows = len(data[0]) if data else 0
+    if not batch_rows:
+        return 0, 0
+    key_positions = [converter.columns.index(name) for name in (key if isinstance(key, tuple) else (key,))]
+
+    def row_key(part, i):
+        values = [json_value(part[pos][i]) for pos in key_positions]
+        return values[0] if len(values) == 1 else json.dumps(values, ensure_ascii=False)
+
+    # Диапазон батча в карантине - только для целочисленного ключа
+    first_id, last_id = row_key(data, 0), row_key(data, -1)
+    if not isinstance(first_id, int) or not isinstance(last_id, int):
+        first_id = last_id = 0
+
+    def insert(part):
+        token = None
+        if dedup_prefix:
+            token = dedup_token(dedup_prefix, row_key(part, 0), row_key(part, -1), len(part[0]))
+        insert_columns(ch_client, target_table, converter, part, token, deduplicate)
+
+    def on_failed_row(row, error):
+        logger.debug(f"Ошибка вставки строки {row_key(row, 0)}: {str(error)}")
+        quarantine.add('insert', row_key(row, 0), error,
+                       {name: col[0] for name, col in zip(converter.columns, row)},
+                       batch_no, first_id, last_id)
+
+    try:
+        insert(data)
+        if on_progress:
+            on_progress(batch_rows)
+        logger.debug(f"Успешно вставлен батч {batch_label} из {batch_rows} строк")
+        return batch_rows, 0
+    except Exception as e:
+        logger.error(f"Ошибка вставки батча {batch_label}: {str(e)}")
+        first_error = e
+
+    # Ищем плохие строки делением батча пополам
+    inserted, error_count = bisect_insert(
+        insert, data, batch_rows, slice_columns, on_failed_row, on_progress, first_error
+    )
+    if inserted > 0:
+        logger.info(f"Удалось вставить {inserted} строк из проблемного батча, плохих строк: {error_count}")
+    return inserted, error_count
+
+
+def concat_columns(parts):
+    """Склеивает части колонки из нескольких батчей; словари DictionaryColumn объединяются"""
+    if all(isinstance(part, DictionaryColumn) for part in parts):
+        index = {}
+        codes = []
+        for part in parts:
+            mapping = np.array([index.setdefault(value, len(index)) for value in part.dictionary],
+                               dtype=np.uint32)
+            codes.append(mapping[part.codes] if len(mapping) else part.codes.astype(np.uint32))
+        dictionary = np.empty(len(index), dtype=object)
+        dictionary[:] = list(index)
+        return DictionaryColumn(np.concatenate(codes).astype(code_dtype(len(index))), dictionary)
+    return np.concatenate([
+        part.materialize() if isinstance(part, DictionaryColumn) else np.asarray(part, dtype=object)
+        if isinstance(part, list) else part
+        for part in parts
+    ])
+
+
+def sort_key_array(col):
+    """Массив для сортировки колонки: для DictionaryColumn - ранги значений словаря"""
+    if isinstance(col, DictionaryColumn):
+        ranks = np.empty(len(col.dictionary), dtype=np.int64)
+        ranks[np.argsort(col.dictionary, kind='stable')] = np.arange(len(col.dictionary))
+        return ranks[col.codes]
+    return np.asarray(col)
+
+
+class BlockCoalescer:
+    """
+    Буфер вставки: копит сконвертированные батчи и отдает их блоками по партициям
+    целевой таблицы, строки блока отсортированы по ключу сортировки (ORDER BY).
+    Каждая вставка создает по куску на каждую затронутую партицию, а батчи по id
+    разбросаны по месяцам, поэтому крупные блоки одной партиции дают меньше мелких
+    кусков и слияний. Партиции вычисляются для PARTITION BY toYYYYMM(<дата>),
+    при другом ключе партиционирования строки только сортируются.
+    """
+
+    def __init__(self, columns, partition_key=None, sorting_key=None, max_rows=500000):
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        match = re.fullmatch(r"toYYYYMM\((\w+)\)", partition_key or '')
+        self.partition_position = (
+            self.columns.index(match.group(1)) if match and match.group(1) in self.columns else None
+        )
+        # Ключ сортировки используется до первого выражения, которого нет среди колонок
+        self.sort_positions = []
+        for name in (sorting_key or '').split(','):
+            name = name.strip().strip('`')
+            if name not in self.columns:
+                break
+            self.sort_positions.append(self.columns.index(name))
+        self.batches = []
+        self.rows = 0
+
+    @property
+    def full(self):
+        return self.rows >= self.max_rows
+
+    def add(self, data):
+        if data and len(data[0]):
+            self.batches.append(data)
+            self.rows += len(data[0])
+
+    def drain(self):
+        """Блоки буфера [(партиция YYYYMM или None, колонки)], буфер очищается"""
+        if not self.batches:
+            return []
+        batches, self.batches, self.rows = self.batches, [], 0
+        data = [concat_columns(parts) for parts in zip(*batches)]
+        del batches
+        # np.lexsort сортирует по последнему ключу в первую очередь
+        keys = [sort_key_array(data[pos]) for pos in reversed(self.sort_positions)]
+        partitions = None
+        if self.partition_position is not None:
+            partitions = np.asarray(data[self.partition_position]).astype('datetime64[M]').astype(np.int64)
+            keys.append(partitions)
+        if not keys:
+            return [(None, data)]
+        order = np.lexsort(keys)
+        if partitions is None:
+            return [(None, [col[order] for col in data])]
+        sorted_partitions = partitions[order]
+        bounds = np.flatnonzero(np.diff(sorted_partitions)) + 1
+        blocks = []
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(order)]):
+            month = int(sorted_partitions[start])
+            rows = order[start:stop]
+            blocks.append(((month // 12 + 1970) * 100 + month % 12 + 1, [col[rows] for col in data]))
+        return blocks
+
+
+_PIPELINE_END = object()
+
+
+def run_pipeline(source, transform, sink, depth=2, workers=1):
+    """
+    Конвейер чтение → преобразование → запись на потоках с ограниченными очередями.
+
+    source - итератор батчей, читается в отдельном потоке;
+    transform - функция батча, выполняется в workers потоках;
+    sink - функция результата, вызывается в текущем потоке строго в порядке source.
+    Одновременно в работе не более depth * 2 + workers батчей, поэтому память
+    ограничена глубиной очередей.
+    """
+    raw_queue = queue.Queue(maxsize=depth)
+    done_queue = queue.Queue(maxsize=depth)
+    in_flight = threading.BoundedSemaphore(depth * 2 + workers)
+    stop = threading.Event()
+    failures = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for seq, batch in enumerate(source):
+                while not in_flight.acquire(timeout=0.5):
+                    if stop.is_set():
+                        return
+                if not put(raw_queue, (seq, batch)):
+                    return
+                del batch
+        except Exception as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            for _ in range(workers):
+                put(raw_queue, _PIPELINE_END)
+
+    def convert():
+        try:
+            while not stop.is_set():
+                try:
+                    item = raw_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is _PIPELINE_END:
+                    break
+                seq, batch = item
+                result = transform(batch)
+                # Исходный батч освобождается сразу после преобразования
+                del item, batch
+                if not put(done_queue, (seq, result)):
+                    return
+                del result
+        except Exception as e:
+            failures.append(e)
+            stop.set()
+        finally:
+            put(done_queue, _PIPELINE_END)
+
+    threads = [threading.Thread(target=read, name='pipeline-reader', daemon=True)]
+    threads += [
+        threading.Thread(target=convert, name=f'pipeline-converter-{i}', daemon=True)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    finished_workers = 0
+    ready = {}
+    next_seq = 0
+    try:
+        while finished_workers < workers and not failures:
+            try:
+                item = done_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _PIPELINE_END:
+                finished_workers += 1
+                continue
+            seq, result = item
+            ready[seq] = result
+            # Пишем строго по порядку, чтобы max(id) в ClickHouse оставался точкой продолжения
+            del item, result
+            while next_seq in ready:
+                sink(ready.pop(next_seq))
+                next_seq += 1
+                in_flight.release()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if failures:
+        raise failures[0]
+
+
+def convert_rows(converter, rows, batch_label=''):
+    """
+    Конвертирует батч; при ошибке каждая строка конвертируется отдельно, исправные - одним батчем.
+    Возвращает (колонки или None, [(строка, ошибка)]).
+    """
+    try:
+        return converter.convert(rows), []
+    except Exception as e:
+        logger.warning(f"Ошибка конвертации батча ({batch_label}): {str(e)}")
+    good_rows = []
+    failed = []
+    for row in rows:
+        try:
+            converter.convert([row])
+            good_rows.append(row)
+        except Exception as row_error:
+            failed.append((row, row_error))
+    return (converter.convert(good_rows) if good_rows else None), failed
+
+
+def copy_id_range(mssql_cursor, ch_client, converter, source_table, target_table,
+                  last_id, batch_size, quarantine, end_id=None, on_progress=None,
+                  pipeline_depth=0, converter_threads=1, read_mode='keyset', reconnect=None,
+                  on_checkpoint=None, dedup_prefix=None, key='id', on_batch=None, batch_sizer=None,
+                  coalescer=None, deduplicate=True):
+    """
+    Переносит строки с ключом key в диапазоне (last_id, end_id] пакетами.
+    Если end_id не задан - до конца таблицы.
+    Строки, которые не удалось сконвертировать или вставить, уходят в quarantine (QuarantineStore),
+    остальные строки батча вставляются.
+    read_mode: 'keyset' - запрос TOP N на каждый батч, 'stream' - один запрос и fetchmany
+    (reconnect - фабрика подключений для продолжения чтения после обрыва).
+    pipeline_depth > 0 включает конвейер: следующий батч читается из MS SQL,
+    пока предыдущий вставляется в ClickHouse.
+    on_checkpoint(last_id, batch_no, rows) вызывается после каждого обработанного батча,
+    dedup_prefix включает токены дедупликации вставок, deduplicate=False выключает
+    дедупликацию (повторная заливка удаленного диапазона).
+    on_batch(record) получает по каждому батчу время чтения, конвертации и вставки,
+    строки, байты и ошибки (поля RunRecorder.BATCH_FIELDS).
+    batch_sizer (BatchSizer) задает размер батчей вместо batch_size и приостанавливает
+    вставку, пока ClickHouse не сольет куски таблицы.
+    coalescer (BlockCoalescer) копит батчи и вставляет их блоками по партициям,
+    контрольная точка сдвигается только после сброса буфера.
+    Возвращает (перенесено строк, ошибок, последний id).
+    """
+    stats = {'transferred': 0, 'errors': 0, 'last_id': last_id, 'batches': 0}
+    key_position = converter.source_columns.index(key)
+
+    def convert(item):
+        rows, fetch_seconds = item
+        first_id, batch_last_id = rows[0][key_position], rows[-1][key_position]
+        record = {'first_id': first_id, 'last_id': batch_last_id, 'rows': len(rows),
+                  'fetch_seconds': fetch_seconds, 'bytes': 0}
+        start = time.perf_counter()
+        data, failed = convert_rows(converter, rows, f"{key} {first_id}..{batch_last_id}")
+        if on_batch and data is not None:
+            record['bytes'] = columns_nbytes(data)
+        record['convert_seconds'] = time.perf_counter() - start
+        return data, first_id, batch_last_id, failed, record
+
+    def flush_blocks():
+        inserted = errors = 0
+        for partition, block in coalescer.drain():
+            block_prefix = f"{dedup_prefix}@{partition}" if dedup_prefix else None
+            block_rows, block_errors = load_batch(ch_client, target_table, converter, block, quarantine,
+                                                  on_progress, f"{partition} ({len(block[0])} строк)",
+                                                  block_prefix, key, stats['batches'], deduplicate)
+            inserted += block_rows
+            errors += block_errors
+        return inserted, errors
+
+    def checkpoint(batch_last_id, inserted):
+        # Контрольная точка сдвигается только после записи плохих строк в карантин
+        quarantine.flush()
+        if on_checkpoint:
+            on_checkpoint(batch_last_id, stats['batches'], inserted)
+
+    def load(converted):
+        data, first_id, batch_last_id, failed, record = converted
+        stats['batches'] += 1
+        start = time.perf_counter()
+        batch_label = f"#{stats['batches']}"
+        logger.debug(f"Обработка батча {batch_label}, id {first_id}..{batch_last_id}")
+
+        # Несконвертированные строки - в карантин с исходными значениями
+        for row, error in failed:
+            quarantine.add('convert', row[key_position], error,
+                           dict(zip(converter.source_columns, row)),
+                           stats['batches'], first_id, batch_last_id)
+        errors = len(failed)
+        inserted = 0
+        if data is not None:
+            if coalescer is None:
+                inserted, insert_errors = load_batch(ch_client, target_table, converter, data, quarantine,
+                                                     on_progress, batch_label, dedup_prefix, key,
+                                                     stats['batches'], deduplicate)
+            else:
+                coalescer.add(data)
+                del data, converted
+                inserted, insert_errors = flush_blocks() if coalescer.full else (0, 0)
+            errors += insert_errors
+            stats['transferred'] += inserted
+        stats['errors'] += errors
+        stats['last_id'] = batch_last_id
+        record = dict(record, batch_no=stats['batches'], errors=errors,
+                      insert_seconds=time.perf_counter() - start)
+        if on_batch:
+            on_batch(record)
+        if batch_sizer:
+            batch_sizer.observe(record)
+        if coalescer is None or not coalescer.rows:
+            checkpoint(batch_last_id, inserted)
+        if batch_sizer:
+            batch_sizer.backpressure()
+
+    batches = timed_batches(fetch_batches(read_mode, mssql_cursor, source_table, last_id,
+                                          batch_sizer or batch_size, end_id, reconnect,
+                                          key=key, key_position=key_position))
+    if pipeline_depth > 0:
+        run_pipeline(batches, convert, load, depth=pipeline_depth, workers=converter_threads)
+    else:
+        for item in batches:
+            converted = convert(item)
+            # Строки pyodbc не нужны после конвертации, батч - после вставки
+            del item
+            load(converted)
+            del converted
+    if coalescer is not None and coalescer.rows:
+        inserted, errors = flush_blocks()
+        stats['transferred'] += inserted
+        stats['errors'] += errors
+        checkpoint(stats['last_id'], inserted)
+
+    return stats['transferred'], stats['errors'], stats['last_id']
+
+
+def get_clickhouse_http_session():
+    """HTTP-сессия ClickHouse для вставок в форматах Arrow/Native. Возвращает (сессия, url)"""
+    session = requests.Session()
+    session.auth = (environ.get('CH_USER', 'admin'), environ.get('CH_PASSWORD', 'admin123'))
+    url = f"http://{environ.get('CH_HOST', 'clickhouse')}:{environ.get('CH_HTTP_PORT', '8123')}/"
+    return session, url
+
+
+def insert_formatted(session, url, target_table, columns, payload, data_format, settings=None):
+    """Вставка готового блока данных (ArrowStream/Native/...) через HTTP-интерфейс ClickHouse"""
+    column_list = ', '.join(f'`{name}`' for name in columns)
+    params = {'query': f"INSERT INTO {target_table} ({column_list}) FORMAT {data_format}"}
+    params.update(settings or {})
+    response = session.post(url, params=params, data=payload, timeout=600)
+    if response.status_code != 200:
+        raise RuntimeError(f"ClickHouse HTTP {response.status_code}: {response.text[:500]}")
+
+
+def arrow_batch_to_ipc(batch):
+    """Сериализует RecordBatch в Arrow IPC stream без построчных Python-объектов"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def normalize_arrow_numbers(batch, numeric_columns):
+    """
+    Текстовые числа numeric_columns в RecordBatch → float64 по правилам _coerce_number:
+    пробелы по краям отбрасываются, запятая - десятичный разделитель, NULL, пустые маркеры
+    и нечисловой текст → 0. Остальные колонки не меняются.
+    """
+    arrays = list(batch.columns)
+    for i, field in enumerate(batch.schema):
+        if field.name not in numeric_columns or not (pa.types.is_string(field.type)
+                                                     or pa.types.is_large_string(field.type)):
+            continue
+        text = pc.replace_substring(pc.utf8_trim_whitespace(arrays[i]), ',', '.')
+        numbers = pc.if_else(pc.match_substring_regex(text, NUMBER_PATTERN), text, pa.scalar(None, text.type))
+        arrays[i] = pc.fill_null(pc.cast(numbers, pa.float64()), 0.0)
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def copy_id_range_arrow(source_table, target_table, columns, last_id, batch_size, quarantine,
+                        end_id=None, on_progress=None, pipeline_depth=0,
+                        on_checkpoint=None, dedup_prefix=None, key='id', on_batch=None,
+                        batch_sizer=None, numeric_columns=()):
+    """
+    Arrow-движок: строки с ключом key в (last_id, end_id] читаются из MS SQL сразу в Arrow
+    RecordBatch (arrow-odbc) и вставляются в ClickHouse как ArrowStream по HTTP.
+    NULL заменяются значениями по умолчанию колонок (input_format_null_as_default),
+    приведение типов выполняет ClickHouse. Текстовые числа numeric_columns приводятся
+    к float64 заранее (normalize_arrow_numbers), как в BatchConverter.
+    on_checkpoint, dedup_prefix, on_batch и quarantine - как в copy_id_range
+    (конвертация - сериализация в IPC).
+    Размер батча arrow-odbc задается один раз при открытии запроса, поэтому batch_sizer
+    здесь дает только обратное давление ClickHouse (backpressure), размер не подбирается.
+    Возвращает (перенесено строк, ошибок, последний id).
+    """
+    if pa is None or read_arrow_batches_from_odbc is None:
+        raise RuntimeError("Для Arrow-движка нужны пакеты pyarrow и arrow-odbc")
+
+    range_filter = f" AND [{key}] <= {end_id}" if end_id is not None else ""
+    column_list = ', '.join(f'[{name}]' for name in columns)
+    reader = read_arrow_batches_from_odbc(
+        query=(
+            f"SELECT {column_list} FROM {source_table} "
+            f"WHERE [{key}] > {last_id}{range_filter} ORDER BY [{key}]"
+        ),
+        connection_string=get_mssql_connection_string(),
+        batch_size=batch_size
+    )
+    session, url = get_clickhouse_http_session()
+    stats = {'transferred': 0, 'errors': 0, 'last_id': last_id, 'batches': 0}
+
+    id_position = columns.index(key)
+
+    def serialize(item):
+        batch, fetch_seconds = item
+        start = time.perf_counter()
+        if numeric_columns:
+            batch = normalize_arrow_numbers(batch, numeric_columns)
+        id_column = batch.column(id_position)
+        payload = arrow_batch_to_ipc(batch)
+        record = {'first_id': id_column[0].as_py(), 'last_id': id_column[-1].as_py(),
+                  'rows': batch.num_rows, 'bytes': len(payload), 'fetch_seconds': fetch_seconds,
+                  'convert_seconds': time.perf_counter() - start}
+        return batch, payload, record['first_id'], record['last_id'], record
+
+    def insert(batch, payload=None):
+        settings = {'input_format_null_as_default': 1}
+        if dedup_prefix:
+            ids = batch.column(id_position)
+            settings.update(dedup_settings(
+                dedup_token(dedup_prefix, ids[0].as_py(), ids[-1].as_py(), batch.num_rows)
+            ))
+        if payload is None:
+            payload = arrow_batch_to_ipc(batch)
+        insert_formatted(session, url, target_table, columns, payload, 'ArrowStream', settings)
+
+    def load(serialized):
+        batch, payload, first_id, batch_last_id, record = serialized
+        stats['batches'] += 1
+
+        def on_failed_row(row, error):
+            values = row.to_pylist()[0]
+            logger.debug(f"Ошибка вставки строки {values[key]}: {str(error)}")
+            quarantine.add('insert', values[key], error, values, stats['batches'], first_id, batch_last_id)
+
+        start = time.perf_counter()
+        errors = 0
+        try:
+            insert(batch, payload)
+            inserted = batch.num_rows
+            if on_progress:
+                on_progress(batch.num_rows)
+        except Exception as e:
+            logger.error(f"Ошибка вставки Arrow-батча #{stats['batches']} (id {first_id}..{batch_last_id}): {str(e)}")
+            # Ищем плохие строки делением батча пополам
+            inserted, errors = bisect_insert(
+                insert, batch, batch.num_rows,
+                lambda part, start, stop: part.slice(start, stop - start),
+                on_failed_row, on_progress, first_error=e
+            )
+            stats['errors'] += errors
+        stats['transferred'] += inserted
+        stats['last_id'] = batch_last_id
+        if on_batch:
+            on_batch(dict(record, batch_no=stats['batches'], errors=errors,
+                          insert_seconds=time.perf_counter() - start))
+        if errors:
+            quarantine.flush()
+        if on_checkpoint:
+            on_checkpoint(batch_last_id, stats['batches'], inserted)
+        if batch_sizer:
+            batch_sizer.backpressure()
+
+    batches = timed_batches(batch for batch in reader if batch.num_rows)
+    try:
+        if pipeline_depth > 0:
+            run_pipeline(batches, serialize, load, depth=pipeline_depth)
+        else:
+            for item in batches:
+                load(serialize(item))
+    finally:
+        session.close()
+
+    return stats['transferred'], stats['errors'], stats['last_id']
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МБ (ru_maxrss в Linux - в КБ)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def split_id_range(start_id, end_id, shards):
+    """Делит диапазон (start_id, end_id] на не более чем shards равных поддиапазонов"""
+    if end_id <= start_id:
+        return []
+    step = max(1, -(-(end_id - start_id) // shards))
+    return [(lo, min(lo + step, end_id)) for lo in range(start_id, end_id, step)]
+
+
+# Подключения процесса-воркера: открываются один раз в инициализаторе пула
+_worker_state = {}
+
+
+def _init_shard_worker(progress_queue):
+    _worker_state['mssql_conn'] = get_mssql_connection()
+    _worker_state['ch_client'] = get_clickhouse_client()
+    _worker_state['progress_queue'] = progress_queue
+
+
+def _transfer_shard(shard):
+    """Переносит один шард (диапазон ключа) в процессе-воркере"""
+    converter = BatchConverter(shard['source_columns'], shard['columns_map'], shard['numeric_columns'])
+    progress_queue = _worker_state['progress_queue']
+    target_table = shard['target_table']
+    batch_sizer = BatchSizer(_worker_state['ch_client'], target_table, shard['batch_size'],
+                             first_size=shard['resume_batch_size'], **shard['batch_control'])
+    if shard['engine'] == 'arrow' or shard['coalesce']:
+        batch_sizer.adaptive = False
+    on_checkpoint = None
+    if shard['checkpoints']:
+        store = CheckpointStore(_worker_state['ch_client'])
+
+        def on_checkpoint(last_id, batch_no, rows):
+            store.save(target_table, last_id, batch_no, rows,
+                       shard_start=shard['start_id'], shard_end=shard['end_id'],
+                       batch_size=batch_sizer.next_size)
+    recorder = None
+    on_batch = None
+    if shard['run_history']:
+        recorder = RunRecorder(_worker_state['ch_client'], target_table, run_id=shard['run_id'])
+        on_batch = recorder.record_batch
+    quarantine = QuarantineStore(_worker_state['ch_client'], target_table, shard['source_table'],
+                                 run_id=shard['run_id'])
+
+    try:
+        if shard['engine'] == 'arrow':
+            transferred, errors, _ = copy_id_range_arrow(
+                shard['source_table'], target_table, converter.columns,
+                last_id=shard['resume_id'], batch_size=batch_sizer.size,
+                quarantine=quarantine, end_id=shard['end_id'],
+                on_progress=progress_queue.put, pipeline_depth=shard['pipeline_depth'],
+                on_checkpoint=on_checkpoint, dedup_prefix=shard['dedup_prefix'],
+                key=shard['key'], on_batch=on_batch, batch_sizer=batch_sizer,
+                numeric_columns=shard['numeric_columns']
+            )
+        else:
+            with read_isolation(_worker_state['mssql_conn'], shard['isolation']):
+                transferred, errors, _ = copy_id_range(
+                    _worker_state['mssql_conn'].cursor(),
+                    _worker_state['ch_client'],
+                    converter,
+                    shard['source_table'],
+                    target_table,
+                    last_id=shard['resume_id'],
+                    end_id=shard['end_id'],
+                    batch_size=shard['batch_size'],
+                    quarantine=quarantine,
+                    on_progress=progress_queue.put,
+                    pipeline_depth=shard['pipeline_depth'],
+                    converter_threads=shard['converter_threads'],
+                    read_mode=shard['read_mode'],
+                    reconnect=isolated_connection_factory(shard['isolation']),
+                    on_checkpoint=on_checkpoint,
+                    dedup_prefix=shard['dedup_prefix'],
+                    key=shard['key'],
+                    on_batch=on_batch,
+                    batch_sizer=batch_sizer,
+                    coalescer=(BlockCoalescer(converter.columns, *shard['coalesce'])
+                               if shard['coalesce'] else None)
+                )
+    finally:
+        quarantine.flush()
+    if recorder is not None:
+        recorder.flush()
+    if shard['checkpoints']:
+        store.save(target_table, shard['end_id'], shard_start=shard['start_id'],
+                   shard_end=shard['end_id'], done=True)
+    return {
+        'start_id': shard['start_id'],
+        'end_id': shard['end_id'],
+        'transferred': transferred,
+        'errors': errors
+    }
+
+
+def plan_shards(start_id, end_id, workers, checkpoint_store=None, target_table=None):
+    """
+    План шардов [(start, end, resume_id, done, resume_batch_size)] для диапазона (start_id, end_id].
+    С контрольными точками сначала берутся шарды прерванного запуска (продолжаются
+    с их last_id и размером следующего батча), а новые шарды строятся только выше их границы.
+    """
+    plan = []
+    if checkpoint_store is not None:
+        plan = [
+            (lo, hi, max(lo, last_id), bool(done), batch_size)
+            for lo, hi, last_id, done, batch_size in checkpoint_store.shards_above(target_table, start_id)
+        ]
+        if plan:
+            logger.info(
+                f"Найдено {len(plan)} шардов прошлого запуска, "
+                f"незавершенных: {sum(1 for _, _, _, done, _ in plan if not done)}"
+            )
+    next_start = max([start_id] + [hi for _, hi, _, _, _ in plan])
+    # Шардов больше, чем воркеров, чтобы неравномерные диапазоны id выравнивались
+    plan += [(lo, hi, lo, False, 0) for lo, hi in split_id_range(next_start, end_id, workers * 4)]
+    return plan
+
+
+def transfer_id_range_parallel(source_table, target_table, start_id, end_id, source_columns,
+                               columns_map, batch_size, workers, pbar,
+                               pipeline_depth=0, converter_threads=1, read_mode='keyset',
+                               engine='python', checkpoint_store=None, key='id',
+                               numeric_columns=NUMERIC_COLUMNS, run_id=None, batch_control=None,
+                               run_history=False, coalesce=None, isolation='read_committed'):
+    """
+    Параллельный перенос: диапазон ключа (start_id, end_id] делится на шарды, каждый шард
+    переносится в отдельном процессе со своим подключением к MS SQL и ClickHouse.
+    Прогресс воркеров собирается в родительском процессе через очередь.
+    С checkpoint_store каждый шард фиксирует свои контрольные точки, а после успешного
+    завершения всех шардов сдвигается общая точка продолжения таблицы.
+    run_id - запуск, под которым шарды пишут строки карантина и (run_history=True)
+    историю своих батчей (RunRecorder).
+    batch_control - настройки BatchSizer каждого шарда,
+    coalesce - (partition_key, sorting_key, строк в буфере) для BlockCoalescer шарда,
+    isolation - уровень изоляции чтения шардов (у каждого процесса свой снимок).
+    Возвращает (перенесено строк, ошибок).
+    """
+    plan = plan_shards(start_id, end_id, workers, checkpoint_store, target_table)
+    shards = [(lo, hi, resume_id, resume_batch_size)
+              for lo, hi, resume_id, done, resume_batch_size in plan if not done]
+    logger.info(f"Параллельный перенос: {len(shards)} шардов на {workers} процессах")
+
+    mp_context = multiprocessing.get_context('spawn')
+    progress_queue = mp_context.Queue()
+    transferred_rows = 0
+    error_count = 0
+    failed_ranges = []
+
+    def drain_progress(timeout=0):
+        try:
+            while True:
+                pbar.update(progress_queue.get(True, timeout))
+        except queue.Empty:
+            pass
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=_init_shard_worker, initargs=(progress_queue,)) as executor:
+        futures = {
+            executor.submit(_transfer_shard, {
+                'source_table': source_table,
+                'target_table': target_table,
+                'start_id': lo,
+                'end_id': hi,
+                'resume_id': resume_id,
+                'batch_size': batch_size,
+                'source_columns': list(source_columns),
+                'columns_map': columns_map,
+                'pipeline_depth': pipeline_depth,
+                'converter_threads': converter_threads,
+                'read_mode': read_mode,
+                'engine': engine,
+                'checkpoints': checkpoint_store is not None,
+                'dedup_prefix': target_table if checkpoint_store is not None else None,
+                'key': key,
+                'numeric_columns': numeric_columns,
+                'run_id': run_id,
+                'run_history': run_history,
+                'resume_batch_size': resume_batch_size,
+                'batch_control': batch_control or {},
+                'coalesce': coalesce,
+                'isolation': isolation
+            }): (lo, hi)
+            for lo, hi, resume_id, resume_batch_size in shards
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            drain_progress()
+            for future in done:
+                lo, hi = futures[future]
+                try:
+                    result = future.result()
+                    transferred_rows += result['transferred']
+                    error_count += result['errors']
+                    logger.debug(f"Шард ({lo}, {hi}] завершен: {result['transferred']:,} строк")
+                except Exception as e:
+                    failed_ranges.append((lo, hi))
+                    logger.error(f"Ошибка переноса шарда ({lo}, {hi}]: {str(e)}")
+        drain_progress(timeout=0.1)
+
+    if failed_ranges:
+        if checkpoint_store is not None:
+            raise RuntimeError(
+                f"Не перенесены шарды {failed_ranges}. Повторный запуск продолжит их "
+                f"с контрольных точек"
+            )
+        raise RuntimeError(
+            f"Не перенесены шарды {failed_ranges}. Перед повторным запуском удалите "
+            f"из {target_table} строки с {key} > {failed_ranges[0][0]}"
+        )
+    if checkpoint_store is not None and plan:
+        checkpoint_store.save(target_table, max(hi for _, hi, _, _, _ in plan), rows=transferred_rows)
+    return transferred_rows, error_count
+
+
+def transfer_table(full_table_name=None, target_table=None, batch_size=50000, workers=1,
+                   pipeline_depth=0, converter_threads=1, read_mode='keyset', engine='python',
+                   checkpoints=False, migrate_schema=False, connections=None, table_cache=None,
+                   row_count='estimate', spec=None, run_history=True, profile=False,
+                   batch_control=None, coalesce_rows=0, isolation='read_committed'):
+    """
+    Оптимизированный перенос данных из MS SQL в ClickHouse.
+    spec - описание таблицы (TableSpec), по умолчанию берется из реестра TABLE_SPECS по имени.
+    workers > 1 включает параллельный перенос по диапазонам ключа в отдельных процессах.
+    pipeline_depth > 0 включает конвейер чтение/конвертация/вставка внутри процесса
+    (converter_threads - число потоков конвертации).
+    read_mode='stream' читает таблицу одним упорядоченным запросом через fetchmany.
+    engine='arrow' переносит данные Arrow-батчами (arrow-odbc → ClickHouse ArrowStream)
+    без построчных Python-объектов, engine='python' - через BatchConverter.
+    checkpoints=True хранит точку продолжения в etl_checkpoints после каждого батча
+    и вставляет батчи с токенами дедупликации, поэтому перезапуск после сбоя
+    продолжает с середины таблицы без повторного чтения и дублей.
+    migrate_schema=True перестраивает существующую таблицу по схеме, сгенерированной из MS SQL.
+    connections=(mssql_conn, ch_client) - уже открытые подключения (не закрываются),
+    table_cache - словарь для кэша схемы между вызовами (режим демона).
+    row_count='estimate' оценивает число новых строк по метаданным MS SQL (estimate_new_rows)
+    только для прогресса, row_count='exact' считает их точно через COUNT(*).
+    run_history=True пишет время этапов каждого батча и итог запуска в etl_batches/etl_runs,
+    profile=True снимает сэмплирующий профиль (StackSampler) в profile_<таблица>_<время>.folded.
+    batch_control - настройки BatchSizer: adaptive=True подбирает размер батча по времени
+    этапов и памяти, вставка приостанавливается при большом числе кусков и слияний в ClickHouse.
+    isolation='snapshot' читает весь перенос одной транзакцией SNAPSHOT (set_isolation):
+    без разделяемых блокировок и с согласованным срезом по всем батчам. Обрыв потокового чтения
+    под SNAPSHOT останавливает перенос (новое подключение читало бы другой срез).
+    С workers > 1 у каждого шарда свой срез, общего среза таблицы нет (пишется предупреждение).
+    Arrow-движок читает своим подключением arrow-odbc только в READ COMMITTED, другой уровень
+    изоляции с engine='arrow' отклоняется.
+    Таблицы с spec.keyset переносятся transfer_keyset (без шардов, Arrow и истории запусков).
+    coalesce_rows > 0 копит до coalesce_rows строк и вставляет их блоками по партициям,
+    отсортированными по ключу сортировки таблицы (BlockCoalescer, только engine='python').
+    Блоки идут не по порядку id, поэтому контрольные точки при этом включаются всегда.
+    Размер батча при этом не подбирается, чтобы после сбоя блоки и токены дедупликации совпали.
+    Возвращает {'rows': перенесено, 'errors': ошибок}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    if spec.keyset:
+        return transfer_keyset(batch_size=batch_size, pipeline_depth=pipeline_depth,
+                               converter_threads=converter_threads, migrate_schema=migrate_schema,
+                               connections=connections, table_cache=table_cache, spec=spec,
+                               isolation=isolation)
+    schema, table_name = spec.schema, spec.table_name
+    target_table = spec.target
+    source_table = spec.source_table
+    key = spec.key
+    if engine == 'arrow' and isolation != 'read_committed':
+        raise ValueError(f"Arrow-движок читает своим подключением в READ COMMITTED, изоляция {isolation} "
+                         f"не поддерживается (TRANSFER_ENGINE=python)")
+    if coalesce_rows > 0 and engine != 'arrow' and not checkpoints:
+        # Блоки вставляются в порядке партиций, а не id: max(id) в ClickHouse
+        # после сбоя посреди сброса буфера не является точкой продолжения
+        logger.warning("TRANSFER_COALESCE_ROWS требует контрольных точек, они включены")
+        checkpoints = True
+    
+    try:
+        logger.info(f"Начало переноса из {schema}.{table_name} в {target_table}")
+
+        # Подключаемся к базам данных; с isolation='snapshot' все чтение идет из одного снимка
+        with open_connections(connections) as (mssql_conn, ch_client), \
+                read_isolation(mssql_conn, isolation) as isolation_level:
+            mssql_cursor = mssql_conn.cursor()
+            if isolation_level != 'read_committed':
+                logger.info(f"Чтение из MS SQL с изоляцией {isolation_level}")
+            if isolation == 'snapshot' and workers > 1:
+                logger.warning(
+                    f"SNAPSHOT с {workers} процессами: каждый шард читает свой снимок, "
+                    f"общего согласованного среза таблицы нет"
+                )
+            
+            if 'columns_map' not in table_cache:
+                # 1. Получаем информацию о колонках из MS SQL
+                mssql_columns = get_source_columns(mssql_cursor, schema, table_name)
+
+                # 2. Создаем таблицу в ClickHouse по схеме MS SQL и получаем типы колонок
+                table_cache['columns_map'] = ensure_target_table(ch_client, target_table, mssql_columns,
+                                                                 spec, migrate=migrate_schema)
+                table_cache['mssql_columns'] = mssql_columns
+            mssql_columns = table_cache['mssql_columns']
+            columns_map = table_cache['columns_map']
+            
+            # 3. Точка продолжения: контрольная точка, иначе максимальный ID из ClickHouse
+            checkpoint_store = None
+            checkpoint = None
+            resume_batch_size = None
+            run_end = 0
+            pending_shards = False
+            if checkpoints:
+                checkpoint_store = CheckpointStore(ch_client)
+                if 'checkpoints_ready' not in table_cache:
+                    checkpoint_store.ensure()
+                    table_cache['checkpoints_ready'] = True
+                checkpoint = checkpoint_store.get(target_table)
+
+            if checkpoint is not None:
+                max_id_ch, _, resume_batch_size, run_end = checkpoint
+                # Шарды выше водяного знака остаются только от прерванного параллельного запуска
+                pending_shards = bool(checkpoint_store.shards_above(target_table, max_id_ch))
+                logger.info(f"Продолжаем с контрольной точки: {key} > {max_id_ch}")
+            else:
+                try:
+                    max_id_ch = ch_client.execute(f"SELECT max(`{key}`) FROM {target_table}")[0][0] or 0
+                    logger.info(f"Текущий максимальный {key} в ClickHouse: {max_id_ch}")
+                except Exception as e:
+                    logger.warning(f"Не удалось получить max ID (возможно таблица пустая): {str(e)}")
+                    max_id_ch = 0
+                if checkpoint_store is not None:
+                    # Первая контрольная точка таблицы, дальше продолжаем только от нее
+                    checkpoint_store.save(target_table, max_id_ch)
+
+            # 4. Количество новых строк в MS SQL: точное (COUNT(*)) или оценка по метаданным
+            if row_count == 'exact':
+                count_query = f"SELECT COUNT(*), MAX([{key}]) FROM {source_table} WHERE [{key}] > {max_id_ch}"
+                logger.debug(f"Выполняем запрос: {count_query}")
+                mssql_cursor.execute(count_query)
+                total_rows, max_id_source = mssql_cursor.fetchone()
+            else:
+                total_rows, max_id_source = estimate_new_rows(mssql_cursor, source_table, key, max_id_ch)
+            
+            if max_id_source is None:
+                logger.info("Нет новых данных для переноса")
+                return {'rows': 0, 'errors': 0}
+                
+            if row_count == 'exact':
+                logger.info(f"Найдено {total_rows:,} новых строк для переноса")
+            elif total_rows is not None:
+                logger.info(f"Найдено примерно {total_rows:,} новых строк для переноса (до {key} {max_id_source})")
+            else:
+                logger.info(f"Найдены новые строки для переноса до {key} {max_id_source}")
+            # Прерванный последовательный запуск доводится до своей границы: последний неполный
+            # батч читается тем же и получает тот же токен дедупликации; новые строки - следующим запуском
+            end_id = max_id_source
+            if run_end > max_id_ch:
+                end_id = run_end
+                logger.info(f"Доводим прерванный запуск до {key} {end_id}")
+
+            # 5. Конвертер строится один раз на таблицу (порядок колонок SELECT * = ORDINAL_POSITION)
+            if 'converter' not in table_cache:
+                table_cache['converter'] = BatchConverter(mssql_columns.keys(), columns_map,
+                                                          spec.numeric_columns)
+                if table_cache['converter'].skipped_columns:
+                    logger.warning(
+                        f"Колонки отсутствуют в ClickHouse и не переносятся: "
+                        f"{table_cache['converter'].skipped_columns}"
+                    )
+            converter = table_cache['converter']
+            if engine == 'arrow':
+                logger.info("Движок переноса: Arrow (arrow-odbc → ClickHouse ArrowStream)")
+            else:
+                logger.info(f"Колоночная вставка, NumPy: {'да' if converter.use_numpy else 'нет'}")
+
+            # 6. Переносим данные пакетами; плохие строки - в карантин etl_quarantine
+            run_id = uuid.uuid4()
+            quarantine = QuarantineStore(ch_client, target_table, spec.source, run_id=run_id)
+            if 'quarantine_ready' not in table_cache:
+                quarantine.ensure()
+                table_cache['quarantine_ready'] = True
+
+            # История запуска (etl_runs/etl_batches) и сэмплирующий профилировщик
+            run_started = datetime.datetime.now()
+            recorder = None
+            on_batch = None
+            if run_history:
+                recorder = RunRecorder(ch_client, target_table, run_id=run_id)
+                if 'run_history_ready' not in table_cache:
+                    recorder.ensure()
+                    table_cache['run_history_ready'] = True
+                on_batch = recorder.record_batch
+            sampler = StackSampler().start() if profile else None
+
+            # Размер батча и обратное давление ClickHouse; первый батч после сбоя - прежнего размера
+            batch_sizer = BatchSizer(ch_client, target_table, batch_size, first_size=resume_batch_size,
+                                     **(batch_control or {}))
+            if engine == 'arrow':
+                batch_sizer.adaptive = False
+
+            # Блоки по партициям строятся по фактическим ключам таблицы в ClickHouse
+            coalesce = None
+            if coalesce_rows > 0 and engine != 'arrow':
+                if 'table_layout' not in table_cache:
+                    _, sorting_key, partition_key = get_table_info(ch_client, target_table)
+                    table_cache['table_layout'] = (partition_key, sorting_key)
+                coalesce = table_cache['table_layout'] + (coalesce_rows,)
+                batch_sizer.adaptive = False
+
+            def finish_run(status, rows=0, errors=0, error=''):
+                if sampler is not None:
+                    sampler.stop(f'profile_{target_table}_{run_started.strftime("%Y%m%d_%H%M%S")}.folded')
+                if recorder is not None:
+                    recorder.finish(spec.source, run_started, rows, errors, status, engine,
+                                    read_mode, batch_size, workers, error)
+
+            try:
+                with tqdm(total=total_rows, unit='rows', desc=f"Перенос {table_name}") as pbar:
+                    on_checkpoint = None
+                    dedup_prefix = None
+                    if checkpoint_store is not None:
+                        dedup_prefix = target_table
+
+                        def on_checkpoint(last_id, batch_no, rows):
+                            checkpoint_store.save(target_table, last_id, batch_no, rows,
+                                                  batch_size=batch_sizer.next_size, end_id=end_id)
+                
+                    # Незавершенные шарды прошлого запуска доводятся тем же планом шардов,
+                    # иначе границы батчей и токены дедупликации не совпадут
+                    if workers > 1 or pending_shards:
+                        transferred_rows, error_count = transfer_id_range_parallel(
+                            source_table, target_table, max_id_ch, max_id_source,
+                            mssql_columns.keys(), columns_map, batch_size, max(workers, 1),
+                            pbar, pipeline_depth, converter_threads, read_mode,
+                            engine, checkpoint_store, key, spec.numeric_columns,
+                            run_id, batch_control, run_history, coalesce, isolation
+                        )
+                    elif engine == 'arrow':
+                        transferred_rows, error_count, _ = copy_id_range_arrow(
+                            source_table, target_table, converter.columns,
+                            last_id=max_id_ch, batch_size=batch_sizer.size, quarantine=quarantine,
+                            end_id=end_id, on_progress=pbar.update, pipeline_depth=pipeline_depth,
+                            on_checkpoint=on_checkpoint, dedup_prefix=dedup_prefix, key=key,
+                            on_batch=on_batch, batch_sizer=batch_sizer,
+                            numeric_columns=spec.numeric_columns
+                        )
+                    else:
+                        transferred_rows, error_count, _ = copy_id_range(
+                            mssql_cursor, ch_client, converter, source_table, target_table,
+                            last_id=max_id_ch, end_id=end_id, batch_size=batch_size,
+                            quarantine=quarantine, on_progress=pbar.update,
+                            pipeline_depth=pipeline_depth, converter_threads=converter_threads,
+                            read_mode=read_mode, reconnect=isolated_connection_factory(isolation_level),
+                            on_checkpoint=on_checkpoint, dedup_prefix=dedup_prefix, key=key,
+                            on_batch=on_batch, batch_sizer=batch_sizer,
+                            coalescer=BlockCoalescer(converter.columns, *coalesce) if coalesce else None
+                        )
+            except Exception as e:
+                finish_run('failed', error=str(e))
+                raise
+            finally:
+                quarantine.flush()
+            finish_run('ok' if error_count == 0 else 'partial', transferred_rows, error_count)
+
+            # 7. Финализация
             total_time = time.time() - start_time
             logger.info(
                 f"Перенос завершен. Перенесено {transferred_rows:,} строк "
-                f"за {total_time:.2f} сек ({transferred_rows/total_time:,.0f} строк/сек)"
+                f"за {total_time:.2f} сек ({transferred_rows/total_time:,.0f} строк/сек), "
+                f"движок {engine}, пиковый RSS {peak_rss_mb():,.0f} МБ"
             )
             
             if error_count > 0:
-                logger.warning(f"Обнаружено {error_count} ошибок. Подробности в {error_log_path}")
-            else:
-                # Удаляем пустой лог ошибок
-                if os.path.exists(error_log_path):
-                    os.remove(error_log_path)
-            
+                logger.warning(
+                    f"Обнаружено {error_count} ошибок. Строки сохранены в {quarantine.table} "
+                    f"(run_id {run_id}), повторная вставка - TRANSFER_MODE=redrive"
+                )
+
             # Проверяем итоговое количество строк
             try:
                 final_count = ch_client.execute(f"SELECT count() FROM {target_table}")[0][0]
                 logger.info(f"Итоговое количество строк в {target_table}: {final_count:,}")
             except Exception as e:
                 logger.warning(f"Не удалось проверить итоговое количество строк: {str(e)}")
+
+            return {'rows': transferred_rows, 'errors': error_count}
             
     except Exception as e:
         logger.error(f"Критическая ошибка при переносе таблицы {target_table}: {str(e)}", exc_info=True)
         raise
     
+def change_capture_query(source_table, from_version, to_version, version_column=None, version_type=None,
+                         key='id'):
+    """
+    Запрос изменений источника: колонки _op ('I'/'U'/'D'), _version, _key и T.*.
+    Без version_column используется MS SQL Change Tracking (видит и удаления),
+    иначе - колонка rowversion / времени изменения / числовой версии (только вставки и обновления).
+    """
+    if version_column is None:
+        return f"""
+            SELECT CT.SYS_CHANGE_OPERATION AS _op, CT.SYS_CHANGE_VERSION AS _version,
+                   CT.[{key}] AS _key, T.*
+            FROM CHANGETABLE(CHANGES {source_table}, {from_version}) AS CT
+            LEFT JOIN {source_table} AS T ON T.[{key}] = CT.[{key}]
+            WHERE CT.SYS_CHANGE_VERSION <= {to_version}
+            ORDER BY CT.SYS_CHANGE_VERSION
+        """
+    column = f"T.[{version_column}]"
+    if version_type in ROWVERSION_TYPES:
+        version_expr = f"CONVERT(BIGINT, {column})"
+        version_filter = (
+            f"{column} > CONVERT(BINARY(8), CONVERT(BIGINT, {from_version})) "
+            f"AND {column} <= CONVERT(BINARY(8), CONVERT(BIGINT, {to_version}))"
+        )
+    elif version_type in DATETIME_TYPES:
+        version_expr = f"DATEDIFF_BIG(MICROSECOND, '19700101', {column})"
+        version_filter = f"{version_expr} > {from_version} AND {version_expr} <= {to_version}"
+    else:
+        version_expr = column
+        version_filter = f"{column} > {from_version} AND {column} <= {to_version}"
+    return f"""
+        SELECT 'U' AS _op, {version_expr} AS _version, T.[{key}] AS _key, T.*
+        FROM {source_table} AS T
+        WHERE {version_filter}
+        ORDER BY {column}
+    """
+
+
+def get_change_bounds(mssql_cursor, source_table, from_version, version_column=None, version_type=None):
+    """
+    Границы набора изменений (from_version, to_version].
+    Без сохраненной версии Change Tracking начинает с минимальной доступной версии
+    (повтор уже перенесенных изменений безопасен), колонка версии - с нуля.
+    """
+    if version_column is None:
+        mssql_cursor.execute(f"""
+            SELECT CHANGE_TRACKING_CURRENT_VERSION(),
+                   CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('{source_table}'))
+        """)
+        current_version, min_valid_version = mssql_cursor.fetchone()
+        if min_valid_version is None:
+            raise RuntimeError(f"Change Tracking не включен для {source_table}")
+        if from_version is None:
+            from_version = min_valid_version
+        elif from_version < min_valid_version:
+            raise RuntimeError(
+                f"Версия {from_version} старше минимально доступной в Change Tracking "
+                f"({min_valid_version}), нужна полная перезагрузка таблицы"
+            )
+        return from_version, current_version
+
+    column = f"[{version_column}]"
+    if version_type in ROWVERSION_TYPES:
+        # Строки незавершенных транзакций получат rowversion не меньше MIN_ACTIVE_ROWVERSION
+        mssql_cursor.execute("SELECT CONVERT(BIGINT, MIN_ACTIVE_ROWVERSION()) - 1")
+    elif version_type in DATETIME_TYPES:
+        mssql_cursor.execute(f"SELECT DATEDIFF_BIG(MICROSECOND, '19700101', MAX({column})) FROM {source_table}")
+    else:
+        mssql_cursor.execute(f"SELECT MAX({column}) FROM {source_table}")
+    to_version = mssql_cursor.fetchone()[0] or 0
+    return from_version or 0, to_version
+
+
+def change_version(value, key_value=None):
+    """
+    Версия изменения для _version (UInt64): rowversion (bytes) - big-endian число,
+    Decimal и другие числа - int(). NULL - ошибка с ключом строки.
+    """
+    if value is None:
+        raise ValueError(f"Пустая версия изменения у строки с ключом {key_value}")
+    if isinstance(value, (bytes, bytearray)):
+        return int.from_bytes(value, 'big')
+    return int(value)
+
+
+def apply_change_batch(ch_client, target_table, converter, rows, version_position, key_position,
+                       op_position, key='id', sorting_columns=('sale_date', 'id')):
+    """
+    Применяет батч изменений к версионированной таблице ClickHouse.
+    Новые версии строк вставляются с _version источника, а для удаленных строк и строк,
+    у которых изменился ключ сортировки (sorting_columns, включает key), вставляются
+    tombstone-строки (_is_deleted = 1) со старым значением ключа сортировки.
+    Возвращает (вставлено версий, удалено).
+    """
+    sorting_columns = list(sorting_columns)
+    versions = {row[key_position]: change_version(row[version_position], row[key_position]) for row in rows}
+    upserts = [row for row in rows if row[op_position] != 'D']
+    new_positions = {}
+    inserted = 0
+    if upserts:
+        data = converter.convert(upserts)
+        data.append(np.array([change_version(row[version_position], row[key_position]) for row in upserts],
+                             dtype=np.uint64))
+        data.append(np.zeros(len(upserts), dtype=np.uint8))
+        inserted = insert_column_data(
+            ch_client, target_table, converter.columns + [VERSION_COLUMN, DELETED_COLUMN],
+            data, converter.use_numpy, {'async_insert': 0}
+        )
+        positions = [
+            np.asarray(data[converter.columns.index(name)]).tolist()
+            for name in sorting_columns
+        ]
+        key_values = positions[sorting_columns.index(key)]
+        new_positions = dict(zip(key_values, zip(*positions)))
+
+    column_list = ', '.join(f'`{name}`' for name in sorting_columns)
+    existing = ch_client.execute(
+        f"SELECT DISTINCT {column_list} FROM {target_table} FINAL WHERE `{key}` IN %(ids)s",
+        {'ids': tuple(versions)}
+    )
+    key_index = sorting_columns.index(key)
+    tombstones = [
+        tuple(position) + (versions[position[key_index]], 1)
+        for position in existing
+        if new_positions.get(position[key_index]) != tuple(position)
+    ]
+    if tombstones:
+        ch_client.execute(
+            f"INSERT INTO {target_table} ({column_list}, {VERSION_COLUMN}, {DELETED_COLUMN}) VALUES",
+            tombstones,
+            settings={'async_insert': 0}
+        )
+    deleted = sum(1 for row in rows if row[op_position] == 'D')
+    return inserted, deleted
+
+
+def sync_changes(full_table_name=None, target_table=None, batch_size=50000, version_column=None,
+                 connections=None, table_cache=None, spec=None):
+    """
+    Инкрементальный перенос изменений (вставки, обновления, удаления) из MS SQL в ClickHouse.
+    Источник изменений - Change Tracking или колонка версии (version_column: rowversion,
+    время изменения или числовая версия). Целевая таблица переводится в ReplacingMergeTree
+    (ensure_target_table(versioned=True)),
+    поэтому стоимость синхронизации пропорциональна числу изменений, а не размеру таблицы.
+    Набор изменений ограничивается версией на момент старта, точка продолжения сохраняется
+    после применения всего набора (повторное применение идемпотентно благодаря версиям).
+    connections, table_cache и spec - как в transfer_table. Возвращает {'rows': изменений, 'errors': 0}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    full_table_name = spec.source
+    schema, table_name = spec.schema, spec.table_name
+    target_table = spec.target
+    source_table = spec.source_table
+    checkpoint_key = f"{target_table}@changes"
+
+    try:
+        with open_connections(connections) as (mssql_conn, ch_client):
+            mssql_cursor = mssql_conn.cursor()
+            if 'columns_map' not in table_cache:
+                mssql_columns = get_source_columns(mssql_cursor, schema, table_name)
+                table_cache['columns_map'] = ensure_target_table(
+                    ch_client, target_table, mssql_columns, spec, versioned=True
+                )
+                table_cache['mssql_columns'] = mssql_columns
+                CheckpointStore(ch_client).ensure()
+            mssql_columns = table_cache['mssql_columns']
+            columns_map = table_cache['columns_map']
+
+            checkpoint_store = CheckpointStore(ch_client)
+            checkpoint = checkpoint_store.get(checkpoint_key)
+
+            version_type = mssql_columns.get(version_column) if version_column else None
+            if version_column and version_type is None:
+                raise ValueError(f"Колонка версии {version_column} не найдена в {full_table_name}")
+
+            from_version, to_version = get_change_bounds(
+                mssql_cursor, source_table, checkpoint[0] if checkpoint else None,
+                version_column, version_type
+            )
+            if to_version <= from_version:
+                logger.info(f"Нет изменений в {full_table_name} после версии {from_version}")
+                return {'rows': 0, 'errors': 0}
+            logger.info(
+                f"Перенос изменений {full_table_name} → {target_table}: версии ({from_version}, {to_version}], "
+                f"источник: {'Change Tracking' if version_column is None else version_column}"
+            )
+
+            # Служебные колонки запроса в ClickHouse не пишутся, _version вставляется отдельно
+            if 'converter' not in table_cache:
+                table_cache['converter'] = BatchConverter(
+                    ['_op', '_change_version', '_key'] + list(mssql_columns.keys()), columns_map,
+                    spec.numeric_columns
+                )
+            converter = table_cache['converter']
+
+            mssql_cursor.execute(change_capture_query(
+                source_table, from_version, to_version, version_column, version_type, spec.key
+            ))
+            total_inserted = total_deleted = 0
+            with tqdm(unit='rows', desc=f"Изменения {table_name}") as pbar:
+                while True:
+                    rows = mssql_cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    inserted, deleted = apply_change_batch(
+                        ch_client, target_table, converter, rows,
+                        version_position=1, key_position=2, op_position=0,
+                        key=spec.key, sorting_columns=spec.sorting_columns
+                    )
+                    total_inserted += inserted
+                    total_deleted += deleted
+                    pbar.update(len(rows))
+
+            checkpoint_store.save(checkpoint_key, to_version, rows=total_inserted + total_deleted)
+            logger.info(
+                f"Изменения применены за {time.time() - start_time:.2f} сек: "
+                f"новых версий {total_inserted:,}, удалений {total_deleted:,}, версия {to_version}"
+            )
+            return {'rows': total_inserted + total_deleted, 'errors': 0}
+    except Exception as e:
+        logger.error(f"Критическая ошибка при переносе изменений {full_table_name}: {str(e)}", exc_info=True)
+        raise
+
+
+# Форматы файлов выгрузки: расширение и формат INSERT ... FORMAT в ClickHouse
+STAGE_FORMATS = {'parquet': ('parquet', 'Parquet'), 'arrow': ('arrows', 'ArrowStream')}
+
+
+class StagedTable:
+    """
+    Каталог файловой выгрузки таблицы <stage_dir>/<target_table>:
+    <first>_<last>_<rows>.<parquet|arrows> - сжатые колоночные файлы диапазонов ключа,
+    state.json - схема источника, колонки файлов и последний выгруженный ключ,
+    loaded/ - загруженные файлы (если их нужно хранить).
+    Файл появляется под своим именем только после полной записи (os.replace).
+    """
+
+    FILE_PATTERN = re.compile(r'^(\d{20})_(\d{20})_(\d+)\.(parquet|arrows)$')
+
+    def __init__(self, stage_dir, target_table):
+        self.path = os.path.join(stage_dir, target_table)
+        self.state_path = os.path.join(self.path, 'state.json')
+        os.makedirs(self.path, exist_ok=True)
+
+    def read_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, **values):
+        state = dict(self.read_state(), **values)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def file_path(self, first_id, last_id, rows, extension):
+        return os.path.join(self.path, f"{first_id:020d}_{last_id:020d}_{rows}.{extension}")
+
+    def pending_files(self):
+        """Незагруженные файлы [(first_id, last_id, rows, путь, формат ClickHouse)] по возрастанию ключа"""
+        files = []
+        for name in os.listdir(self.path):
+            match = self.FILE_PATTERN.match(name)
+            if match:
+                first_id, last_id, rows, extension = match.groups()
+                data_format = next(ch_format for ext, ch_format in STAGE_FORMATS.values() if ext == extension)
+                files.append((int(first_id), int(last_id), int(rows), os.path.join(self.path, name), data_format))
+        return sorted(files)
+
+    def mark_loaded(self, path, keep=False):
+        if keep:
+            loaded_dir = os.path.join(self.path, 'loaded')
+            os.makedirs(loaded_dir, exist_ok=True)
+            os.replace(path, os.path.join(loaded_dir, os.path.basename(path)))
+        else:
+            os.remove(path)
+
+
+class StageFileWriter:
+    """Запись колоночных батчей в один файл выгрузки (Parquet - группа строк на батч, Arrow IPC stream)"""
+
+    def __init__(self, staged, data_format, columns):
+        if pa is None:
+            raise RuntimeError("Для файловой выгрузки нужен пакет pyarrow")
+        if data_format not in STAGE_FORMATS:
+            raise ValueError(f"Неизвестный формат выгрузки: {data_format}")
+        self.staged = staged
+        self.data_format = data_format
+        self.columns = columns
+        self.extension = STAGE_FORMATS[data_format][0]
+        self.tmp_path = os.path.join(staged.path, f".{uuid.uuid4().hex}.tmp")
+        self.schema = None
+        self.writer = None
+        self.first_id = None
+        self.last_id = None
+        self.rows = 0
+
+    @staticmethod
+    def _array(col, arrow_type):
+        if isinstance(col, DictionaryColumn):
+            # Строки собираются из словаря средствами Arrow, без массива Python-объектов
+            col = pa.DictionaryArray.from_arrays(col.codes, col.dictionary).dictionary_decode()
+            return col if arrow_type is None else col.cast(arrow_type)
+        return pa.array(col, type=arrow_type)
+
+    def write(self, columns_data, first_id, last_id):
+        arrays = [
+            self._array(col, self.schema.field(i).type if self.schema else None)
+            for i, col in enumerate(columns_data)
+        ]
+        batch = pa.RecordBatch.from_arrays(arrays, names=self.columns)
+        if self.writer is None:
+            self.schema = batch.schema
+            if self.data_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression='zstd')
+            else:
+                self.writer = pa.ipc.new_stream(
+                    self.tmp_path, self.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')
+                )
+            self.first_id = first_id
+        if self.data_format == 'parquet':
+            self.writer.write_batch(batch, row_group_size=batch.num_rows)
+        else:
+            self.writer.write_batch(batch)
+        self.last_id = last_id
+        self.rows += batch.num_rows
+
+    def close(self):
+        """Закрывает файл и публикует его под именем с диапазоном ключа. Возвращает путь"""
+        self.writer.close()
+        path = self.staged.file_path(self.first_id, self.last_id, self.rows, self.extension)
+        os.replace(self.tmp_path, path)
+        return path
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def stage_start_id(ch_client, target_table, key):
+    """Ключ, с которого начинается первая выгрузка таблицы: контрольная точка или max(key) в ClickHouse"""
+    try:
+        checkpoint = CheckpointStore(ch_client).get(target_table)
+        if checkpoint is not None:
+            return checkpoint[0]
+        return ch_client.execute(f"SELECT max(`{key}`) FROM {target_table}")[0][0] or 0
+    except Exception as e:
+        logger.warning(f"Не удалось получить точку продолжения из ClickHouse, выгружаем с начала: {str(e)}")
+        return 0
+
+
+def source_key_value(value, mssql_type):
+    """Значение ключа из JSON контрольной точки в тип параметра pyodbc по DATA_TYPE колонки MS SQL"""
+    if not isinstance(value, str):
+        return value
+    if mssql_type == 'date':
+        return datetime.date.fromisoformat(value)
+    if mssql_type in DATETIME_TYPES:
+        return datetime.datetime.fromisoformat(value)
+    if mssql_type in ('decimal', 'numeric', 'money', 'smallmoney'):
+        return Decimal(value)
+    return value
+
+
+def transfer_keyset(full_table_name=None, target_table=None, batch_size=50000, pipeline_depth=0,
+                    converter_threads=1, migrate_schema=False, connections=None, table_cache=None,
+                    spec=None, isolation='read_committed'):
+    """
+    Инкрементальный перенос таблицы без возрастающего id: keyset-пагинация по spec.keyset -
+    уникальному ключу строки, первая колонка которого - монотонно растущее время.
+    Последний ключ хранится в etl_checkpoints (last_key) после каждого батча. Каждый запуск
+    перечитывает источник с времени последнего ключа минус spec.keyset_lookback (>=),
+    поэтому строки, пришедшие позже с тем же или чуть более ранним временем, не теряются.
+    Перечитанные строки получают новые токены дедупликации (границы батчей зависят от новых
+    строк), их схлопывает ReplacingMergeTree по ключу сортировки; до слияния кусков они видны
+    дважды, поэтому запросы к таблице должны использовать FINAL. Без контрольной точки в непустой
+    таблице ClickHouse продолжение - с максимума колонки времени в ClickHouse минус lookback.
+    Колонки ключа не должны содержать NULL. Батчи вставляются с токенами дедупликации.
+    isolation - уровень изоляции чтения, как в transfer_table.
+    Возвращает {'rows': перенесено, 'errors': ошибок}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    key_columns = spec.keyset
+    logger.info(f"Начало keyset-переноса из {spec.source} в {target_table} по ({', '.join(key_columns)})")
+
+    with open_connections(connections) as (mssql_conn, ch_client), read_isolation(mssql_conn, isolation):
+        mssql_cursor = mssql_conn.cursor()
+        if 'columns_map' not in table_cache:
+            mssql_columns = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+            missing = [name for name in key_columns if name not in mssql_columns]
+            if missing:
+                raise ValueError(f"Колонок ключа {missing} нет в {spec.source}")
+            table_cache['columns_map'] = ensure_target_table(ch_client, target_table, mssql_columns,
+                                                             spec, migrate=migrate_schema)
+            table_cache['mssql_columns'] = mssql_columns
+        mssql_columns = table_cache['mssql_columns']
+        leading = key_columns[0]
+        leading_type = mssql_columns[leading]
+        if leading_type != 'date' and leading_type not in DATETIME_TYPES:
+            raise ValueError(
+                f"{spec.source}: keyset должен начинаться с монотонно растущей колонки времени, "
+                f"{leading} имеет тип {leading_type}"
+            )
+        if 'converter' not in table_cache:
+            table_cache['converter'] = BatchConverter(mssql_columns.keys(), table_cache['columns_map'],
+                                                      spec.numeric_columns)
+        converter = table_cache['converter']
+        source_positions = list(mssql_columns)
+        key_positions = [source_positions.index(name) for name in key_columns]
+
+        checkpoint_store = CheckpointStore(ch_client)
+        if 'checkpoints_ready' not in table_cache:
+            checkpoint_store.ensure()
+            table_cache['checkpoints_ready'] = True
+        last_key = checkpoint_store.get_key(target_table)
+        if last_key is not None:
+            last_time = source_key_value(last_key[0], leading_type)
+        else:
+            # Таблица могла быть загружена раньше без контрольной точки
+            rows, max_leading = ch_client.execute(f"SELECT count(), max(`{leading}`) FROM {target_table}")[0]
+            last_time = max_leading if rows else None
+        since = None
+        if last_time is not None:
+            since = last_time - spec.keyset_lookback
+            logger.info(f"Продолжаем с {leading} >= {since} (последнее перенесенное {last_time}, "
+                        f"перекрытие {spec.keyset_lookback})")
+
+        quarantine = QuarantineStore(ch_client, target_table, spec.source)
+        if 'quarantine_ready' not in table_cache:
+            quarantine.ensure()
+            table_cache['quarantine_ready'] = True
+        stats = {'transferred': 0, 'errors': 0, 'batches': 0}
+
+        def convert(rows):
+            first_key = tuple(rows[0][pos] for pos in key_positions)
+            batch_last_key = tuple(rows[-1][pos] for pos in key_positions)
+            data, failed = convert_rows(converter, rows, f"{first_key}..{batch_last_key}")
+            failed = [(json.dumps([json_value(row[pos]) for pos in key_positions], ensure_ascii=False),
+                       dict(zip(converter.source_columns, row)), error) for row, error in failed]
+            return data, failed, batch_last_key
+
+        def load(converted):
+            data, failed, batch_last_key = converted
+            stats['batches'] += 1
+            for row_key, values, error in failed:
+                quarantine.add('convert', row_key, error, values, stats['batches'])
+            inserted, errors = 0, len(failed)
+            if data is not None:
+                inserted, insert_errors = load_batch(ch_client, target_table, converter, data, quarantine,
+                                                     pbar.update, f"#{stats['batches']}",
+                                                     f"{target_table}@keyset", key_columns, stats['batches'])
+                errors += insert_errors
+            stats['transferred'] += inserted
+            stats['errors'] += errors
+            # Ключ сдвигается только после записи плохих строк в карантин
+            quarantine.flush()
+            checkpoint_store.save(target_table, 0, stats['batches'], inserted, last_key=batch_last_key)
+
+        batches = fetch_keyset_batches(mssql_cursor, spec.source_table, key_columns, key_positions,
+                                       since, batch_size)
+        try:
+            with tqdm(unit='rows', desc=f"Перенос {spec.table_name}") as pbar:
+                if pipeline_depth > 0:
+                    run_pipeline(batches, convert, load, depth=pipeline_depth, workers=converter_threads)
+                else:
+                    for rows in batches:
+                        converted = convert(rows)
+                        del rows
+                        load(converted)
+                        del converted
+        finally:
+            quarantine.flush()
+
+    total_time = time.time() - start_time
+    logger.info(f"Keyset-перенос {target_table} завершен: {stats['transferred']:,} строк за {total_time:.2f} сек, "
+                f"батчей {stats['batches']}, ошибок {stats['errors']}")
+    return {'rows': stats['transferred'], 'errors': stats['errors']}
+
+
+def export_table(full_table_name=None, target_table=None, stage_dir='stage', data_format='parquet',
+                 batch_size=50000, read_mode='stream', file_rows=1000000, connections=None,
+                 table_cache=None, spec=None):
+    """
+    Выгрузка новых строк MS SQL в файлы без загрузки в ClickHouse (режим export).
+    Строки читаются батчами, конвертируются BatchConverter в типы целевой таблицы из описания
+    таблицы и пишутся в файлы по file_rows строк (Parquet или Arrow IPC, сжатие ZSTD).
+    Продолжает с последнего выгруженного ключа (state.json), первая выгрузка - с контрольной
+    точки или max(key) в ClickHouse. Возвращает {'rows': выгружено, 'errors': 0, 'files': файлов}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    staged = StagedTable(stage_dir, target_table)
+
+    with open_connections(connections) as (mssql_conn, ch_client):
+        mssql_cursor = mssql_conn.cursor()
+        if 'mssql_columns' not in table_cache:
+            table_cache['mssql_columns'] = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+        mssql_columns = table_cache['mssql_columns']
+        ch_types = {
+            name: spec.column_type(name, mssql_type)
+            for name, mssql_type in mssql_columns.items() if mssql_type not in ROWVERSION_TYPES
+        }
+        converter = BatchConverter(mssql_columns.keys(), ch_types, spec.numeric_columns)
+        key_position = converter.source_columns.index(spec.key)
+
+        state = staged.read_state()
+        last_id = state.get('last_id')
+        if last_id is None:
+            last_id = stage_start_id(ch_client, target_table, spec.key)
+        staged.write_state(source_columns=mssql_columns, columns=converter.columns, key=spec.key,
+                           last_id=last_id)
+        logger.info(f"Выгрузка {spec.source} в {staged.path} ({data_format}): {spec.key} > {last_id}")
+
+        exported = files = 0
+        writer = None
+        try:
+            for rows in fetch_batches(read_mode, mssql_cursor, spec.source_table, last_id, batch_size,
+                                      reconnect=get_mssql_connection, key=spec.key,
+                                      key_position=key_position):
+                if writer is None:
+                    writer = StageFileWriter(staged, data_format, converter.columns)
+                writer.write(converter.convert(rows), rows[0][key_position], rows[-1][key_position])
+                exported += len(rows)
+                if writer.rows >= file_rows:
+                    path = writer.close()
+                    staged.write_state(last_id=writer.last_id)
+                    files += 1
+                    logger.info(f"Записан файл {os.path.basename(path)}: {writer.rows:,} строк")
+                    writer = None
+            if writer is not None:
+                path = writer.close()
+                staged.write_state(last_id=writer.last_id)
+                files += 1
+                logger.info(f"Записан файл {os.path.basename(path)}: {writer.rows:,} строк")
+                writer = None
+        finally:
+            if writer is not None:
+                # Недописанный файл не публикуется, повтор выгрузит его строки заново
+                writer.discard()
+
+    logger.info(f"Выгрузка завершена за {time.time() - start_time:.2f} сек: {exported:,} строк, {files} файлов")
+    return {'rows': exported, 'errors': 0, 'files': files}
+
+
+def load_staged_files(full_table_name=None, target_table=None, stage_dir='stage', keep_files=False,
+                      checkpoints=True, migrate_schema=False, connections=None, table_cache=None,
+                      spec=None, batch_control=None):
+    """
+    Загрузка файлов выгрузки в ClickHouse (режим load) без обращения к MS SQL.
+    Каждый файл вставляется одним потоковым INSERT ... FORMAT Parquet/ArrowStream по HTTP
+    с токеном дедупликации по диапазону ключа, поэтому повторная загрузка файла после сбоя
+    не создает дублей. Файлы грузятся по возрастанию ключа, загрузка останавливается на первой
+    ошибке (файл остается в каталоге для повтора). После файла сдвигается контрольная точка,
+    файл удаляется (keep_files=True - переносится в loaded/).
+    Возвращает {'rows': загружено, 'errors': 0, 'files': файлов}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    staged = StagedTable(stage_dir, target_table)
+    files = staged.pending_files()
+    if not files:
+        logger.info(f"Нет файлов для загрузки в {target_table} в {staged.path}")
+        return {'rows': 0, 'errors': 0, 'files': 0}
+    state = staged.read_state()
+
+    with open_connections(connections) as (_, ch_client):
+        if 'stage_target_ready' not in table_cache:
+            # Схема источника сохранена при выгрузке, MS SQL не нужен
+            ensure_target_table(ch_client, target_table, state['source_columns'], spec,
+                                migrate=migrate_schema)
+            table_cache['stage_target_ready'] = True
+        checkpoint_store = CheckpointStore(ch_client) if checkpoints else None
+        if checkpoint_store is not None and 'checkpoints_ready' not in table_cache:
+            checkpoint_store.ensure()
+            table_cache['checkpoints_ready'] = True
+        batch_sizer = BatchSizer(ch_client, target_table, max(rows for _, _, rows, _, _ in files),
+                                 **(batch_control or {}))
+
+        session, url = get_clickhouse_http_session()
+        loaded_rows = 0
+        try:
+            for number, (first_id, last_id, rows, path, data_format) in enumerate(files, 1):
+                settings = {'input_format_null_as_default': 1}
+                settings.update(dedup_settings(dedup_token(target_table, first_id, last_id, rows)))
+                with open(path, 'rb') as payload:
+                    insert_formatted(session, url, target_table, state['columns'], payload,
+                                     data_format, settings)
+                loaded_rows += rows
+                if checkpoint_store is not None:
+                    checkpoint_store.save(target_table, last_id, number, rows)
+                staged.mark_loaded(path, keep_files)
+                logger.info(f"Загружен файл {os.path.basename(path)} ({number}/{len(files)}): {rows:,} строк")
+                batch_sizer.backpressure()
+        except Exception as e:
+            logger.error(
+                f"Ошибка загрузки файла {os.path.basename(path)} в {target_table}: {str(e)}. "
+                f"Файл и следующие за ним остаются в {staged.path} для повторной загрузки"
+            )
+            raise
+        finally:
+            session.close()
+
+    logger.info(
+        f"Загрузка в {target_table} завершена за {time.time() - start_time:.2f} сек: "
+        f"{loaded_rows:,} строк из {len(files)} файлов"
+    )
+    return {'rows': loaded_rows, 'errors': 0, 'files': len(files)}
+
+
+def restore_value(value, ch_type):
+    """Значение из JSON карантина в тип Python для колонки ClickHouse (даты хранятся строками)"""
+    base_type = unwrap_low_cardinality(ch_type)
+    if isinstance(value, str) and value:
+        if base_type == 'Date':
+            return datetime.date.fromisoformat(value[:10])
+        if base_type.startswith('DateTime'):
+            return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def key_literal(value):
+    """Значение ключа (строка из карантина) как литерал T-SQL"""
+    if value.lstrip('-').isdigit():
+        return value
+    return "'" + value.replace("'", "''") + "'"
+
+
+def redrive_quarantine(full_table_name=None, target_table=None, source='mssql', batch_size=50000,
+                       connections=None, table_cache=None, spec=None):
+    """
+    Повторная вставка строк из карантина (режим redrive) крупными батчами.
+    source='mssql' - строки заново читаются из MS SQL по ключам (исправлены в источнике
+    или исправлена конвертация), source='quarantine' - берутся значения из row_json
+    (исправленные в etl_quarantine через ALTER TABLE ... UPDATE).
+    Вставленные строки получают статус redriven, строки, которых нет в источнике - missing,
+    снова не прошедшие строки остаются pending с новой ошибкой.
+    Вставка идет с токенами дедупликации, поэтому повтор после сбоя не создает дублей.
+    Возвращает {'rows': вставлено, 'errors': осталось в карантине}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+
+    with open_connections(connections) as (mssql_conn, ch_client):
+        quarantine = QuarantineStore(ch_client, target_table, spec.source)
+        quarantine.ensure()
+        pending = quarantine.pending_rows()
+        if not pending:
+            logger.info(f"В карантине нет строк {target_table}")
+            return {'rows': 0, 'errors': 0}
+        logger.info(f"Повторная вставка {len(pending):,} строк {target_table} из карантина (источник: {source})")
+
+        columns_map = {
+            name: ch_type for name, ch_type, *_ in ch_client.execute(f"DESCRIBE TABLE {target_table}")
+            if name not in (VERSION_COLUMN, DELETED_COLUMN)
+        }
+        if source == 'mssql':
+            mssql_cursor = mssql_conn.cursor()
+            if 'mssql_columns' not in table_cache:
+                table_cache['mssql_columns'] = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+            converter = BatchConverter(table_cache['mssql_columns'].keys(), columns_map, spec.numeric_columns)
+        elif source == 'quarantine':
+            converter = BatchConverter(columns_map.keys(), columns_map, spec.numeric_columns)
+        else:
+            raise ValueError(f"Неизвестный источник повторной вставки: {source}")
+        key_position = converter.source_columns.index(spec.key)
+
+        inserted_total = failed_total = 0
+        for batch_no, offset in enumerate(range(0, len(pending), batch_size), 1):
+            chunk = pending[offset:offset + batch_size]
+            # Свой буфер на батч: по нему видно, какие строки снова не прошли
+            retry = QuarantineStore(ch_client, target_table, spec.source, run_id=quarantine.run_id,
+                                    flush_every=len(chunk) + 1)
+            if source == 'mssql':
+                rows = []
+                for start in range(0, len(chunk), 1000):
+                    keys = ', '.join(key_literal(row_key) for row_key, *_ in chunk[start:start + 1000])
+                    mssql_cursor.execute(f"SELECT * FROM {spec.source_table} WHERE [{spec.key}] IN ({keys})")
+                    rows.extend(mssql_cursor.fetchall())
+            else:
+                rows = []
+                for _, row_json, *_ in chunk:
+                    values = json.loads(row_json)
+                    rows.append(tuple(restore_value(values.get(name), ch_type)
+                                      for name, ch_type in columns_map.items()))
+            rows.sort(key=lambda row: row[key_position])
+
+            good_rows = []
+            for row in rows:
+                try:
+                    converter.convert([row])
+                    good_rows.append(row)
+                except Exception as e:
+                    retry.add('convert', row[key_position], e, dict(zip(converter.source_columns, row)), batch_no)
+            inserted = 0
+            if good_rows:
+                inserted, _ = load_batch(ch_client, target_table, converter, converter.convert(good_rows),
+                                         retry, batch_label=f"#{batch_no}",
+                                         dedup_prefix=f"{target_table}@redrive", key=spec.key,
+                                         batch_no=batch_no)
+            failed_keys = retry.buffered_keys()
+            found_keys = {str(json_value(row[key_position])) for row in rows}
+            retry.flush()
+            missing = [row for row in chunk if row[0] not in found_keys]
+            quarantine.set_status([row for row in chunk if row[0] in found_keys and row[0] not in failed_keys],
+                                  'redriven')
+            quarantine.set_status(missing, 'missing')
+            inserted_total += inserted
+            failed_total += len(failed_keys)
+            logger.info(
+                f"Батч #{batch_no}: вставлено {inserted:,}, снова в карантине {len(failed_keys):,}, "
+                f"нет в источнике {len(missing):,}"
+            )
+
+    logger.info(
+        f"Повторная вставка {target_table} завершена за {time.time() - start_time:.2f} сек: "
+        f"вставлено {inserted_total:,}, осталось в карантине {failed_total:,}"
+    )
+    return {'rows': inserted_total, 'errors': failed_total}
+
+
+# Суммы, которые сверяются между MS SQL и ClickHouse (если колонки есть в обеих таблицах)
+RECONCILE_SUMS = ('sales_amount_rub', 'sales_quantity')
+
+
+def reconcile_bucket_sql(spec, bucket, bucket_size, date_column):
+    """Выражение бакета (MS SQL, ClickHouse): месяц YYYYMM по date_column или диапазон ключа"""
+    if bucket == 'month':
+        # NULL-даты в ClickHouse хранятся как 1970-01-01
+        source_date = f"ISNULL([{date_column}], '19700101')"
+        return (f"YEAR({source_date}) * 100 + MONTH({source_date})", f"toYYYYMM(`{date_column}`)")
+    if bucket == 'id':
+        return (f"[{spec.key}] / {int(bucket_size)}", f"intDiv(`{spec.key}`, {int(bucket_size)})")
+    raise ValueError(f"Неизвестный бакет сверки: {bucket}")
+
+
+def source_sum_sql(name, mssql_type):
+    """Сумма колонки в MS SQL как float; текстовые числа с запятой приводятся через TRY_CAST"""
+    if MSSQL_TYPE_MAP.get(mssql_type) in ('Float64', 'Float32', 'Int64', 'Int32', 'Int16', 'UInt8'):
+        return f"SUM(CAST([{name}] AS float))"
+    return f"SUM(TRY_CAST(REPLACE([{name}], ',', '.') AS float))"
+
+
+def aggregate_buckets(mssql_cursor, ch_client, spec, columns_map, mssql_columns, sums,
+                      bucket, bucket_size, date_column, max_id):
+    """
+    Агрегаты по бакетам с обеих сторон для строк с ключом <= max_id.
+    Возвращает (source, target): {бакет: (строк, суммы..., min ключа, max ключа)}.
+    """
+    source_bucket, target_bucket = reconcile_bucket_sql(spec, bucket, bucket_size, date_column)
+    key = spec.key
+    source_sums = ''.join(f", {source_sum_sql(name, mssql_columns[name])}" for name in sums)
+    mssql_cursor.execute(f"""
+        SELECT {source_bucket} AS bucket, COUNT_BIG(*){source_sums}, MIN([{key}]), MAX([{key}])
+        FROM {spec.source_table}
+        WHERE [{key}] <= {max_id}
+        GROUP BY {source_bucket}
+    """)
+    source = {row[0]: tuple(row[1:]) for row in mssql_cursor.fetchall()}
+
+    # Версионированная таблица (режим changes): актуальные версии без удаленных строк
+    versioned = DELETED_COLUMN in columns_map
+    final = " FINAL" if versioned else ""
+    deleted_filter = f" AND `{DELETED_COLUMN}` = 0" if versioned else ""
+    target_sums = ''.join(f", sum(`{name}`)" for name in sums)
+    rows = ch_client.execute(f"""
+        SELECT {target_bucket} AS bucket, count(){target_sums}, min(`{key}`), max(`{key}`)
+        FROM {spec.target}{final}
+        WHERE `{key}` <= {max_id}{deleted_filter}
+        GROUP BY bucket
+    """)
+    target = {row[0]: tuple(row[1:]) for row in rows}
+    return source, target
+
+
+def bucket_matches(source, target, tolerance):
+    """Совпадают ли число строк и суммы бакета (суммы - с относительной точностью tolerance)"""
+    if source is None or target is None or source[0] != target[0]:
+        return False
+    for source_sum, target_sum in zip(source[1:-2], target[1:-2]):
+        source_sum, target_sum = float(source_sum or 0), float(target_sum or 0)
+        if abs(source_sum - target_sum) > max(0.01, tolerance * max(abs(source_sum), abs(target_sum))):
+            return False
+    return True
+
+
+def merge_ranges(ranges):
+    """Объединяет пересекающиеся диапазоны ключа [(lo, hi)]"""
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def reconcile_table(full_table_name=None, target_table=None, bucket='month', bucket_size=1000000,
+                    sum_columns=RECONCILE_SUMS, repair=False, batch_size=50000, tolerance=1e-6,
+                    connections=None, table_cache=None, spec=None):
+    """
+    Сверка MS SQL и ClickHouse агрегатами по бакетам без чтения строк: число строк
+    и суммы sum_columns по месяцам (bucket='month', колонка даты из ключа партиционирования
+    toYYYYMM(...)) или по диапазонам ключа шириной bucket_size (bucket='id').
+    Сверяются строки с ключом не больше максимального ключа в ClickHouse,
+    новые строки источника ждут обычного переноса.
+    repair=True перезаливает несовпавшие бакеты: строки бакета (месяц по колонке даты
+    или диапазон ключа) удаляются из ClickHouse мутацией и переносятся заново
+    без дедупликации вставок, после чего сверка повторяется.
+    Возвращает {'rows': перезалито строк, 'errors': несовпавших бакетов, 'buckets': всего бакетов,
+    'mismatched': [бакет, ...]}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    key = spec.key
+
+    date_column = None
+    if bucket == 'month':
+        match = re.fullmatch(r"toYYYYMM\((\w+)\)", spec.partition_key or '')
+        if match:
+            date_column = match.group(1)
+        else:
+            logger.warning(f"{target_table} не партиционирована по месяцам, сверка по диапазонам {key}")
+            bucket = 'id'
+
+    with open_connections(connections) as (mssql_conn, ch_client):
+        mssql_cursor = mssql_conn.cursor()
+        if 'mssql_columns' not in table_cache:
+            table_cache['mssql_columns'] = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+        mssql_columns = table_cache['mssql_columns']
+        columns_map = {name: ch_type for name, ch_type, *_ in ch_client.execute(f"DESCRIBE TABLE {target_table}")}
+        sums = [name for name in sum_columns if name in columns_map and name in mssql_columns]
+
+        max_id = ch_client.execute(f"SELECT max(`{key}`) FROM {target_table}")[0][0]
+        if not max_id:
+            logger.info(f"{target_table} пуста, сверять нечего")
+            return {'rows': 0, 'errors': 0, 'buckets': 0, 'mismatched': []}
+
+        def compare():
+            source, target = aggregate_buckets(mssql_cursor, ch_client, spec, columns_map, mssql_columns,
+                                               sums, bucket, bucket_size, date_column, max_id)
+            buckets = sorted(set(source) | set(target))
+            mismatched = [b for b in buckets if not bucket_matches(source.get(b), target.get(b), tolerance)]
+            for b in mismatched:
+                logger.warning(f"Бакет {b} не совпадает: MS SQL {source.get(b)}, ClickHouse {target.get(b)}")
+            return source, target, buckets, mismatched
+
+        logger.info(f"Сверка {spec.source} и {target_table} по бакетам {bucket}, {key} <= {max_id}, "
+                    f"суммы: {', '.join(sums) or 'нет'}")
+        source, target, buckets, mismatched = compare()
+
+        repaired = 0
+        if repair and mismatched:
+            if 'converter' not in table_cache:
+                table_cache['converter'] = BatchConverter(mssql_columns.keys(), columns_map,
+                                                          spec.numeric_columns)
+            converter = table_cache['converter']
+            quarantine = QuarantineStore(ch_client, target_table, spec.source)
+            if 'quarantine_ready' not in table_cache:
+                quarantine.ensure()
+                table_cache['quarantine_ready'] = True
+            try:
+                key_position = converter.source_columns.index(key)
+                if bucket == 'month':
+                    # Месяц перезаливается по колонке даты, а не по диапазону id:
+                    # id месяца могут быть разбросаны по всей таблице
+                    for month_bucket in mismatched:
+                        month = datetime.date(month_bucket // 100, month_bucket % 100, 1)
+                        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+                        logger.info(f"Перезаливка {target_table}: месяц {month_bucket}, {key} <= {max_id}")
+                        ch_client.execute(
+                            f"ALTER TABLE {target_table} DELETE "
+                            f"WHERE toYYYYMM(`{date_column}`) = {month_bucket} AND `{key}` <= {max_id}",
+                            settings={'mutations_sync': 2}
+                        )
+                        date_filter = (f"[{date_column}] >= '{month:%Y%m%d}' "
+                                       f"AND [{date_column}] < '{next_month:%Y%m%d}'")
+                        if month_bucket == 197001:
+                            # NULL-даты попадают в бакет 1970-01, как в reconcile_bucket_sql
+                            date_filter = f"({date_filter} OR [{date_column}] IS NULL)"
+                        mssql_cursor.execute(
+                            f"SELECT * FROM {spec.source_table} WHERE {date_filter} AND [{key}] <= {max_id}"
+                        )
+                        batch_no = 0
+                        while True:
+                            rows = mssql_cursor.fetchmany(batch_size)
+                            if not rows:
+                                break
+                            batch_no += 1
+                            data, failed = convert_rows(converter, rows, f"{month_bucket} #{batch_no}")
+                            for row, error in failed:
+                                quarantine.add('convert', row[key_position], error,
+                                               dict(zip(converter.source_columns, row)), batch_no)
+                            del rows
+                            if data is not None:
+                                inserted, _ = load_batch(ch_client, target_table, converter, data, quarantine,
+                                                         batch_label=f"{month_bucket} #{batch_no}", key=key,
+                                                         batch_no=batch_no, deduplicate=False)
+                                repaired += inserted
+                else:
+                    ranges = merge_ranges(
+                        (min(side[b][-2] for side in (source, target) if b in side),
+                         max(side[b][-1] for side in (source, target) if b in side))
+                        for b in mismatched
+                    )
+                    for lo, hi in ranges:
+                        logger.info(f"Перезаливка {target_table}: {key} {lo}..{hi}")
+                        ch_client.execute(
+                            f"ALTER TABLE {target_table} DELETE WHERE `{key}` >= {lo} AND `{key}` <= {hi}",
+                            settings={'mutations_sync': 2}
+                        )
+                        rows, _, _ = copy_id_range(
+                            mssql_cursor, ch_client, converter, spec.source_table, target_table,
+                            last_id=lo - 1, batch_size=batch_size, quarantine=quarantine, end_id=hi, key=key,
+                            deduplicate=False
+                        )
+                        repaired += rows
+            finally:
+                quarantine.flush()
+            source, target, buckets, mismatched = compare()
+
+    logger.info(
+        f"Сверка {target_table} завершена за {time.time() - start_time:.2f} сек: бакетов {len(buckets)}, "
+        f"не совпало {len(mismatched)}" + (f", перезалито строк {repaired:,}" if repair else "")
+    )
+    return {'rows': repaired, 'errors': len(mismatched), 'buckets': len(buckets), 'mismatched': mismatched}
+
+
+def month_starts(date_from, date_to):
+    """Первые числа месяцев, которые пересекает окно [date_from, date_to]"""
+    month = date_from.replace(day=1)
+    months = []
+    while month <= date_to:
+        months.append(month)
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def backfill_window(full_table_name=None, target_table=None, date_from=None, date_to=None,
+                    batch_size=50000, connections=None, table_cache=None, spec=None):
+    """
+    Перезаливка окна дат [date_from, date_to] (строки 'YYYY-MM-DD' или date) целыми партициями.
+    Окно расширяется до целых месяцев партиционирования toYYYYMM(<дата>). Строки окна
+    читаются из MS SQL в промежуточную таблицу {target_table}__backfill той же структуры,
+    затем каждая партиция атомарно подменяется в рабочей таблице (REPLACE PARTITION),
+    поэтому дашборды не видят частично загруженный месяц. Месяц, которого больше нет
+    в источнике, удаляется из рабочей таблицы.
+    Берутся строки с ключом не больше максимального в ClickHouse: новые строки переносит
+    append, и во время перезаливки он не должен писать в те же месяцы.
+    Строки с NULL в колонке даты лежат в партиции 1970-01 и перезаливаются вместе с ней.
+    Если строки окна не удалось сконвертировать или вставить (карантин), партиции не подменяются.
+    Возвращает {'rows': загружено строк, 'errors': 0, 'partitions': подменено партиций}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    key = spec.key
+    match = re.fullmatch(r"toYYYYMM\((\w+)\)", spec.partition_key or '')
+    if not match:
+        raise ValueError(f"{target_table}: перезаливка окна требует PARTITION BY toYYYYMM(<дата>)")
+    date_column = match.group(1)
+    if isinstance(date_from, str):
+        date_from = datetime.date.fromisoformat(date_from)
+    if isinstance(date_to, str):
+        date_to = datetime.date.fromisoformat(date_to)
+    if date_from is None or date_to is None or date_from > date_to:
+        raise ValueError(f"Некорректное окно перезаливки: {date_from} - {date_to}")
+    months = month_starts(date_from, date_to)
+    staging_table = f"{target_table}__backfill"
+
+    with open_connections(connections) as (mssql_conn, ch_client):
+        mssql_cursor = mssql_conn.cursor()
+        if 'mssql_columns' not in table_cache:
+            table_cache['mssql_columns'] = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+        mssql_columns = table_cache['mssql_columns']
+        columns_map = {name: ch_type for name, ch_type, *_ in ch_client.execute(f"DESCRIBE TABLE {target_table}")}
+        converter = BatchConverter(mssql_columns.keys(), columns_map, spec.numeric_columns)
+        key_position = converter.source_columns.index(key)
+        max_id = ch_client.execute(f"SELECT max(`{key}`) FROM {target_table}")[0][0] or 0
+        logger.info(
+            f"Перезаливка {target_table}: {months[0]:%Y-%m} - {months[-1]:%Y-%m} "
+            f"({len(months)} партиций), {key} <= {max_id}"
+        )
+
+        ch_client.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        ch_client.execute(f"CREATE TABLE {staging_table} AS {target_table}")
+        quarantine = QuarantineStore(ch_client, target_table, spec.source)
+        if 'quarantine_ready' not in table_cache:
+            quarantine.ensure()
+            table_cache['quarantine_ready'] = True
+
+        # 1. Месяцы окна - в промежуточную таблицу
+        loaded = {}
+        errors = 0
+        try:
+            for month in tqdm(months, unit='месяц', desc=f"Перезаливка {target_table}"):
+                next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+                partition = month.year * 100 + month.month
+                date_filter = (f"[{date_column}] >= '{month:%Y%m%d}' "
+                               f"AND [{date_column}] < '{next_month:%Y%m%d}'")
+                if partition == 197001:
+                    # NULL-даты попадают в партицию 1970-01, как в reconcile_bucket_sql
+                    date_filter = f"({date_filter} OR [{date_column}] IS NULL)"
+                mssql_cursor.execute(
+                    f"SELECT * FROM {spec.source_table} WHERE {date_filter} AND [{key}] <= {max_id}"
+                )
+                loaded[partition] = 0
+                batch_no = 0
+                while True:
+                    rows = mssql_cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    batch_no += 1
+                    batch_label = f"{partition} #{batch_no}"
+                    data, failed = convert_rows(converter, rows, batch_label)
+                    for row, error in failed:
+                        quarantine.add('convert', row[key_position], error,
+                                       dict(zip(converter.source_columns, row)), batch_no)
+                    errors += len(failed)
+                    del rows
+                    if data is not None:
+                        inserted, batch_errors = load_batch(ch_client, staging_table, converter, data,
+                                                            quarantine, batch_label=batch_label, key=key,
+                                                            batch_no=batch_no)
+                        loaded[partition] += inserted
+                        errors += batch_errors
+        finally:
+            quarantine.flush()
+
+        if errors:
+            raise RuntimeError(
+                f"Перезаливка {target_table} остановлена: {errors} строк не вставлены "
+                f"(см. {quarantine.table}), рабочая таблица не изменена, строки окна - в {staging_table}"
+            )
+
+        # 2. Подмена партиций: каждая меняется атомарно
+        for partition, rows in loaded.items():
+            if rows:
+                ch_client.execute(f"ALTER TABLE {target_table} REPLACE PARTITION {partition} FROM {staging_table}")
+            else:
+                logger.warning(f"Месяца {partition} нет в источнике, партиция удаляется из {target_table}")
+                ch_client.execute(f"ALTER TABLE {target_table} DROP PARTITION {partition}")
+            logger.info(f"Партиция {partition} подменена: {rows:,} строк")
+        ch_client.execute(f"DROP TABLE IF EXISTS {staging_table}")
+
+    total_rows = sum(loaded.values())
+    logger.info(f"Перезаливка {target_table} завершена за {time.time() - start_time:.2f} сек: "
+                f"{total_rows:,} строк, {len(loaded)} партиций")
+    return {'rows': total_rows, 'errors': 0, 'partitions': len(loaded)}
+
+
+class WorkQueue:
+    """
+    Очередь единиц работы в ClickHouse (etl_work_units) для нескольких экземпляров переноса
+    на разных хостах. Единица - диапазон ключа (unit_start, unit_end] целевой таблицы,
+    единица PLAN_UNIT = (0, 0) - право планировать новые диапазоны.
+    Экземпляр захватывает единицу арендой (lease_until), продлевает ее heartbeat-ами
+    и отмечает завершение (done) или возвращает в очередь (released).
+    Строки только добавляются: каждый захват - новое поколение (generation) единицы,
+    владелец поколения - самый ранний захват (claimed_at, owner). Время захвата и аренды
+    берется из часов сервера ClickHouse, поэтому расхождение часов хостов не влияет.
+    Захват проверяется через settle_seconds после вставки, а каждый heartbeat перепроверяет
+    владельца, так что из двух одновременных захватов работу продолжает только один.
+    """
+
+    PLAN_UNIT = (0, 0)
+
+    def __init__(self, ch_client, target_table, owner=None, lease_seconds=60, settle_seconds=1.0,
+                 table='etl_work_units'):
+        self.ch_client = ch_client
+        self.target_table = target_table
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.settle_seconds = settle_seconds
+        self.table = table
+        # Свои захваты: единица → (поколение, claimed_at)
+        self.claims = {}
+
+    def ensure(self):
+        self.ch_client.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                target_table String,
+                unit_start UInt64,
+                unit_end UInt64,
+                generation UInt32,
+                owner String,
+                status LowCardinality(String),
+                claimed_at DateTime64(6),
+                lease_until DateTime64(6),
+                rows UInt64,
+                updated_at DateTime64(6)
+            ) ENGINE = ReplacingMergeTree(updated_at)
+            ORDER BY (target_table, unit_start, unit_end, generation, owner)
+        """)
+
+    def states(self, unit=None):
+        """
+        Текущее состояние единиц: {(start, end): {'generation', 'owner', 'status', 'claimed_at',
+        'alive', 'rows'}}. status: pending, claimed, done или released; alive - аренда не истекла.
+        """
+        unit_sql = "AND unit_start = %(unit_start)s AND unit_end = %(unit_end)s" if unit else ""
+        rows = self.ch_client.execute(
+            f"""
+            SELECT unit_start, unit_end, generation, owner, argMax(status, updated_at), min(claimed_at),
+                   argMax(lease_until, updated_at) > now64(6), argMax(rows, updated_at)
+            FROM {self.table}
+            WHERE target_table = %(target_table)s {unit_sql}
+            GROUP BY unit_start, unit_end, generation, owner
+            """,
+            {'target_table': self.target_table, 'unit_start': unit[0] if unit else 0,
+             'unit_end': unit[1] if unit else 0}
+        )
+        states = {}
+        for start, end, generation, owner, status, claimed_at, alive, unit_rows in rows:
+            current = states.get((start, end))
+            # Старшее поколение, в нем - самый ранний захват
+            if (current is None or generation > current['generation']
+                    or (generation == current['generation'] and (claimed_at, owner) < (current['claimed_at'],
+                                                                                      current['owner']))):
+                states[(start, end)] = {'generation': generation, 'owner': owner, 'status': status,
+                                        'claimed_at': claimed_at, 'alive': bool(alive), 'rows': unit_rows}
+        return states
+
+    @staticmethod
+    def claimable(state):
+        """Единицу можно захватить: не захвачена, возвращена в очередь или аренда истекла"""
+        return (state['status'] in ('pending', 'released')
+                or (state['status'] == 'claimed' and not state['alive']))
+
+    def register(self, ranges):
+        """Добавляет новые единицы (start, end] в очередь"""
+        if not ranges:
+            return
+        epoch = datetime.datetime(1970, 1, 1)
+        now = datetime.datetime.now()
+        self.ch_client.execute(
+            f"INSERT INTO {self.table} VALUES",
+            [(self.target_table, start, end, 0, '', 'pending', epoch, epoch, 0, now) for start, end in ranges],
+            settings={'async_insert': 0}
+        )
+
+    def _write(self, unit, generation, status, claimed_at=None, lease_seconds=None, rows=0):
+        # Время захвата и аренды - по часам сервера ClickHouse
+        claimed_sql = "toDateTime64(%(claimed_at)s, 6)" if claimed_at is not None else "now64(6)"
+        self.ch_client.execute(
+            f"""
+            INSERT INTO {self.table}
+            SELECT %(target_table)s, %(unit_start)s, %(unit_end)s, %(generation)s, %(owner)s, %(status)s,
+                   {claimed_sql}, addMilliseconds(now64(6), %(lease_ms)s), %(rows)s, now64(6)
+            """,
+            {'target_table': self.target_table, 'unit_start': unit[0], 'unit_end': unit[1],
+             'generation': generation, 'owner': self.owner, 'status': status,
+             'claimed_at': claimed_at.isoformat(sep=' ', timespec='microseconds') if claimed_at else None,
+             'lease_ms': int((self.lease_seconds if lease_seconds is None else lease_seconds) * 1000),
+             'rows': rows},
+            settings={'async_insert': 0}
+        )
+
+    def owns(self, unit):
+        """Единица все еще захвачена этим экземпляром (то же поколение, аренда не истекла)"""
+        generation, _ = self.claims.get(unit, (None, None))
+        state = self.states(unit).get(unit)
+        return (state is not None and state['owner'] == self.owner and state['generation'] == generation
+                and state['status'] == 'claimed' and state['alive'])
+
+    def claim(self, unit, state=None):
+        """Пытается захватить единицу. Возвращает True, если захват остался за этим экземпляром"""
+        state = state or self.states(unit).get(unit)
+        if state is None and unit == self.PLAN_UNIT:
+            # Единица планирования появляется с первым захватом
+            state = {'generation': 0, 'status': 'pending', 'alive': False}
+        if state is None or not self.claimable(state):
+            return False
+        generation = state['generation'] + 1
+        self._write(unit, generation, 'claimed')
+        time.sleep(self.settle_seconds)
+        state = self.states(unit).get(unit)
+        if state['owner'] != self.owner or state['generation'] != generation:
+            logger.debug(f"{self.target_table} {unit}: захвачена экземпляром {state['owner']}")
+            return False
+        self.claims[unit] = (generation, state['claimed_at'])
+        return True
+
+    def next_unit(self):
+        """Захватывает следующую свободную единицу с наименьшим ключом или возвращает None"""
+        states = self.states()
+        candidates = sorted(unit for unit, state in states.items()
+                            if unit != self.PLAN_UNIT and self.claimable(state))
+        while candidates:
+            # Случайная из первых единиц, чтобы одновременные экземпляры реже спорили за одну
+            unit = random.choice(candidates[:8])
+            candidates.remove(unit)
+            if self.claim(unit, states[unit]):
+                return unit
+        return None
+
+    def busy(self):
+        """Есть единицы (или планирование) в работе у живых экземпляров"""
+        return any(state['status'] == 'claimed' and state['alive'] for state in self.states().values())
+
+    def heartbeat(self, unit):
+        """Продлевает аренду своей единицы. Возвращает False, если единица перешла к другому"""
+        if not self.owns(unit):
+            return False
+        generation, claimed_at = self.claims[unit]
+        self._write(unit, generation, 'claimed', claimed_at=claimed_at)
+        return True
+
+    def complete(self, unit, rows=0):
+        generation, claimed_at = self.claims.pop(unit)
+        self._write(unit, generation, 'done', claimed_at=claimed_at, lease_seconds=0, rows=rows)
+
+    def release(self, unit):
+        """Возвращает единицу в очередь (например, после ошибки или планирования)"""
+        generation, claimed_at = self.claims.pop(unit)
+        self._write(unit, generation, 'released', claimed_at=claimed_at, lease_seconds=0)
+
+    @contextlib.contextmanager
+    def lease(self, unit, client_factory=get_clickhouse_client):
+        """
+        Продлевает аренду единицы в фоновом потоке (каждую треть lease_seconds) со своим
+        подключением к ClickHouse. Возвращает Event, который выставляется, когда единица
+        перешла к другому экземпляру или аренду не удалось продлить до ее истечения.
+        """
+        lost = threading.Event()
+        stop = threading.Event()
+
+        def beat():
+            beat_queue = copy.copy(self)
+            beat_queue.ch_client = None
+            renewed = time.monotonic()
+            try:
+                try:
+                    beat_queue.ch_client = client_factory()
+                except Exception as e:
+                    # Без heartbeat аренда истечет, и единицу заберет другой экземпляр
+                    logger.error(f"{self.target_table} {unit}: нет подключения для продления аренды: {str(e)}")
+                    lost.set()
+                    return
+                while not stop.wait(self.lease_seconds / 3):
+                    try:
+                        if not beat_queue.heartbeat(unit):
+                            logger.warning(f"{self.target_table} {unit}: единица перешла к другому экземпляру")
+                            lost.set()
+                            return
+                        renewed = time.monotonic()
+                    except Exception as e:
+                        logger.warning(f"{self.target_table} {unit}: не удалось продлить аренду: {str(e)}")
+                        if time.monotonic() - renewed > self.lease_seconds:
+                            lost.set()
+                            return
+            finally:
+                if beat_queue.ch_client is not None:
+                    beat_queue.ch_client.disconnect()
+
+        thread = threading.Thread(target=beat, name=f'lease-{unit[0]}', daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+
+def plan_work_units(mssql_cursor, ch_client, spec, work_queue, checkpoint_store, unit_size):
+    """
+    Планирование очереди (под арендой PLAN_UNIT): новые строки источника выше последней
+    зарегистрированной единицы делятся на единицы по unit_size значений ключа.
+    Водяной знак таблицы в etl_checkpoints сдвигается по непрерывно завершенным единицам,
+    поэтому append после очереди продолжает с конца перенесенного.
+    Возвращает число новых единиц.
+    """
+    target_table = spec.target
+    key = spec.key
+    checkpoint = checkpoint_store.get(target_table)
+    if checkpoint is not None:
+        watermark = checkpoint[0]
+    else:
+        try:
+            watermark = ch_client.execute(f"SELECT max(`{key}`) FROM {target_table}")[0][0] or 0
+        except Exception as e:
+            logger.warning(f"Не удалось получить max ID (возможно таблица пустая): {str(e)}")
+            watermark = 0
+        checkpoint_store.save(target_table, watermark)
+
+    states = work_queue.states()
+    units = sorted(unit for unit in states if unit != work_queue.PLAN_UNIT)
+    new_watermark = watermark
+    for start, end in units:
+        if start > new_watermark:
+            break
+        if end > new_watermark:
+            if states[(start, end)]['status'] != 'done':
+                break
+            new_watermark = end
+    if new_watermark > watermark:
+        checkpoint_store.save(target_table, new_watermark)
+        logger.info(f"{target_table}: водяной знак очереди {key} > {new_watermark}")
+
+    start_id = max([watermark] + [end for _, end in units])
+    mssql_cursor.execute(f"SELECT MAX([{key}]) FROM {spec.source_table}")
+    max_id_source = mssql_cursor.fetchone()[0]
+    if max_id_source is None or max_id_source <= start_id:
+        return 0
+    ranges = [(lo, min(lo + unit_size, max_id_source)) for lo in range(start_id, max_id_source, unit_size)]
+    work_queue.register(ranges)
+    logger.info(f"{target_table}: в очередь добавлено {len(ranges)} единиц, {key} {start_id}..{max_id_source}")
+    return len(ranges)
+
+
+def run_work_queue(full_table_name=None, target_table=None, batch_size=50000, unit_size=1000000,
+                   lease_seconds=60, poll_interval=5, pipeline_depth=0, converter_threads=1,
+                   read_mode='stream', migrate_schema=False, connections=None, table_cache=None,
+                   spec=None, batch_control=None, isolation='read_committed'):
+    """
+    Перенос через общую очередь единиц работы (WorkQueue): экземпляры на разных хостах
+    запускаются с одной таблицей и делят ее диапазоны ключа без повторной загрузки.
+    Экземпляр, захвативший PLAN_UNIT, добавляет в очередь новые диапазоны по unit_size значений
+    ключа, затем все экземпляры захватывают единицы, переносят их copy_id_range под арендой
+    lease_seconds и отмечают завершение. Прогресс единицы хранится в etl_checkpoints
+    (shard_start, shard_end = границы единицы), батчи вставляются с токенами дедупликации,
+    поэтому единицу упавшего экземпляра после истечения аренды продолжает другой
+    с его контрольной точки. Экземпляр завершается, когда свободных единиц нет и ни одна
+    не в работе (poll_interval - пауза ожидания чужих единиц).
+    Возвращает {'rows': перенесено, 'errors': ошибок, 'units': перенесено единиц}.
+    """
+    start_time = time.time()
+    table_cache = {} if table_cache is None else table_cache
+    spec = spec or get_table_spec(full_table_name, target_table)
+    target_table = spec.target
+    key = spec.key
+    if spec.keyset:
+        raise ValueError(f"{target_table}: очередь единиц работы делит возрастающий ключ, keyset не поддерживается")
+
+    with open_connections(connections) as (mssql_conn, ch_client):
+        mssql_cursor = mssql_conn.cursor()
+        if 'columns_map' not in table_cache:
+            mssql_columns = get_source_columns(mssql_cursor, spec.schema, spec.table_name)
+            table_cache['columns_map'] = ensure_target_table(ch_client, target_table, mssql_columns,
+                                                             spec, migrate=migrate_schema)
+            table_cache['mssql_columns'] = mssql_columns
+        if 'converter' not in table_cache:
+            table_cache['converter'] = BatchConverter(table_cache['mssql_columns'].keys(),
+                                                      table_cache['columns_map'], spec.numeric_columns)
+        converter = table_cache['converter']
+
+        checkpoint_store = CheckpointStore(ch_client)
+        quarantine = QuarantineStore(ch_client, target_table, spec.source)
+        work_queue = WorkQueue(ch_client, target_table, lease_seconds=lease_seconds)
+        if 'work_queue_ready' not in table_cache:
+            checkpoint_store.ensure()
+            quarantine.ensure()
+            work_queue.ensure()
+            table_cache['work_queue_ready'] = True
+        logger.info(f"Очередь {work_queue.table}: {target_table}, экземпляр {work_queue.owner}")
+
+        transferred_rows = error_count = units_done = 0
+        planned = False
+        while True:
+            if not planned and work_queue.claim(work_queue.PLAN_UNIT):
+                try:
+                    plan_work_units(mssql_cursor, ch_client, spec, work_queue, checkpoint_store, unit_size)
+                finally:
+                    work_queue.release(work_queue.PLAN_UNIT)
+                planned = True
+
+            unit = work_queue.next_unit()
+            if unit is None:
+                if work_queue.busy():
+                    time.sleep(poll_interval)
+                    continue
+                break
+
+            lo, hi = unit
+            checkpoint = checkpoint_store.get(target_table, lo, hi)
+            resume_id, _, resume_batch_size, _ = checkpoint or (lo, False, 0, 0)
+            logger.info(f"{target_table}: единица ({lo}, {hi}], продолжение с {key} > {max(lo, resume_id)}")
+            batch_sizer = BatchSizer(ch_client, target_table, batch_size, first_size=resume_batch_size,
+                                     **(batch_control or {}))
+            try:
+                with work_queue.lease(unit) as lost:
+                    def on_checkpoint(last_id, batch_no, rows):
+                        if lost.is_set():
+                            raise RuntimeError(f"Аренда единицы ({lo}, {hi}] потеряна, перенос единицы остановлен")
+                        checkpoint_store.save(target_table, last_id, batch_no, rows, shard_start=lo,
+                                              shard_end=hi, batch_size=batch_sizer.next_size)
+
+                    with read_isolation(mssql_conn, isolation):
+                        unit_rows, unit_errors, _ = copy_id_range(
+                            mssql_conn.cursor(), ch_client, converter, spec.source_table, target_table,
+                            last_id=max(lo, resume_id), end_id=hi, batch_size=batch_size,
+                            quarantine=quarantine, pipeline_depth=pipeline_depth,
+                            converter_threads=converter_threads, read_mode=read_mode,
+                            reconnect=isolated_connection_factory(isolation),
+                            on_checkpoint=on_checkpoint, dedup_prefix=target_table, key=key,
+                            batch_sizer=batch_sizer
+                        )
+                quarantine.flush()
+                if lost.is_set():
+                    raise RuntimeError(f"Аренда единицы ({lo}, {hi}] потеряна до ее завершения")
+                checkpoint_store.save(target_table, hi, shard_start=lo, shard_end=hi, done=True)
+                work_queue.complete(unit, unit_rows)
+            except Exception:
+                quarantine.flush()
+                if unit in work_queue.claims:
+                    try:
+                        work_queue.release(unit)
+                    except Exception as e:
+                        logger.warning(f"Не удалось вернуть единицу ({lo}, {hi}] в очередь: {str(e)}")
+                raise
+            transferred_rows += unit_rows
+            error_count += unit_errors
+            units_done += 1
+            logger.info(f"{target_table}: единица ({lo}, {hi}] перенесена, {unit_rows:,} строк")
+
+    logger.info(
+        f"Очередь {target_table}: экземпляр перенес {units_done} единиц, {transferred_rows:,} строк "
+        f"за {time.time() - start_time:.2f} сек"
+    )
+    return {'rows': transferred_rows, 'errors': error_count, 'units': units_done}
+
+
+class ConnectionPool:
+    """
+    Пул пар подключений (mssql_conn, ch_client), живущих между переносами.
+    Пара выдается на время переноса одной таблицы; перед выдачей проверяется SELECT 1,
+    а после ошибки внутри переноса закрывается, чтобы не вернуть в пул оборванное подключение.
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_alive(pair):
+        mssql_conn, ch_client = pair
+        try:
+            mssql_conn.cursor().execute("SELECT 1")
+            ch_client.execute("SELECT 1")
+            return True
+        except Exception as e:
+            logger.warning(f"Подключение из пула потеряно, переподключаемся: {str(e)}")
+            return False
+
+    @staticmethod
+    def _close_pair(pair):
+        mssql_conn, ch_client = pair
+        for close in (mssql_conn.close, ch_client.disconnect):
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _take(self):
+        while True:
+            with self._lock:
+                pair = self._idle.pop() if self._idle else None
+            if pair is None:
+                return get_mssql_connection(), get_clickhouse_client()
+            if self._is_alive(pair):
+                return pair
+            self._close_pair(pair)
+
+    @contextlib.contextmanager
+    def connection(self):
+        pair = self._take()
+        try:
+            yield pair
+        except BaseException:
+            self._close_pair(pair)
+            raise
+        with self._lock:
+            self._idle.append(pair)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pair in idle:
+            self._close_pair(pair)
+
+
+class ResourceBudget:
+    """
+    Общий бюджет подключений к MS SQL и памяти для одновременных переносов таблиц.
+    Запрос больше всего бюджета урезается до бюджета (такой перенос идет в одиночку).
+    """
+
+    def __init__(self, connections, memory_mb):
+        self.connections = connections
+        self.memory_mb = memory_mb
+        self._used_connections = 0
+        self._used_memory_mb = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, connections, memory_mb):
+        connections = min(connections, self.connections)
+        memory_mb = min(memory_mb, self.memory_mb)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._used_connections + connections <= self.connections
+                and self._used_memory_mb + memory_mb <= self.memory_mb
+            )
+            self._used_connections += connections
+            self._used_memory_mb += memory_mb
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._used_connections -= connections
+                self._used_memory_mb -= memory_mb
+                self._condition.notify_all()
+
+
+# Настройки режимов export/load/redrive, не передаются в transfer_table
+MODE_OPTIONS = ('stage_dir', 'stage_format', 'stage_file_rows', 'stage_keep', 'redrive_source',
+                'reconcile_bucket', 'reconcile_bucket_size', 'reconcile_repair',
+                'backfill_from', 'backfill_to', 'queue_unit_size', 'queue_lease_seconds')
+
+# Оценка памяти на строку батча в Python-объектах (кортеж pyodbc + конвертированные колонки)
+ROW_BYTES_ESTIMATE = 4096
+
+
+class TransferOrchestrator:
+    """
+    Перенос нескольких таблиц одновременно (потоки, не больше max_tables) в пределах
+    общего бюджета подключений к MS SQL и памяти. Перед переносом таблица резервирует
+    свою долю бюджета и берет пару подключений из пула; схема таблиц кэшируется
+    между вызовами run (режим демона).
+    options - общие настройки запуска (аргументы transfer_table, mode, version_column
+    и MODE_OPTIONS), значения из TableSpec имеют приоритет.
+    mode: append - transfer_table, changes - sync_changes, export - export_table,
+    load - load_staged_files, redrive - redrive_quarantine, reconcile - reconcile_table,
+    backfill - backfill_window, queue - run_work_queue.
+    """
+
+    def __init__(self, specs, options, max_tables=2, connection_budget=8, memory_budget_mb=4096):
+        self.specs = list(specs)
+        self.options = dict(options)
+        self.max_tables = max(1, max_tables)
+        self.budget = ResourceBudget(connection_budget, memory_budget_mb)
+        self.table_caches = {spec.target: {} for spec in self.specs}
+
+    def table_options(self, spec):
+        """Настройки переноса таблицы: общие настройки с приоритетом значений из spec"""
+        options = dict(self.options)
+        for name in ('engine', 'batch_size', 'mode', 'version_column'):
+            if getattr(spec, name) is not None:
+                options[name] = getattr(spec, name)
+        # Адаптивный размер батча уменьшается, когда RSS процесса выходит за общий бюджет памяти
+        options['batch_control'] = dict(options.get('batch_control') or {})
+        options['batch_control'].setdefault('memory_limit_mb', self.budget.memory_mb)
+        return options
+
+    @staticmethod
+    def connections_needed(options):
+        """Подключения к MS SQL: основное, по одному на процесс-шард и отдельное у arrow-odbc"""
+        workers = options.get('workers', 1)
+        connections = 1 + (workers if workers > 1 else 0)
+        if options.get('engine') == 'arrow':
+            connections += max(1, workers)
+        return connections
+
+    @staticmethod
+    def memory_needed_mb(options):
+        """
+        Оценка памяти: батчи в работе конвейера (в каждом процессе-шарде) × размер батча
+        и буфер BlockCoalescer каждого процесса
+        """
+        depth = options.get('pipeline_depth', 0)
+        in_flight = depth * 2 + options.get('converter_threads', 1) if depth > 0 else 1
+        batches = in_flight * max(1, options.get('workers', 1))
+        batch_size = options.get('batch_size', 50000)
+        batch_control = options.get('batch_control') or {}
+        if batch_control.get('adaptive'):
+            batch_size = batch_control.get('max_size') or batch_size * 4
+        rows = batch_size * batches + options.get('coalesce_rows', 0) * max(1, options.get('workers', 1))
+        return rows * ROW_BYTES_ESTIMATE // 2 ** 20
+
+    def run_table(self, spec, pool):
+        options = self.table_options(spec)
+        mode = options.pop('mode', 'append')
+        version_column = options.pop('version_column', None)
+        mode_options = {name: options.pop(name) for name in MODE_OPTIONS if name in options}
+        table_cache = self.table_caches.setdefault(spec.target, {})
+        connections = self.connections_needed(options)
+        memory_mb = self.memory_needed_mb(options)
+        logger.debug(f"{spec.source}: резервируем {connections} подключений и {memory_mb} МБ")
+        with self.budget.reserve(connections, memory_mb), pool.connection() as pair:
+            try:
+                if mode == 'changes':
+                    return sync_changes(
+                        batch_size=options.get('batch_size', 50000), version_column=version_column,
+                        connections=pair, table_cache=table_cache, spec=spec
+                    )
+                if mode == 'export':
+                    return export_table(
+                        stage_dir=mode_options.get('stage_dir', 'stage'),
+                        data_format=mode_options.get('stage_format', 'parquet'),
+                        batch_size=options.get('batch_size', 50000),
+                        read_mode=options.get('read_mode', 'stream'),
+                        file_rows=mode_options.get('stage_file_rows', 1000000),
+                        connections=pair, table_cache=table_cache, spec=spec
+                    )
+                if mode == 'reconcile':
+                    return reconcile_table(
+                        bucket=mode_options.get('reconcile_bucket', 'month'),
+                        bucket_size=mode_options.get('reconcile_bucket_size', 1000000),
+                        repair=mode_options.get('reconcile_repair', False),
+                        batch_size=options.get('batch_size', 50000),
+                        connections=pair, table_cache=table_cache, spec=spec
+                    )
+                if mode == 'backfill':
+                    return backfill_window(
+                        date_from=mode_options.get('backfill_from'),
+                        date_to=mode_options.get('backfill_to'),
+                        batch_size=options.get('batch_size', 50000),
+                        connections=pair, table_cache=table_cache, spec=spec
+                    )
+                if mode == 'queue':
+                    return run_work_queue(
+                        batch_size=options.get('batch_size', 50000),
+                        unit_size=mode_options.get('queue_unit_size', 1000000),
+                        lease_seconds=mode_options.get('queue_lease_seconds', 60),
+                        pipeline_depth=options.get('pipeline_depth', 0),
+                        converter_threads=options.get('converter_threads', 1),
+                        read_mode=options.get('read_mode', 'stream'),
+                        migrate_schema=options.get('migrate_schema', False),
+                        connections=pair, table_cache=table_cache, spec=spec,
+                        batch_control=options.get('batch_control'),
+                        isolation=options.get('isolation', 'read_committed')
+                    )
+                if mode == 'redrive':
+                    return redrive_quarantine(
+                        source=mode_options.get('redrive_source', 'mssql'),
+                        batch_size=options.get('batch_size', 50000),
+                        connections=pair, table_cache=table_cache, spec=spec
+                    )
+                if mode == 'load':
+                    return load_staged_files(
+                        stage_dir=mode_options.get('stage_dir', 'stage'),
+                        keep_files=mode_options.get('stage_keep', False),
+                        checkpoints=options.get('checkpoints', True),
+                        migrate_schema=options.get('migrate_schema', False),
+                        connections=pair, table_cache=table_cache, spec=spec,
+                        batch_control=options.get('batch_control')
+                    )
+                return transfer_table(connections=pair, table_cache=table_cache, spec=spec, **options)
+            except Exception:
+                # Схема могла измениться - в следующий раз читаем ее заново
+                table_cache.clear()
+                raise
+
+    def run(self, pool=None):
+        """
+        Переносит все таблицы. Ошибка одной таблицы не останавливает остальные.
+        Возвращает {'rows', 'errors', 'tables': {цель: результат или ошибка}, 'failed': [цели]}.
+        """
+        own_pool = pool is None
+        pool = pool or ConnectionPool()
+        result = {'rows': 0, 'errors': 0, 'tables': {}, 'failed': []}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_tables, len(self.specs))),
+                                    thread_name_prefix='table') as executor:
+                futures = {executor.submit(self.run_table, spec, pool): spec for spec in self.specs}
+                for future in as_completed(futures):
+                    spec = futures[future]
+                    try:
+                        table_result = future.result()
+                    except Exception as e:
+                        logger.error(f"Перенос {spec.source} → {spec.target} не выполнен: {str(e)}")
+                        result['failed'].append(spec.target)
+                        result['tables'][spec.target] = {'error': f"{type(e).__name__}: {e}"}
+                        continue
+                    result['tables'][spec.target] = table_result
+                    result['rows'] += table_result['rows']
+                    result['errors'] += table_result['errors']
+        finally:
+            if own_pool:
+                pool.close()
+        return result
+
+
+class SyncDaemon:
+    """
+    Долгоживущий режим синхронизации вместо перезапуска контейнера.
+    Подключения к MS SQL и ClickHouse держатся в пуле между циклами, схема таблиц
+    кэшируется в оркестраторе. run_cycle(pool=...) вызывается каждые poll_interval секунд
+    и возвращает результат TransferOrchestrator.run. Состояние отдается по HTTP на status_port.
+    """
+
+    def __init__(self, run_cycle, poll_interval=60, status_port=None):
+        self.run_cycle = run_cycle
+        self.poll_interval = poll_interval
+        self.status_port = status_port
+        self.pool = ConnectionPool()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._state = {
+            'status': 'starting',
+            'started_at': datetime.datetime.now(),
+            'poll_interval': poll_interval,
+            'cycles': 0,
+            'failed_cycles': 0,
+            'consecutive_failures': 0,
+            'total_rows': 0,
+            'last_rows': None,
+            'last_errors': None,
+            'tables': {},
+            'last_cycle_started_at': None,
+            'last_cycle_seconds': None,
+            'last_success_at': None,
+            'last_error': None,
+            'next_poll_at': None,
+        }
+
+    def state(self):
+        with self._lock:
+            return dict(self._state)
+
+    def _update_state(self, **changes):
+        with self._lock:
+            self._state.update(changes)
+
+    def stop(self, *args):
+        logger.info("Получен сигнал остановки, завершаем после текущего цикла")
+        self._stop.set()
+
+    def run_once(self):
+        cycle_start = time.time()
+        self._update_state(status='running', last_cycle_started_at=datetime.datetime.now())
+        result = None
+        error = None
+        try:
+            result = self.run_cycle(pool=self.pool)
+            if result['failed']:
+                error = f"Не перенесены таблицы: {', '.join(result['failed'])}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        with self._lock:
+            self._state['last_cycle_seconds'] = round(time.time() - cycle_start, 3)
+            if result is not None:
+                self._state['total_rows'] += result['rows']
+                self._state.update(last_rows=result['rows'], last_errors=result['errors'],
+                                   tables=result['tables'])
+            if error is None:
+                self._state['cycles'] += 1
+                self._state.update(status='idle', consecutive_failures=0,
+                                   last_success_at=datetime.datetime.now())
+            else:
+                self._state['failed_cycles'] += 1
+                self._state['consecutive_failures'] += 1
+                self._state.update(status='error', last_error=error)
+        if error is not None:
+            logger.error(f"Цикл синхронизации завершился ошибкой: {error}")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        server = serve_status(self.status_port, self.state) if self.status_port else None
+        logger.info(f"Режим демона: опрос источника каждые {self.poll_interval} сек")
+        try:
+            while not self._stop.is_set():
+                self.run_once()
+                next_poll = datetime.datetime.now() + datetime.timedelta(seconds=self.poll_interval)
+                self._update_state(next_poll_at=next_poll)
+                self._stop.wait(self.poll_interval)
+        finally:
+            self._update_state(status='stopped', next_poll_at=None)
+            self.pool.close()
+            if server is not None:
+                server.shutdown()
+        logger.info("Демон синхронизации остановлен")
+
+
 if __name__ == "__main__":
     try:
         # Настройки из переменных окружения
@@ -372,10 +4392,71 @@ if __name__ == "__main__":
         os.environ.setdefault('CH_USER', 'admin')
         os.environ.setdefault('CH_PASSWORD', 'admin123')
         
-        transfer_table(
-            full_table_name='bi.ALL_DATA_COMPETITORS_MATERIALIZED',
-            batch_size=50000  # Увеличенный размер блока
+        daemon = environ.get('TRANSFER_DAEMON', '0') == '1'
+        orchestrator = TransferOrchestrator(
+            resolve_table_specs(environ.get('TABLE_TO_TRANSFER', 'bi.ALL_DATA_COMPETITORS_MATERIALIZED')),
+            options={
+                'mode': environ.get('TRANSFER_MODE', 'append'),
+                'version_column': environ.get('TRANSFER_VERSION_COLUMN') or None,
+                # Размер батча для таблиц, у которых он не задан в реестре
+                'batch_size': int(environ.get('BATCH_SIZE', '50000')),
+                'workers': int(environ.get('TRANSFER_WORKERS', '1')),
+                'pipeline_depth': int(environ.get('TRANSFER_PIPELINE_DEPTH', '2')),
+                'converter_threads': int(environ.get('TRANSFER_CONVERTER_THREADS', '1')),
+                'read_mode': environ.get('TRANSFER_READ_MODE', 'stream'),
+                'engine': environ.get('TRANSFER_ENGINE', 'python'),
+                'checkpoints': environ.get('TRANSFER_CHECKPOINTS', '1') == '1',
+                'migrate_schema': environ.get('TRANSFER_MIGRATE_SCHEMA', '0') == '1',
+                # estimate - оценка по метаданным, exact - COUNT(*) новых строк
+                'row_count': environ.get('TRANSFER_ROW_COUNT', 'estimate'),
+                'run_history': environ.get('TRANSFER_RUN_HISTORY', '1') == '1',
+                'profile': environ.get('TRANSFER_PROFILE', '0') == '1',
+                # snapshot - весь перенос одной транзакцией SNAPSHOT без блокировок источника
+                'isolation': environ.get('TRANSFER_ISOLATION', 'read_committed'),
+                # >0 - вставка блоками по партициям, отсортированными по ключу сортировки
+                'coalesce_rows': int(environ.get('TRANSFER_COALESCE_ROWS', '0')),
+                # Файловая выгрузка: export - MS SQL → файлы, load - файлы → ClickHouse
+                'stage_dir': environ.get('TRANSFER_STAGE_DIR', '/app/data/stage'),
+                'stage_format': environ.get('TRANSFER_STAGE_FORMAT', 'parquet'),
+                'stage_file_rows': int(environ.get('TRANSFER_STAGE_FILE_ROWS', '1000000')),
+                'stage_keep': environ.get('TRANSFER_STAGE_KEEP', '0') == '1',
+                # redrive - повторная вставка строк из etl_quarantine: mssql или quarantine
+                'redrive_source': environ.get('TRANSFER_REDRIVE_SOURCE', 'mssql'),
+                # reconcile - сверка агрегатами по месяцам (month) или диапазонам ключа (id)
+                'reconcile_bucket': environ.get('TRANSFER_RECONCILE_BUCKET', 'month'),
+                'reconcile_bucket_size': int(environ.get('TRANSFER_RECONCILE_BUCKET_SIZE', '1000000')),
+                'reconcile_repair': environ.get('TRANSFER_RECONCILE_REPAIR', '0') == '1',
+                # backfill - перезаливка окна sale_date целыми партициями
+                'backfill_from': environ.get('TRANSFER_BACKFILL_FROM'),
+                'backfill_to': environ.get('TRANSFER_BACKFILL_TO'),
+                # queue - экземпляры на разных хостах делят диапазоны id через etl_work_units
+                'queue_unit_size': int(environ.get('TRANSFER_QUEUE_UNIT_SIZE', '1000000')),
+                'queue_lease_seconds': int(environ.get('TRANSFER_QUEUE_LEASE_SECONDS', '60')),
+                # Размер батча по времени этапов и памяти, пауза при перегрузке слияний ClickHouse
+                'batch_control': {
+                    'adaptive': environ.get('TRANSFER_ADAPTIVE_BATCH', '0') == '1',
+                    'min_size': int(environ.get('TRANSFER_MIN_BATCH_SIZE', '0')) or None,
+                    'max_size': int(environ.get('TRANSFER_MAX_BATCH_SIZE', '0')) or None,
+                    'target_seconds': float(environ.get('TRANSFER_TARGET_BATCH_SECONDS', '5')),
+                    'max_parts': int(environ.get('TRANSFER_MAX_ACTIVE_PARTS', '100')),
+                    'max_merges': int(environ.get('TRANSFER_MAX_MERGES', '10')),
+                },
+            },
+            max_tables=int(environ.get('TRANSFER_MAX_TABLES', '2')),
+            connection_budget=int(environ.get('TRANSFER_MAX_CONNECTIONS', '8')),
+            memory_budget_mb=int(environ.get('TRANSFER_MEMORY_BUDGET_MB', '4096'))
         )
+
+        if daemon:
+            SyncDaemon(
+                orchestrator.run,
+                poll_interval=float(environ.get('TRANSFER_POLL_INTERVAL', '60')),
+                status_port=int(environ.get('TRANSFER_STATUS_PORT', '0')) or None
+            ).run()
+        else:
+            result = orchestrator.run()
+            if result['failed']:
+                raise RuntimeError(f"Не перенесены таблицы: {', '.join(result['failed'])}")
     except Exception as e:
         logger.error(f"Фатальная ошибка: {str(e)}", exc_info=True)
         exit(1)
\ No newline at end of file
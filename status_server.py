@@ -0,0 +1,26 @@
+import json
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+def serve_status(port, get_state):
+    """Отдает состояние процесса в JSON по HTTP (GET на любой путь) в фоновом потоке"""
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(get_state(), ensure_ascii=False, default=str).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"status: {format % args}")
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name='status-server', daemon=True).start()
+    logger.info(f"Состояние доступно по http://0.0.0.0:{port}/status")
+    return server
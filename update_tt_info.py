@@ -12,8 +12,10 @@ import os
 import pyodbc
 import numpy as np
 from tqdm import tqdm
-from datetime import date
+from datetime import date, datetime, timedelta
 import hashlib
+import signal
+from status_server import serve_status
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -678,8 +680,9 @@ class YandexGeoProcessor:
             'federal_subject': federal_subject
         }
 
-    def process_source_table(self, max_requests: int = 2000, sleep_between: float = 0.5) -> Dict[str, int]:
-        """Обрабатывает новые адреса с конкретной датой продажи"""
+    def process_source_table(self, max_requests: int = 2000, sleep_between: float = 0.5,
+                             rows: Optional[List[Dict]] = None) -> Dict[str, int]:
+        """Обрабатывает новые адреса с конкретной датой продажи (rows - уже прочитанные записи)"""
         stats = {
             'fetched': 0, 
             'processed': 0, 
@@ -690,7 +693,8 @@ class YandexGeoProcessor:
         }
 
         try:
-            rows = self.get_data_from_source_table()
+            if rows is None:
+                rows = self.get_data_from_source_table()
             stats['fetched'] = len(rows)
             rows_to_process = rows[:max_requests]
             total_to_process = len(rows_to_process)
@@ -755,6 +759,88 @@ class YandexGeoProcessor:
             return stats
         
 
+def run_daemon(processor: YandexGeoProcessor, poll_interval: float = 300, daily_limit: int = 40000,
+               sleep_between: float = 0.1, status_port: Optional[int] = None):
+    """
+    Режим демона: обновление продаж и геокодирование новых магазинов каждые poll_interval секунд.
+    Подключение к БД переиспользуется (get_db_connection), лимит API запросов считается за сутки,
+    а не за цикл. Состояние отдается по HTTP на status_port.
+    """
+    stop = threading.Event()
+    lock = threading.Lock()
+    state = {
+        'status': 'starting',
+        'started_at': datetime.now(),
+        'poll_interval': poll_interval,
+        'cycles': 0,
+        'failed_cycles': 0,
+        'api_requests_today': 0,
+        'api_day': date.today(),
+        'last_updated_sales': None,
+        'last_stats': None,
+        'pending': None,
+        'last_success_at': None,
+        'last_error': None,
+        'next_poll_at': None,
+    }
+
+    def get_state():
+        with lock:
+            return dict(state)
+
+    def on_signal(*args):
+        logger.info("Получен сигнал остановки, завершаем после текущего цикла")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    server = serve_status(status_port, get_state) if status_port else None
+    logger.info(f"Режим демона: опрос каждые {poll_interval} сек, лимит API {daily_limit} запросов в сутки")
+
+    try:
+        while not stop.is_set():
+            with lock:
+                if state['api_day'] != date.today():
+                    state['api_day'] = date.today()
+                    state['api_requests_today'] = 0
+                state['status'] = 'running'
+                requests_left = daily_limit - state['api_requests_today']
+            try:
+                updated_count = processor.update_existing_stores_sales()
+                rows = processor.get_data_from_source_table()
+                stats = None
+                if rows and requests_left > 0:
+                    stats = processor.process_source_table(
+                        max_requests=requests_left,
+                        sleep_between=sleep_between,
+                        rows=rows
+                    )
+                elif rows:
+                    logger.warning(f"Суточный лимит API исчерпан, ожидают обработки: {len(rows)}")
+                with lock:
+                    state['cycles'] += 1
+                    state['api_requests_today'] += stats['api_requests'] if stats else 0
+                    state.update(
+                        status='idle', last_updated_sales=updated_count, last_stats=stats,
+                        pending=len(rows) - (stats['processed'] if stats else 0),
+                        last_success_at=datetime.now()
+                    )
+            except Exception as e:
+                logger.error(f"Цикл обработки завершился ошибкой: {e}")
+                with lock:
+                    state['failed_cycles'] += 1
+                    state.update(status='error', last_error=f"{type(e).__name__}: {e}")
+            with lock:
+                state['next_poll_at'] = datetime.now() + timedelta(seconds=poll_interval)
+            stop.wait(poll_interval)
+    finally:
+        with lock:
+            state.update(status='stopped', next_poll_at=None)
+        if server is not None:
+            server.shutdown()
+    logger.info("Демон обработки остановлен")
+
+
 def main():
     print("🔍 Запуск обработки данных из БД")
     
@@ -779,6 +865,15 @@ def main():
 
     # Информация о ключах
     print(f"🔑 Используется {len(API_KEYS)} ключей")
+
+    if os.environ.get('TT_DAEMON', '0') == '1':
+        run_daemon(
+            processor,
+            poll_interval=float(os.environ.get('TT_POLL_INTERVAL', '300')),
+            daily_limit=int(os.environ.get('TT_DAILY_API_LIMIT', '40000')),
+            status_port=int(os.environ.get('TT_STATUS_PORT', '0')) or None
+        )
+        return
     
     # 1. Сначала обновляем существующие записи с продажами
     print("🔄 Обновление данных о продажах в существующих магазинах...")
@@ -794,7 +889,8 @@ def main():
     if total_records > 0:
         stats = processor.process_source_table(
             max_requests=40000,
-            sleep_between=0.1
+            sleep_between=0.1,
+            rows=rows_to_process
         )
         
         print(f"\n📊 Статистика обработки:")